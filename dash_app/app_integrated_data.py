@@ -1,10 +1,13 @@
+import base64
 import datetime
+import functools
+import hmac
 import io
+import os
 import random
 import re
 
 import dash_bootstrap_components as dbc
-import diskcache
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
@@ -18,25 +21,42 @@ from dash import (
     State,
     callback,
     callback_context,
+    dash_table,
     dcc,
     html,
 )
-from dash_extensions.enrich import (
-    DashProxy,
-    Serverside,
-    ServersideOutputTransform,
-    no_update,
-)
-from flask import send_file
+from dash_extensions.enrich import DashProxy, Serverside, no_update
+from flask import abort, jsonify, request, send_file
 
 import auxiliary_functions
+import cache_management
 import data_loading
+import data_processing
+import dim_reduction_backend
 import dim_reduction_viz
 import image_backend
+import normative_atlas
+import outlier_atlas
 import outlier_detection
+import outlier_model
+import permutation_testing
 import principal_components_age_corr_regression_viz
+import quantile_sketches
+import regression_cache
+import regression_registry
+import session_manager
 import tck_file_loading
+from arrow_backend import (
+    ArrowBackend,
+    ArrowServersideOutputTransform,
+    Columns,
+    SchemaOnly,
+)
 from constants import (
+    ADMIN_TOKEN_ENV,
+    BACKGROUND_CACHE_DIR,
+    BACKGROUND_CACHE_SIZE_LIMIT,
+    BOOTSTRAP_RESAMPLES,
     DBC_CSS,
     DBC_THEME,
     DEFAULT_AGE_GROUPS,
@@ -44,20 +64,86 @@ from constants import (
     DEFAULT_MEASURES,
     DEFAULT_SEXES,
     IMAGE_DOWNLOAD_OPTIONS,
+    OUTLIER_ENGINES,
+    PATIENT_SCORE_ALPHA,
+    PATIENT_SCORE_N_COMPONENTS,
+    PERMUTATION_TEST_PERMUTATIONS,
+    QUANTILE_SKETCH_SIZE,
 )
 from content_layout import content_layout
 
 # Cache Managers
-cache = diskcache.Cache("./cache")
+# The caches are bounded by the budgets and TTLs of their namespace, and swept periodically (see cache_management.py)
+cache = cache_management.managed_cache(
+    BACKGROUND_CACHE_DIR, BACKGROUND_CACHE_SIZE_LIMIT, "background"
+)
 background_callback_manager = DiskcacheManager(cache)
+serverside_backend = ArrowBackend()
+cache_management.start_sweeper()
 
 # App Setup
 app = DashProxy(
     external_stylesheets=[DBC_THEME, DBC_CSS],
-    transforms=[ServersideOutputTransform()],
+    # Serverside DataFrames are stored as Arrow IPC files, read memory-mapped and column by column (see arrow_backend.py)
+    transforms=[ArrowServersideOutputTransform(backends=[serverside_backend])],
     background_callback_manager=background_callback_manager,
 )
 
+
+# Every browser gets a session id cookie, the server-side data in memory is budgeted per session (see session_manager.py)
+app.server.after_request(session_manager.set_session_cookie)
+
+
+def admin_only(view):
+    """
+    Restricts an admin endpoint to the requests carrying the shared secret of ADMIN_TOKEN_ENV in the X-Admin-Token header
+    The endpoint answers 404 when no secret is configured, and 403 when the header does not match
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        token = os.environ.get(ADMIN_TOKEN_ENV)
+        if not token:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), token):
+            abort(403)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@app.server.route("/admin/cache")
+@admin_only
+def cache_stats():
+    """
+    Returns the statistics of the cache namespaces, and the in-memory values of the server process, as JSON
+    """
+    stats = cache_management.stats()
+    if serverside_backend.sessions is not None:
+        stats["serverside_hot_cache"] = serverside_backend.sessions.cache.stats()
+    return jsonify(stats)
+
+
+@app.server.route("/admin/sessions")
+@admin_only
+def session_stats():
+    """
+    Returns the memory footprint of the sessions of the server process, as JSON
+    """
+    if serverside_backend.sessions is None:
+        return jsonify({})
+    return jsonify(serverside_backend.sessions.telemetry())
+
+
+@app.server.route("/admin/cache/sweep", methods=["POST"])
+@admin_only
+def cache_sweep():
+    """
+    Sweeps the cache namespaces now, returns the number of removed entries per namespace as JSON
+    """
+    return jsonify(cache_management.sweep())
+
+
 # Placeholder for the scatter plot figure
 fig = px.scatter()
 fig.update_yaxes(
@@ -85,6 +171,7 @@ app.layout = content_layout.create_content_layout()
         Output("age-group-dropdown", "value"),
         Output("sex-dropdown", "value"),
         # End Deletion in prod
+        Output("quantile-sketch-store", "data"),
     ],
     [Input("upload-data", "contents")],
 )
@@ -93,7 +180,7 @@ def update_dropdown_options(contents):
     Updates the dropdown options based on the uploaded data (runs only once every time data is uploaded)
     """
     if contents is None:
-        return [no_update] * 9
+        return [no_update] * 10
 
     try:
         table_data, pathways_tractseg, id_data, sex_data, age_data, age_group_data = (
@@ -103,6 +190,10 @@ def update_dropdown_options(contents):
             table_data, pathways_tractseg, id_data, sex_data, age_data, age_group_data
         )
         options = auxiliary_functions.prepare_dropdown_options(df)
+        # Quantile sketches of every bundle x age group x sex cell, for the outlier normal-score transform
+        cell_sketches = quantile_sketches.build_cell_sketches(
+            df, size=QUANTILE_SKETCH_SIZE
+        )
         return [
             *options,
             Serverside(df),
@@ -110,6 +201,7 @@ def update_dropdown_options(contents):
             DEFAULT_MEASURES,
             DEFAULT_AGE_GROUPS,
             DEFAULT_SEXES,
+            Serverside(cell_sketches),
         ]
     except Exception as e:
         raise Exception(f"Failed to load or process data: {e}")
@@ -125,7 +217,7 @@ def update_dropdown_options(contents):
     ],
     prevent_initial_call=True,
 )
-def update_load_images_switch(data):
+def update_load_images_switch(data: SchemaOnly):
     """
     Callback to reset the load images switch and the relayout data of the scatter plot upon a change of the PCA data
     """
@@ -414,6 +506,10 @@ def update_graph_based_on_images(
         Output("pca-data-store", "data"),
         Output("pca-outlier-store", "data"),
         Output("hover-data-store", "data"),
+        Output("umap-knn-store", "data"),
+        Output("kernel-pca-model-store", "data"),
+        Output("pca-refine-store", "data"),
+        Output("outlier-projection-store", "data"),
         Output("modal_patient_selector_error", "is_open"),
         Output("modal_patient_selector_error_body", "children"),
     ],
@@ -439,12 +535,24 @@ def update_graph_based_on_images(
         Input("apply-changes-button", "n_clicks"),
         State("original-measures-dropdown", "value"),
         Input("change-splom-button", "n_clicks"),
+        State("reduction-method", "value"),
+        State("umap-n-neighbors", "value"),
+        State("umap-min-dist", "value"),
+        State("umap-n-epochs", "value"),
+        State("umap-knn-store", "data"),
+        State("kpca-n-landmarks", "value"),
+        State("kpca-gamma", "value"),
+        State("progressive-pca-switch", "value"),
+        State("exact-quantile-switch", "value"),
+        State("quantile-sketch-store", "data"),
     ],
     prevent_initial_call=True,
     running=[
         (Output("apply-changes-button", "disabled"), True, False),
         (Output("change-splom-button", "disabled"), True, False),
+        (Output("cancel-changes-button", "disabled"), False, True),
     ],
+    cancel=[Input("cancel-changes-button", "n_clicks")],
     background=True,
 )
 def update_graph(
@@ -469,9 +577,20 @@ def update_graph(
     apply_changes_clicks,
     original_measures_value,
     change_splom_clicks,
+    reduction_method,
+    umap_n_neighbors,
+    umap_min_dist,
+    umap_n_epochs,
+    umap_knn_graph,
+    kpca_n_landmarks,
+    kpca_gamma,
+    progressive_pca,
+    exact_quantile_transform,
+    cell_sketches,
 ):
     """
     Main callback function to update the PCA scatter plot and related plots
+    Runs as a background job, which can be cancelled with the cancel button in the patient selector
     """
     # For easier handling during invocation of other functions, this is used to pack all the parameters
     params = auxiliary_functions.pack_params(
@@ -494,6 +613,14 @@ def update_graph(
         modal_is_open,
         modal_close_clicks,
         apply_changes_clicks,
+        reduction_method,
+        umap_n_neighbors,
+        umap_min_dist,
+        umap_n_epochs,
+        kpca_n_landmarks,
+        kpca_gamma,
+        progressive_pca,
+        exact_quantile_transform,
     )
     # Gets callback context
     ctx = callback_context
@@ -514,6 +641,10 @@ def update_graph(
             no_update,
             no_update,
             no_update,
+            no_update,
+            no_update,
+            no_update,
+            no_update,
         )
 
     # Check if the button for closing the modal was clicked
@@ -585,8 +716,49 @@ def update_graph(
                 no_update,
                 no_update,
                 no_update,
+                no_update,
+                no_update,
+                no_update,
+                no_update,
             )
         try:
+            # Progressive PCA: show a preview fitted on a sample first, the exact PCA is computed by refine_progressive_pca
+            if params["progressive_pca"] and params["reduction_method"] == "pca":
+                preview = auxiliary_functions.run_pca_preview(
+                    params, all_patients_df, patient_list
+                )
+                if preview is not None:
+                    fig, fig_pca_loadings, pca_df, hover_data = preview
+                    # The uploaded contents are not needed to refine, so they are not stored
+                    refine_params = {
+                        key: value for key, value in params.items() if key != "contents"
+                    }
+                    # The plots and the outlier data of the previous selection are cleared until the refinement
+                    # replaces them, so the outlier tab never runs on the previous selection
+                    placeholder = dim_reduction_viz.create_placeholder_plot(
+                        "Refining the PCA preview..."
+                    )
+                    return (
+                        fig,
+                        fig_pca_loadings,
+                        placeholder,
+                        placeholder,
+                        placeholder,
+                        placeholder,
+                        params["bundle_values"],
+                        params["measure_values"],
+                        Serverside(pca_df),
+                        None,
+                        Serverside(hover_data),
+                        no_update,
+                        None,
+                        Serverside(
+                            {"params": refine_params, "patient_list": patient_list}
+                        ),
+                        None,
+                        no_update,
+                        no_update,
+                    )
             # Run PCA and related plots
             (
                 fig,
@@ -598,7 +770,16 @@ def update_graph(
                 pca_df,
                 pca_outlier_df,
                 hover_data,
-            ) = auxiliary_functions.run_pca(params, all_patients_df, patient_list)
+                umap_knn_graph,
+                kernel_pca_model,
+                outlier_projection,
+            ) = auxiliary_functions.run_pca(
+                params,
+                all_patients_df,
+                patient_list,
+                umap_knn_graph,
+                cell_sketches=cell_sketches,
+            )
             return (
                 fig,
                 fig_pca_loadings,
@@ -611,6 +792,11 @@ def update_graph(
                 Serverside(pca_df),
                 Serverside(pca_outlier_df),
                 Serverside(hover_data),
+                Serverside(umap_knn_graph) if umap_knn_graph else no_update,
+                # Cleared for the other methods, so new scans are not projected on a previous embedding
+                Serverside(kernel_pca_model) if kernel_pca_model else None,
+                no_update,
+                Serverside(outlier_projection),
                 no_update,
                 no_update,
             )
@@ -632,7 +818,100 @@ def update_graph(
             no_update,
             no_update,
             no_update,
+            no_update,
+            no_update,
+            no_update,
+            no_update,
+        )
+
+
+@app.callback(
+    [
+        Output("graph-2-dcc", "figure", allow_duplicate=True),
+        Output("graph-pca-loadings", "figure", allow_duplicate=True),
+        Output("graph-original-measures", "figure", allow_duplicate=True),
+        Output("graph-correlation-heatmap", "figure", allow_duplicate=True),
+        Output("graph-explained-variance", "figure", allow_duplicate=True),
+        Output("graph-explained-outlier-variance", "figure", allow_duplicate=True),
+        Output("pca-data-store", "data", allow_duplicate=True),
+        Output("pca-outlier-store", "data", allow_duplicate=True),
+        Output("outlier-projection-store", "data", allow_duplicate=True),
+        Output("modal_patient_selector_error", "is_open", allow_duplicate=True),
+        Output("modal_patient_selector_error_body", "children", allow_duplicate=True),
+    ],
+    [
+        Input("pca-refine-store", "data"),
+        State("patient-list-store", "data"),
+        State("pca-data-store", "data"),
+        State("quantile-sketch-store", "data"),
+    ],
+    prevent_initial_call=True,
+    running=[
+        (Output("pca-refine-status", "children"), "Refining the PCA preview...", ""),
+    ],
+    # A new selection makes the refinement obsolete
+    cancel=[Input("apply-changes-button", "n_clicks")],
+    background=True,
+)
+def refine_progressive_pca(
+    refine_request, all_patients_df, preview_pca_df, cell_sketches
+):
+    """
+    Second stage of the progressive PCA: computes the exact PCA of the selection shown as a preview,
+    and patches the coordinates of the scatter plot in place, so the zoom and the image markers are kept
+    The plots that were skipped by the preview (SPLOM, heatmap, explained variance) are created here
+    """
+    if refine_request is None or all_patients_df is None:
+        return [no_update] * 11
+
+    try:
+        (
+            fig,
+            fig_pca_loadings,
+            fig_original_measures,
+            fig_corr_heatmap,
+            fig_pca_x_variance,
+            fig_outlier_pca_x_variance,
+            pca_df,
+            pca_outlier_df,
+            _,
+            _,
+            _,
+            outlier_projection,
+        ) = auxiliary_functions.run_pca(
+            refine_request["params"],
+            all_patients_df,
+            refine_request["patient_list"],
+            reference_pca_df=preview_pca_df,
+            cell_sketches=cell_sketches,
         )
+    except Exception as e:
+        # Same modal as update_graph, the preview stays on screen but the user knows it was not refined
+        return [no_update] * 9 + [
+            True,
+            f"An error occurred while refining the PCA preview, the plot shows the preview \n {e}",
+        ]
+
+    # Only the coordinates and the title change, the traces are in the same order as in the preview
+    fig_patch = Patch()
+    for i, trace in enumerate(fig.data):
+        fig_patch["data"][i]["x"] = trace.x
+        fig_patch["data"][i]["y"] = trace.y
+    fig_patch["layout"]["title"]["text"] = fig.layout.title.text
+
+    return [
+        fig_patch,
+        fig_pca_loadings,
+        fig_original_measures,
+        fig_corr_heatmap,
+        fig_pca_x_variance,
+        fig_outlier_pca_x_variance,
+        Serverside(pca_df),
+        Serverside(pca_outlier_df),
+        Serverside(outlier_projection),
+        no_update,
+        no_update,
+    ]
 
 
 @app.callback(
@@ -641,7 +920,7 @@ def update_graph(
     background=True,
     prevent_initial_call=True,
 )
-def update_x_y_axes(data, figure):
+def update_x_y_axes(data: SchemaOnly, figure):
     """
     Function to update the x and y axes of the scatter plot, used for the image markers
     """
@@ -847,12 +1126,79 @@ def update_3d_visualization(
         return no_update, no_update, no_update, no_update, no_update
 
 
+def age_regression_from_inputs(
+    pca_df,
+    y_axis_value,
+    bundle_value,
+    sex_value,
+    knots_value,
+    enable_knots,
+    select_knots_cv,
+):
+    """
+    Builds the (not fitted) SplineRegression of the inputs of the age scatter plot: the bundle, the split by sex,
+    and the typed, default or cross-validated knots and degree. It is shared by the regression plot and its
+    bootstrap bands, so both describe the same model.
+    Returns the regression and the cross-validation results (None if the knots were not selected by cross-validation),
+    or None, None if the bundle has no data. Raises a ValueError if the typed knots are invalid.
+    """
+    # Truncate the PCA data to the selected bundle
+    pca_df_truncate = pca_df[pca_df["Bundle"] == bundle_value]
+    if len(pca_df_truncate) == 0:
+        return None, None
+
+    # Convert the Age_Group column to a categorical column, and apply the get_age_group_label function
+    pca_df_truncate.loc[:, "Age_Group"] = (
+        pca_df_truncate["Age_Group"]
+        .astype("category")
+        .apply(auxiliary_functions.get_age_group_label)
+    )
+
+    # Different or same plot divided by sex, or all the data
+    plots = {
+        "Divided by Sex Different Plot": "Different Plot",
+        "Divided by Sex Same Plot": "Same Plot",
+    }.get(sex_value)
+    by_variable = "Sex" if plots else None
+
+    knots_list = None
+    degree = 3
+    cv_df = None
+    # Check if the knots are enabled
+    if enable_knots:
+        # Check if the knots are valid, based on the available age values
+        knots_list = sorted(int(knot) for knot in (knots_value or "").split(","))
+        # if the knots are not within the range of the age values, return an error
+        if knots_list[0] < pca_df["Age"].min() or knots_list[-1] > pca_df["Age"].max():
+            raise ValueError("The knots are outside of the range of the age values")
+    # Select the knots and degree by cross-validation, grouped by patient, replaces the typed knots
+    # With separate fits per sex, the knots are selected per sex, within the age range of each
+    if select_knots_cv:
+        knots_list, degree, cv_df = regression_cache.select_knots(
+            pca_df_truncate, y_axis_value, by_variable=by_variable
+        )
+
+    spline_reg = principal_components_age_corr_regression_viz.SplineRegression(
+        dataframe=pca_df_truncate,
+        response_var=y_axis_value,
+        predictor_var="Age",
+        bundle_var=bundle_value,
+        degree=degree,
+        knots=knots_list,
+        method="GLM",
+        by_variable=by_variable,
+        plots=plots,
+    )
+    return spline_reg, cv_df
+
+
 @app.callback(
     [
         Output("graph-pca-scatter-plot-age-div", "children", allow_duplicate=True),
         Output("store-pca-scatter-plot-output", "data", allow_duplicate=True),
         Output("scatter-plot-knots-input", "valid", allow_duplicate=True),
         Output("scatter-plot-knots-input", "invalid", allow_duplicate=True),
+        Output("graph-knot-selection-cv", "figure"),
     ],
     [
         Input("generate-scatter-plot-regression", "n_clicks"),
@@ -862,9 +1208,8 @@ def update_3d_visualization(
         State("scatter-plot-sex-dropdown", "value"),
         State("scatter-plot-knots-input", "value"),
         State("scatter-plot-knots", "value"),
+        State("scatter-plot-knots-cv", "value"),
         State("pca-data-store", "data"),
-        State("graph-pca-scatter-plot-age-div", "children"),
-        State("store-pca-scatter-plot-output", "data"),
     ],
     prevent_initial_call=True,
 )
@@ -876,9 +1221,8 @@ def update_pca_scatter_plot_age(
     sex_value,
     knots_value,
     enable_knots,
+    select_knots_cv,
     pca_df,
-    children,
-    data_store_scatter_plot_output_json,
 ):
     """
     Function to calculate and display the regression of principal components against age, with different parameters
@@ -889,151 +1233,72 @@ def update_pca_scatter_plot_age(
 
     # Checks if it has not been triggered
     if ctx.triggered_id != "generate-scatter-plot-regression":
-        return no_update, no_update, no_update, no_update
+        return no_update, no_update, no_update, no_update, no_update
 
     # Check if the PCA data is not None
     if pca_df is None:
-        return no_update, no_update, no_update, no_update
-
-    # Truncate the PCA data to the selected bundle
-    pca_df_truncate = pca_df[pca_df["Bundle"] == bundle_value]
+        return no_update, no_update, no_update, no_update, no_update
 
+    # The regression of the selected bundle, with the typed, default or cross-validated knots
+    try:
+        spline_reg, cv_df = age_regression_from_inputs(
+            pca_df,
+            y_axis_value,
+            bundle_value,
+            sex_value,
+            knots_value,
+            enable_knots,
+            select_knots_cv,
+        )
+    except ValueError:
+        return no_update, no_update, False, True, no_update
     # Check if the truncated PCA data is empty
-    if len(pca_df_truncate) == 0:
-        return no_update, no_update, no_update, no_update
-
-    # Convert the Age_Group column to a categorical column, and apply the get_age_group_label function
-    pca_df_truncate.loc[:, "Age_Group"] = (
-        pca_df_truncate["Age_Group"]
-        .astype("category")
-        .apply(auxiliary_functions.get_age_group_label)
-    )
-
-    # Check if the knots are enabled
-    if enable_knots:
-        # Check if the knots are valid, based on the available age values
-        try:
-            knots_list = [int(knot) for knot in knots_value.split(",")]
-        except Exception as e:
-            return no_update, no_update, False, True
-        knots_list = sorted(knots_list)
-        min_age = pca_df["Age"].min()
-        max_age = pca_df["Age"].max()
-        # if the knots are not within the range of the age values, return an error
-        if knots_list[0] < min_age or knots_list[-1] > max_age:
-            return no_update, no_update, False, True
+    if spline_reg is None:
+        return no_update, no_update, no_update, no_update, no_update
 
-    # If we plot the regression with different plots, divided by sex
-    if sex_value == "Divided by Sex Different Plot":
-        spline_reg = principal_components_age_corr_regression_viz.SplineRegression(
-            dataframe=pca_df_truncate,
-            response_var=y_axis_value,
-            predictor_var="Age",
-            bundle_var=bundle_value,
-            degree=3,
-            knots=knots_list if enable_knots else None,
-            method="GLM",
-            by_variable="Sex",
-            plots="Different Plot",
-        )
-    # If we plot the regression with the same plot, divided by sex
-    elif sex_value == "Divided by Sex Same Plot":
-        spline_reg = principal_components_age_corr_regression_viz.SplineRegression(
-            dataframe=pca_df_truncate,
-            response_var=y_axis_value,
-            predictor_var="Age",
-            bundle_var=bundle_value,
-            knots=knots_list if enable_knots else None,
-            degree=3,
-            method="GLM",
-            by_variable="Sex",
-            plots="Same Plot",
-        )
-    # If we plot the regression with all the data
-    else:
-        spline_reg = principal_components_age_corr_regression_viz.SplineRegression(
-            dataframe=pca_df_truncate,
-            response_var=y_axis_value,
-            predictor_var="Age",
-            bundle_var=bundle_value,
-            knots=knots_list if enable_knots else None,
-            degree=3,
-            method="GLM",
+    knots_cv_fig = no_update
+    if cv_df is not None:
+        knots_cv_fig = (
+            principal_components_age_corr_regression_viz.plot_knot_selection_cv(
+                cv_df, y_axis_value, spline_reg.knots, spline_reg.degree
+            )
         )
-    # print(spline_reg.fit_model())
-    spline_reg.fit_model()
-    # Get the plots for the regression
-    figs = spline_reg.plot(
-        color_column=color_value,
-        hover_data=["Patient", "Patient_ID", "Bundle", "Age_Group", "Sex"],
-    )
-    # Get the model outputs for the regression
-    models_dict_current = spline_reg.fit_model_to_df()
-
-    # The idea here is to generate a random key for each plot generated, and store the model outputs in a dictionary, with the random key as the key
-    # The random key is used to identify the plot and the model outputs
-    # The model outputs are stored in a dictionary, which is then stored Serialised as a JSON object
-    # This JSON object is then stored in the data store, and is used to retrieve the model outputs when the user wants to download the statistics
-    # The random key is also used to identify the plot when the user wants to remove the plot
-    # By removing the plot, the model outputs are also removed from the dictionary
-    # The dictionary is then stored in the data store again, with the updated model outputs
-
-    # Load the previous model outputs
+
+    # Fit the regression, get the plots and the model outputs, from the cache if the same regression was generated before
     try:
-        models_dict_previous = auxiliary_functions.json_to_dataframes(
-            data_store_scatter_plot_output_json
+        figs, models_dict_current = regression_cache.fit_and_plot(
+            spline_reg,
+            color_column=color_value,
+            hover_data=["Patient", "Patient_ID", "Bundle", "Age_Group", "Sex"],
         )
-    except:
-        # If they don't exist, create an empty dictionary
-        models_dict_previous = {}
-
-    # Create a list to store the random keys
+    except ValueError as error:
+        # The typed knots fall outside the age range of one of the sexes
+        print("Invalid knots:", error)
+        return no_update, no_update, False, True, knots_cv_fig
+
+    # Every plot gets a unique key, its model outputs are stored server side under this key (see regression_registry.py)
+    # The key identifies the plot when the user wants to remove it or download its statistics
+    # Only the list of keys is kept in the browser, in the same order as the plots, so adding, removing
+    # or downloading the outputs of a plot does not (de)serialize the outputs of the other plots
     rand_keys = []
 
-    # If we plot the regression with same plot, divided by sex, we need to store the model outputs for
-    # two different plots, so we need to store the model outputs for each plot in the dictionary
-    # But we need to store them with the same random key, so that they can be identified as the same plot
-    # Basically, the random key identifies a dictionary containing the two model outputs for the same plot
-    # This way, when we delete the plot, we can delete both model outputs
-    # The random key is also referring to the same plot, so that the plot can be deleted
-    # We have a 1-to-2 mapping between the random key and the model outputs
-    # And a 1-to-1 mapping between the random key and the plot
+    # If we plot the regression with same plot, divided by sex, the model outputs of both levels belong to the same plot
+    # so they are stored under the same key, with the level in the name of the tables
+    # We have a 1-to-2 mapping between the key and the model outputs
+    # And a 1-to-1 mapping between the key and the plot
     if sex_value == "Divided by Sex Same Plot":
-        rand = random.randint(0, 100000)
-        # Ensure the random number is unique
-        while rand in models_dict_previous:
-            rand = random.randint(0, 100000)
         model_outputs = {}
         for key, model_output in models_dict_current.items():
             model_output[f"table_1_{key}"] = model_output.pop("table_1")
             model_output[f"table_2_{key}"] = model_output.pop("table_2")
             model_outputs.update(model_output)
+        rand_keys.append(regression_registry.add_outputs(model_outputs))
 
-        # Append the current model output to the previous dictionary with a new random key
-        models_dict_previous[rand] = model_outputs
-        # Store the random key for use in the following loop
-        rand_keys.append(rand)
-
-    # If we plot the regression with different plots, the model outputs are stored in the dictionary with different random keys
-    # The same complex logic is not needed here, as the model outputs are stored in the dictionary with different random keys
-    # And we can identify the plots by the random keys, and delete the model outputs by the random keys
-    # We have a 1-to-1 mapping between the random keys and the plots
+    # If we plot the regression with different plots, the model outputs of each plot are stored under their own key
+    # We have a 1-to-1 mapping between the keys and the plots
     else:
-        # Loop through each model's output in models_dict_current
         for _, model_output in models_dict_current.items():
-            # Generate a unique random number to use as a new key
-            rand = random.randint(0, 100000)
-
-            # Ensure the random number is unique
-            while rand in models_dict_previous:
-                rand = random.randint(0, 100000)
-
-            # Append the current model output to the previous dictionary with a new random key
-            models_dict_previous[rand] = model_output
-            # Store the random key for use in the following loop
-            rand_keys.append(rand)
-
-    print(models_dict_previous)
+            rand_keys.append(regression_registry.add_outputs(model_output))
 
     # Create a Patch object to store the children
     # THis is used so we do not update the whole children list, but only the children that have been updated
@@ -1095,173 +1360,489 @@ def update_pca_scatter_plot_age(
         )
         # Append the plot to the Patch object
         patched_children.append(fig_with_button)
+    patched_keys = Patch()
+    patched_keys.extend(rand_keys)
     time_end = datetime.datetime.now()
     print("Time to generate regression plots:", time_end - time_now)
 
     return [
         patched_children,  # Return the Patch object with the children
-        auxiliary_functions.dataframes_to_json(
-            models_dict_previous
-        ),  # Store the model outputs in the data store
+        patched_keys,  # Append the keys of the new plots to the list of keys
         no_update,
         no_update,
+        knots_cv_fig,
     ]
 
 
 @app.callback(
     [
-        Output("graph-pca-scatter-plot-age-div", "children"),
-        Output("store-pca-scatter-plot-output", "data", allow_duplicate=True),
-    ],
-    [Input({"type": "remove-button-", "index": ALL}, "n_clicks")],
-    [
-        State({"type": "remove-button-", "index": ALL}, "id"),
-        State("graph-pca-scatter-plot-age-div", "children"),
-        State("store-pca-scatter-plot-output", "data"),
-    ],
-    prevent_initial_call=True,
-)
-def remove_plot(n_clicks, id, children, data_store_scatter_plot_output_json):
-    """
-    This function is used to remove a plot from the PCA scatter plot regression tab
-    And also remove the model outputs from the data store, based on the random key, which is used to identify the plot and the model outputs
-    The random key is given in the id of the button that is clicked
-    """
-    # Load the model outputs from the data store
-    data_store_scatter_plot_output_df = auxiliary_functions.json_to_dataframes(
-        data_store_scatter_plot_output_json
-    )
-    # Get the callback context
-    ctx = callback_context
-
-    # For each button that was clicked
-    for item in ctx.triggered:
-        # Get the random key from the id of the button
-        prop_id_dict = eval(item["prop_id"].split(".")[0])
-        index = prop_id_dict["index"]
-        type_ = prop_id_dict["type"]
-        value = item["value"]
-    # If the type of the button is remove-button- and the value is not 0 (the button was clicked)
-    if type_ == "remove-button-" and value != 0:
-        # Loop through the children
-        for i, child in enumerate(children):
-            # Get the random key of the child
-            prop_id_dict_child = auxiliary_functions.find_key_in_nested_dict(
-                child, "index"
-            )
-            if (
-                prop_id_dict_child == index
-            ):  # If the random key of the child is the same as the random key of the button
-                if (
-                    data_store_scatter_plot_output_df
-                    and str(index) in data_store_scatter_plot_output_df
-                ):
-                    del data_store_scatter_plot_output_df[
-                        str(index)
-                    ]  # Remove the model outputs from the dictionary
-                # Remove the child from the children
-                children.pop(i)
-                return [
-                    children,  # Return the updated children
-                    auxiliary_functions.dataframes_to_json(
-                        data_store_scatter_plot_output_df
-                    ),  # Return the updated model outputs
-                ]
-    return no_update, no_update
-
-
-@app.callback(
-    Output({"type": "download-stats-output-", "index": MATCH}, "data"),
-    [
-        Input({"type": "download-stats-button-", "index": MATCH}, "n_clicks"),
-        Input({"type": "download-stats-button-", "index": MATCH}, "id"),
+        Output("table-all-bundles-regression-r2", "data"),
+        Output("table-all-bundles-regression-r2", "columns"),
+        Output("scatter-plot-knots-input", "valid", allow_duplicate=True),
+        Output("scatter-plot-knots-input", "invalid", allow_duplicate=True),
     ],
     [
-        State("store-pca-scatter-plot-output", "data"),
+        Input("button-fit-all-bundles-regression", "n_clicks"),
+        State("scatter-plot-sex-dropdown", "value"),
+        State("scatter-plot-knots-input", "value"),
+        State("scatter-plot-knots", "value"),
+        State("pca-data-store", "data"),
     ],
     prevent_initial_call=True,
 )
-def download_file_pca_scatter_plot_age_output(
-    n_clicks, index_dict, data_store_scatter_plot_output_json
-):
+def fit_all_bundles_regression(n_clicks, sex_value, knots_value, enable_knots, pca_df):
     """
-    Function to download the statistics for the PCA scatter plot regression
-    Based on the same concept as the remove plot function, the random key is used to identify the model outputs
+    Fits the spline regression of every principal component against age for every bundle at once,
+    and displays the R2 of each bundle and component
     """
+    if pca_df is None:
+        return no_update, no_update, no_update, no_update
 
-    # If there is nothing to download, return no_update
-    if data_store_scatter_plot_output_json is None:
-        return no_update
+    time_now = datetime.datetime.now()
+    knots_list = None
+    # Same validation of the knots as for the scatter plot
+    if enable_knots:
+        try:
+            knots_list = sorted(int(knot) for knot in (knots_value or "").split(","))
+        except ValueError:
+            return no_update, no_update, False, True
+        if knots_list[0] < pca_df["Age"].min() or knots_list[-1] > pca_df["Age"].max():
+            return no_update, no_update, False, True
 
-    # Get the model outputs from the data store
-    data_store_scatter_plot_output_dfs = auxiliary_functions.json_to_dataframes(
-        data_store_scatter_plot_output_json
+    pc_columns = [column for column in pca_df.columns if column.startswith("PC")]
+    spline_reg = principal_components_age_corr_regression_viz.BatchedSplineRegression(
+        dataframe=pca_df,
+        response_vars=pc_columns,
+        predictor_var="Age",
+        bundle_var="Bundle",
+        degree=3,
+        knots=knots_list,
+        by_variable=(
+            "Sex"
+            if sex_value
+            in ["Divided by Sex Different Plot", "Divided by Sex Same Plot"]
+            else None
+        ),
     )
-
-    print(data_store_scatter_plot_output_dfs)
-    print(index_dict)
-
-    # Get the model outputs for the random key
-    data_store_scatter_plot_output_df = data_store_scatter_plot_output_dfs.pop(
-        str(index_dict["index"])
+    try:
+        spline_reg.fit_model()
+    except ValueError as error:
+        # The typed knots fall outside the age range of one of the bundles or sexes
+        print("Invalid knots:", error)
+        return no_update, no_update, False, True
+    r2_df = auxiliary_functions.truncate_floats_in_df(spline_reg.r2_table())
+    time_end = datetime.datetime.now()
+    print("Time to fit the regression of all bundles:", time_end - time_now)
+    return (
+        r2_df.to_dict("records"),
+        [{"name": column, "id": column} for column in r2_df.columns],
+        no_update,
+        no_update,
     )
 
-    # Create a BytesIO object to store the Excel file
-    output = io.BytesIO()
-    # Open the Excel writer
-    writer = pd.ExcelWriter(output, engine="xlsxwriter")
-
-    # Write the model outputs to the Excel file
-    for key, df in data_store_scatter_plot_output_df.items():
-        if key.startswith(
-            "table_"
-        ):  # This is used in case there are multiple tables for the same plot
-            df.to_excel(writer, sheet_name=key, index=True)
-
-    # Close the writer
-    writer.close()
-    # Seek to the beginning of the BytesIO object
-    data = output.getvalue()
-
-    # Return the Excel file
-    return dcc.send_bytes(data, "mydf.xlsx")
-
 
 @app.callback(
     [
-        Output("offcanvas-patient-selector", "is_open"),
-        Output("offcanvas-3D-bundle-visualization", "is_open"),
-    ],
-    [
-        Input("open-offcanvas-patient-selector", "n_clicks"),
-        Input("open-offcanvas-3D-bundle-visualization", "n_clicks"),
+        Output("graph-pca-scatter-plot-age-div", "children", allow_duplicate=True),
+        Output("store-pca-scatter-plot-output", "data", allow_duplicate=True),
     ],
-    [
-        State("offcanvas-patient-selector", "is_open"),
-        State("offcanvas-3D-bundle-visualization", "is_open"),
+    [Input("button-permutation-test", "n_clicks")],
+    [State("pca-data-store", "data")],
+    background=True,
+    prevent_initial_call=True,
+    running=[
+        (Output("button-permutation-test", "disabled"), True, False),
     ],
 )
-def toggle_collapse(
-    n_patient_selector,
-    n_3d_bundle,
-    is_open_patient_selector,
-    is_open_3d_bundle,
-):
+def permutation_test_all_bundles(n_clicks, pca_df):
     """
-    Toggle the offcanvas for the patient selector and the 3D bundle visualization
+    Permutation test of the age and sex effects on every PC of every bundle, with family-wise error correction
+    The results are added to the regression outputs like a plot, so they can be removed and downloaded as an Excel file
     """
-    # Gets callback context
-    ctx = callback_context
-
-    # Checks if it has not been triggered
-    if not ctx.triggered:
+    if pca_df is None:
         return no_update, no_update
-    # Check if the offcanvas for the patient selector was triggered
-    if ctx.triggered_id == "open-offcanvas-patient-selector":
-        return not is_open_patient_selector, no_update
-    # Check if the offcanvas for the 3D bundle visualization was triggered
-    if ctx.triggered_id == "open-offcanvas-3D-bundle-visualization":
-        return no_update, not is_open_3d_bundle
+    time_now = datetime.datetime.now()
+    pc_columns = [column for column in pca_df.columns if column.startswith("PC")]
+    results_df = permutation_testing.permutation_test(
+        pca_df, pc_columns, n_permutations=PERMUTATION_TEST_PERMUTATIONS
+    ).sort_values(["Effect", "P_Value_FWER", "F"], ascending=[True, True, False])
+    results_df = results_df.reset_index(drop=True)
+
+    # Same registry of the model outputs as the scatter plots
+    rand = regression_registry.add_outputs({"table_permutation_test": results_df})
+
+    table_df = auxiliary_functions.truncate_floats_in_df(results_df.copy())
+    patched_children = Patch()
+    patched_children.append(
+        html.Div(
+            [
+                dbc.Row(
+                    [
+                        dbc.Col(
+                            [
+                                dbc.Button(
+                                    "Remove",
+                                    id={"type": "remove-button-", "index": rand},
+                                    n_clicks=0,
+                                    style={"marginTop": "40px", "width": "130%"},
+                                ),
+                                dbc.Button(
+                                    "Download Stats",
+                                    id={
+                                        "type": "download-stats-button-",
+                                        "index": rand,
+                                    },
+                                    n_clicks=0,
+                                    style={"marginTop": "10px", "width": "130%"},
+                                ),
+                                dcc.Download(
+                                    id={"type": "download-stats-output-", "index": rand}
+                                ),
+                            ],
+                            width=1,
+                        ),
+                        dbc.Col(
+                            [
+                                html.H6(
+                                    f"Permutation test of the age and sex effects on all bundles ({PERMUTATION_TEST_PERMUTATIONS} permutations, max-statistic FWER)",
+                                    className="mt-4",
+                                ),
+                                dash_table.DataTable(
+                                    data=table_df.to_dict("records"),
+                                    columns=[
+                                        {"name": column, "id": column}
+                                        for column in table_df.columns
+                                    ],
+                                    style_table={"overflowX": "scroll"},
+                                    page_size=10,
+                                    sort_action="native",
+                                    filter_action="native",
+                                ),
+                            ],
+                            width=11,
+                        ),
+                    ],
+                ),
+            ]
+        )
+    )
+    time_end = datetime.datetime.now()
+    print("Time to run the permutation test:", time_end - time_now)
+    patched_keys = Patch()
+    patched_keys.append(rand)
+    return patched_children, patched_keys
+
+
+@app.callback(
+    Output("bootstrap-bands-info", "children"),
+    [Input("button-bootstrap-bands", "n_clicks")],
+    [
+        State("scatter-plot-y-axis-dropdown", "value"),
+        State("scatter-plot-color-dropdown", "value"),
+        State("scatter-plot-bundle-dropdown", "value"),
+        State("scatter-plot-sex-dropdown", "value"),
+        State("scatter-plot-knots-input", "value"),
+        State("scatter-plot-knots", "value"),
+        State("scatter-plot-knots-cv", "value"),
+        State("input-bootstrap-resamples", "value"),
+        State("pca-data-store", "data"),
+    ],
+    background=True,
+    prevent_initial_call=True,
+    running=[
+        (Output("button-bootstrap-bands", "disabled"), True, False),
+    ],
+    progress=[Output("bootstrap-bands-div", "children")],
+)
+def bootstrap_bands(
+    set_progress,
+    n_clicks,
+    y_axis_value,
+    color_value,
+    bundle_value,
+    sex_value,
+    knots_value,
+    enable_knots,
+    select_knots_cv,
+    n_resamples,
+    pca_df,
+):
+    """
+    Subject-level bootstrap bands of the age regression of the selected bundle and PC, with the same knots, degree
+    and split by sex as the regression plot. The bands are drawn on the figures of the regression plot, which are
+    updated every time a batch of resamples finishes, so the bands appear while the rest is running
+    """
+    if pca_df is None or bundle_value is None or y_axis_value is None:
+        return no_update
+    time_now = datetime.datetime.now()
+    try:
+        spline_reg, _ = age_regression_from_inputs(
+            pca_df,
+            y_axis_value,
+            bundle_value,
+            sex_value,
+            knots_value,
+            enable_knots,
+            select_knots_cv,
+        )
+        if spline_reg is None:
+            return no_update
+        spline_reg.fit_model()
+    except ValueError as error:
+        return f"Invalid knots: {error}"
+    figs = spline_reg.plot(
+        color_column=color_value,
+        hover_data=["Patient", "Patient_ID", "Bundle", "Age_Group", "Sex"],
+    )
+    n_resamples = int(n_resamples) if n_resamples else BOOTSTRAP_RESAMPLES
+    n_total = n_resamples * len(spline_reg.models)
+    for n_done, bands in spline_reg.bootstrap_bands(n_resamples=n_resamples):
+        set_progress(
+            [
+                [
+                    dcc.Graph(figure=fig, style={"height": "600px"})
+                    for fig in principal_components_age_corr_regression_viz.add_bootstrap_bands(
+                        spline_reg, figs, bands, n_done, n_total
+                    )
+                ]
+            ]
+        )
+    time_end = datetime.datetime.now()
+    return f"{n_total} resamples in {(time_end - time_now).total_seconds():.2f} s"
+
+
+@app.callback(
+    [
+        Output("normative-atlas-store", "data"),
+        Output("normative-measure-dropdown", "options"),
+        Output("normative-subject-dropdown", "options"),
+        Output("normative-atlas-info", "children"),
+    ],
+    [Input("button-build-normative-atlas", "n_clicks")],
+    [State("patient-list-store", "data")],
+    background=True,
+    prevent_initial_call=True,
+    running=[
+        (Output("button-build-normative-atlas", "disabled"), True, False),
+    ],
+)
+def build_normative_atlas(n_clicks, all_patients_df):
+    """
+    Fits the normative centile curves of every bundle and measure of the uploaded cohort, split by sex,
+    in parallel worker processes. The atlas does not depend on the selection, it is cached by the content of the cohort
+    so it is only fitted once per dataset. The curves are kept server side, so showing a curve or z-scoring a subject does not refit anything
+    """
+    if all_patients_df is None:
+        return no_update, no_update, no_update, no_update
+    time_now = datetime.datetime.now()
+    atlas_df = regression_cache.build_normative_atlas(all_patients_df)
+    time_end = datetime.datetime.now()
+    print("Time to build the normative atlas:", time_end - time_now)
+    return (
+        Serverside(atlas_df),
+        list(atlas_df["Measure"].cat.categories),
+        sorted(all_patients_df["Patient_ID"].unique()),
+        f"Atlas of the uploaded cohort: {len(all_patients_df)} rows, "
+        f"{atlas_df.groupby(['Bundle', 'Sex', 'Measure'], observed=True).ngroups} curves",
+    )
+
+
+@app.callback(
+    [
+        Output("normative-atlas-store", "data", allow_duplicate=True),
+        Output("normative-measure-dropdown", "options", allow_duplicate=True),
+        Output("normative-subject-dropdown", "options", allow_duplicate=True),
+        Output("normative-atlas-info", "children", allow_duplicate=True),
+    ],
+    [Input("upload-normative-atlas", "contents")],
+    [
+        State("upload-normative-atlas", "filename"),
+        State("patient-list-store", "data"),
+    ],
+    prevent_initial_call=True,
+)
+def load_normative_atlas(contents, filename, all_patients_df):
+    """
+    Loads an atlas built offline (python normative_atlas.py data.mat --output atlas.csv), instead of fitting it
+    """
+    if contents is None:
+        return no_update, no_update, no_update, no_update
+    try:
+        _, content_string = contents.split(",")
+        atlas_df = normative_atlas.load_normative_atlas(
+            io.BytesIO(base64.b64decode(content_string))
+        )
+    except Exception as e:
+        return no_update, no_update, no_update, f"Failed to load {filename}: {e}"
+    subject_options = (
+        sorted(all_patients_df["Patient_ID"].unique())
+        if all_patients_df is not None
+        else no_update
+    )
+    return (
+        Serverside(atlas_df),
+        list(atlas_df["Measure"].cat.categories),
+        subject_options,
+        f"Loaded {filename}: "
+        f"{atlas_df.groupby(['Bundle', 'Sex', 'Measure'], observed=True).ngroups} curves",
+    )
+
+
+@app.callback(
+    [
+        Output("graph-normative-centiles", "figure"),
+        Output("table-normative-z-scores", "data"),
+        Output("table-normative-z-scores", "columns"),
+    ],
+    [
+        Input("normative-atlas-store", "data"),
+        Input("scatter-plot-bundle-dropdown", "value"),
+        Input("normative-measure-dropdown", "value"),
+        Input("normative-subject-dropdown", "value"),
+    ],
+    [State("patient-list-store", "data")],
+    prevent_initial_call=True,
+)
+def show_normative_centiles(
+    atlas_df, bundle_value, measure_value, subject_value, all_patients_df
+):
+    """
+    Shows the centile curves of the selected bundle and measure, and the z-scores of the selected subject
+    against the atlas, for all its bundles and measures of the uploaded cohort
+    The PCs of the current selection are not z-scored, they are not the projection the PC curves of an atlas were fitted on
+    """
+    if atlas_df is None or bundle_value is None or measure_value is None:
+        return no_update, no_update, no_update
+
+    subject_df = None
+    z_df = None
+    z_data = []
+    z_columns = no_update
+    if subject_value is not None and all_patients_df is not None:
+        subject_df = all_patients_df[all_patients_df["Patient_ID"] == subject_value]
+        z_df = normative_atlas.normative_z_scores(atlas_df, subject_df)
+        z_table_df = auxiliary_functions.truncate_floats_in_df(
+            z_df[["Bundle", "Measure", "Value", "Z_Score", "Centile"]].copy()
+        )
+        z_data = z_table_df.to_dict("records")
+        z_columns = [{"name": column, "id": column} for column in z_table_df.columns]
+
+    fig = principal_components_age_corr_regression_viz.plot_normative_centiles(
+        atlas_df, bundle_value, measure_value, subject_df, z_df
+    )
+    return fig, z_data, z_columns
+
+
+@app.callback(
+    [
+        Output("graph-pca-scatter-plot-age-div", "children"),
+        Output("store-pca-scatter-plot-output", "data", allow_duplicate=True),
+    ],
+    [Input({"type": "remove-button-", "index": ALL}, "n_clicks")],
+    [State("store-pca-scatter-plot-output", "data")],
+    prevent_initial_call=True,
+)
+def remove_plot(n_clicks, plot_keys):
+    """
+    This function is used to remove a plot from the PCA scatter plot regression tab
+    And also remove the model outputs from the registry, based on the key, which is used to identify the plot and the model outputs
+    The key is given in the id of the button that is clicked
+    The keys are in the same order as the plots, so the plot is removed by its position, without sending the plots back
+    """
+    # Get the callback context
+    ctx = callback_context
+
+    # If the button was not clicked (the plot was just added), nothing to do
+    if ctx.triggered_id is None or not ctx.triggered[0]["value"]:
+        return no_update, no_update
+    key = ctx.triggered_id["index"]
+    if not plot_keys or key not in plot_keys:
+        return no_update, no_update
+
+    # Remove the model outputs from the registry
+    regression_registry.remove_outputs(key)
+    position = plot_keys.index(key)
+    patched_children = Patch()
+    del patched_children[position]
+    patched_keys = Patch()
+    del patched_keys[position]
+    return patched_children, patched_keys
+
+
+@app.callback(
+    Output({"type": "download-stats-output-", "index": MATCH}, "data"),
+    [
+        Input({"type": "download-stats-button-", "index": MATCH}, "n_clicks"),
+        Input({"type": "download-stats-button-", "index": MATCH}, "id"),
+    ],
+    prevent_initial_call=True,
+)
+def download_file_pca_scatter_plot_age_output(n_clicks, index_dict):
+    """
+    Function to download the statistics for the PCA scatter plot regression
+    Based on the same concept as the remove plot function, the key is used to fetch the model outputs from the registry
+    """
+    # Get the model outputs of the plot, if there is nothing to download, return no_update
+    model_outputs = regression_registry.get_outputs(index_dict["index"])
+    if not n_clicks or model_outputs is None:
+        return no_update
+
+    # Create a BytesIO object to store the Excel file
+    output = io.BytesIO()
+    # Open the Excel writer
+    writer = pd.ExcelWriter(output, engine="xlsxwriter")
+
+    # Write the model outputs to the Excel file
+    for key, df in model_outputs.items():
+        if key.startswith(
+            "table_"
+        ):  # This is used in case there are multiple tables for the same plot
+            df.to_excel(writer, sheet_name=key, index=True)
+
+    # Close the writer
+    writer.close()
+    # Seek to the beginning of the BytesIO object
+    data = output.getvalue()
+
+    # Return the Excel file
+    return dcc.send_bytes(data, "mydf.xlsx")
+
+
+@app.callback(
+    [
+        Output("offcanvas-patient-selector", "is_open"),
+        Output("offcanvas-3D-bundle-visualization", "is_open"),
+    ],
+    [
+        Input("open-offcanvas-patient-selector", "n_clicks"),
+        Input("open-offcanvas-3D-bundle-visualization", "n_clicks"),
+    ],
+    [
+        State("offcanvas-patient-selector", "is_open"),
+        State("offcanvas-3D-bundle-visualization", "is_open"),
+    ],
+)
+def toggle_collapse(
+    n_patient_selector,
+    n_3d_bundle,
+    is_open_patient_selector,
+    is_open_3d_bundle,
+):
+    """
+    Toggle the offcanvas for the patient selector and the 3D bundle visualization
+    """
+    # Gets callback context
+    ctx = callback_context
+
+    # Checks if it has not been triggered
+    if not ctx.triggered:
+        return no_update, no_update
+    # Check if the offcanvas for the patient selector was triggered
+    if ctx.triggered_id == "open-offcanvas-patient-selector":
+        return not is_open_patient_selector, no_update
+    # Check if the offcanvas for the 3D bundle visualization was triggered
+    if ctx.triggered_id == "open-offcanvas-3D-bundle-visualization":
+        return no_update, not is_open_3d_bundle
 
 
 @app.callback(
@@ -1294,6 +1875,21 @@ def update_age_area(selection_mode):
         return [{"display": "block"}, {"display": "block"}]
 
 
+@app.callback(
+    [Output("umap-area", "style"), Output("kernel-pca-area", "style")],
+    [Input("reduction-method", "value")],
+)
+def update_reduction_method_area(reduction_method):
+    """
+    This is used in the patient selector to display only the parameters of the selected dimensionality reduction method
+    """
+    if reduction_method == "umap":
+        return [{"display": "block"}, {"display": "none"}]
+    elif reduction_method == "kernel-pca":
+        return [{"display": "none"}, {"display": "block"}]
+    return [{"display": "none"}, {"display": "none"}]
+
+
 @app.callback(
     Output("scatter-plot-knots-collapse", "style"),
     [Input("scatter-plot-knots", "value")],
@@ -1430,7 +2026,9 @@ def check_nu_level(value, pattern):
     ],
     [Input("pca-data-store", "data")],
 )
-def outlier_dropdowns_update(pca_df):
+def outlier_dropdowns_update(
+    pca_df: Columns["Patient", "Patient_ID", "Bundle", "Sex", "Age", "Age_Group"],
+):
     """
     Update the dropdowns for the bundle and age group in the outlier detection tab, based on the PCA data
     """
@@ -1443,7 +2041,36 @@ def outlier_dropdowns_update(pca_df):
 
 
 @app.callback(
-    [Output("table-outlier-data", "data"), Output("outlier-points-store", "data")],
+    Output("table-patient-outlier-scores", "data"),
+    [
+        Input("pca-outlier-store", "data"),
+        Input("n_components_to_use_for_outlier", "value"),
+    ],
+    prevent_initial_call=True,
+)
+def patient_outlier_scores(pca_df, n_components):
+    """
+    Ranks the scans by their robust distances over all the bundles, runs automatically for every selection
+    """
+    # The outlier data is cleared while a progressive PCA preview is shown, so are the scores
+    if pca_df is None:
+        return []
+    # Use the selected number of components, within the components of the outlier PCA
+    n_pcs = len([column for column in pca_df.columns if column.startswith("PC")])
+    q = min(int(n_components) if n_components else PATIENT_SCORE_N_COMPONENTS, n_pcs)
+    patient_df = outlier_detection.patient_level_scores(
+        pca_df, q, alpha=PATIENT_SCORE_ALPHA
+    )
+    return auxiliary_functions.truncate_floats_in_df(patient_df).to_dict("records")
+
+
+@app.callback(
+    [
+        Output("table-outlier-data", "data"),
+        Output("outlier-points-store", "data"),
+        Output("mcd-fit-store", "data"),
+        Output("outlier-engine-info", "children"),
+    ],
     [Input("button-detect-outliers", "n_clicks")],
     [
         State("dropdown-bundle-outlier-detection", "value"),
@@ -1452,6 +2079,14 @@ def outlier_dropdowns_update(pca_df):
         State("input-significance-level", "value"),
         State("input-nu-level", "value"),
         State("n_components_to_use_for_outlier", "value"),
+        State("dropdown-threshold-method", "value"),
+        State("input-mcd-support-fraction", "value"),
+        State("mcd-subsample-switch", "value"),
+        State("mcd-fit-store", "data"),
+        State("outlier-atlas-store", "data"),
+        State("dropdown-outlier-engine", "value"),
+        State("compare-exact-ocsvm-switch", "value"),
+        State("outlier-projection-store", "data"),
     ],
     background=True,
     prevent_initial_call=True,
@@ -1467,26 +2102,84 @@ def outlier_generation(
     significance,
     nu,
     n_components,
+    threshold_method,
+    support_fraction,
+    mcd_subsample,
+    mcd_cache,
+    atlas,
+    engine,
+    compare_exact,
+    projection,
 ):
     """
     Function to generate the outliers based on the PCA data, and the parameters selected by the user
+    The robust MCD fits are cached server side, so changing only the significance or nu does not refit them
+    If an outlier atlas was built with the same data and parameters, the outliers of a bundle and age group are looked up
     """
     # If one of the inputs is None, return no_update
     if pca_df is None or significance is None or nu is None:
-        return no_update, no_update
+        return no_update, no_update, no_update, no_update
     print(n_components)
 
     # Truncate the PCA data to the selected bundle and age group
     pca_df_truncate = outlier_detection.pca_truncate_for_anomaly_detector(
         pca_df, bundle_value, age_group_value
     )
+    # Convert the support fraction to a float, empty uses the default of scikit-learn
+    support_fraction = float(support_fraction) / 100.0 if support_fraction else None
+    # The atlas is computed per bundle and age group, so it can only be used if both are selected
+    if (
+        atlas is not None
+        and bundle_value is not None
+        and age_group_value is not None
+        and atlas["key"]
+        == outlier_atlas.atlas_key(
+            pca_df,
+            n_components,
+            significance,
+            nu,
+            threshold_method,
+            engine,
+            support_fraction,
+            mcd_subsample,
+        )
+    ):
+        outlier_df = outlier_atlas.lookup_outliers(atlas["table"], pca_df_truncate)
+        if projection is not None:
+            outlier_df = outlier_detection.add_measure_contributions(
+                outlier_df, projection
+            )
+        return [
+            auxiliary_functions.truncate_floats_in_df(outlier_df).to_dict("records"),
+            Serverside(outlier_df),
+            no_update,
+            f"Engine: {OUTLIER_ENGINES[engine]}, looked up in the outlier atlas",
+        ]
+
     # Generate the outliers
-    outlier_df = outlier_detection.anomaly_detector_caller(
+    outlier_df, mcd_cache, engine_info = outlier_detection.anomaly_detector_caller(
         pca_df_truncate,
         int(n_components),  # Convert the n_components to an integer
         1 - (float(significance) / 100.0),  # Convert the significance to a float
         (float(nu) / 100.0),  # Convert the nu to a float
+        threshold_method,
+        mcd_cache,
+        support_fraction,
+        mcd_subsample,
+        engine,
+        compare_exact,
+    )
+    # Break the contributions of the components down to the original measures, through the outlier PCA loadings
+    if projection is not None:
+        outlier_df = outlier_detection.add_measure_contributions(outlier_df, projection)
+    # Summary of the engine, the agreement is only known if the exact OCSVM was fitted as well
+    engine_text = (
+        f"Engine: {OUTLIER_ENGINES[engine]}, fit time: {engine_info['fit_time']:.2f} s"
     )
+    if engine_info["agreement"] is not None:
+        engine_text += (
+            f", agreement with the exact OCSVM: {100 * engine_info['agreement']:.1f}%"
+        )
     return [
         auxiliary_functions.truncate_floats_in_df(outlier_df).to_dict(
             "records"
@@ -1494,9 +2187,318 @@ def outlier_generation(
         Serverside(
             outlier_df
         ),  # Return the outliers as a Serverside object for further use
+        Serverside(mcd_cache),
+        engine_text,
     ]
 
 
+@app.callback(
+    [
+        Output("outlier-atlas-store", "data"),
+        Output("button-export-outlier-atlas", "disabled"),
+    ],
+    [Input("button-build-outlier-atlas", "n_clicks")],
+    [
+        State("pca-outlier-store", "data"),
+        State("input-significance-level", "value"),
+        State("input-nu-level", "value"),
+        State("n_components_to_use_for_outlier", "value"),
+        State("dropdown-threshold-method", "value"),
+        State("dropdown-outlier-engine", "value"),
+        State("input-mcd-support-fraction", "value"),
+        State("mcd-subsample-switch", "value"),
+    ],
+    background=True,
+    prevent_initial_call=True,
+    running=[
+        (Output("button-build-outlier-atlas", "disabled"), True, False),
+        (Output("button-detect-outliers", "disabled"), True, False),
+    ],
+)
+def build_outlier_atlas(
+    n_clicks,
+    pca_df,
+    significance,
+    nu,
+    n_components,
+    threshold_method,
+    engine,
+    support_fraction,
+    mcd_subsample,
+):
+    """
+    Runs the outlier detection for every bundle and age group combination in parallel worker processes,
+    the flags are stored server side with a key of the data and parameters they were computed with
+    """
+    if pca_df is None or significance is None or nu is None or n_components is None:
+        return no_update, no_update
+
+    # Same MCD settings as the detector, empty support fraction uses the default of scikit-learn
+    support_fraction = float(support_fraction) / 100.0 if support_fraction else None
+    atlas_df = outlier_atlas.build_outlier_atlas(
+        pca_df,
+        int(n_components),
+        1 - (float(significance) / 100.0),
+        (float(nu) / 100.0),
+        threshold_method,
+        engine,
+        support_fraction,
+        mcd_subsample,
+    )
+    key = outlier_atlas.atlas_key(
+        pca_df,
+        n_components,
+        significance,
+        nu,
+        threshold_method,
+        engine,
+        support_fraction,
+        mcd_subsample,
+    )
+    return Serverside({"key": key, "table": atlas_df}), False
+
+
+@app.callback(
+    Output("download-outlier-atlas", "data"),
+    [Input("button-export-outlier-atlas", "n_clicks")],
+    [State("outlier-atlas-store", "data")],
+    prevent_initial_call=True,
+)
+def export_outlier_atlas(n_clicks, atlas):
+    """
+    Exports the cohort-level QC report of the outlier atlas as an Excel file
+    """
+    if atlas is None:
+        return no_update
+    return dcc.send_bytes(
+        outlier_atlas.create_qc_report(atlas["table"]), "outlier_qc_report.xlsx"
+    )
+
+
+@app.callback(
+    [
+        Output("outlier-model-store", "data"),
+        Output("download-outlier-model", "data"),
+        Output("outlier-model-info", "children"),
+        Output("button-score-new-scans", "disabled"),
+    ],
+    [Input("button-save-outlier-model", "n_clicks")],
+    [
+        State("dropdown-bundle-outlier-detection", "value"),
+        State("dropdown-age-group-outlier-detection", "value"),
+        State("pca-outlier-store", "data"),
+        State("outlier-projection-store", "data"),
+        State("input-significance-level", "value"),
+        State("input-nu-level", "value"),
+        State("n_components_to_use_for_outlier", "value"),
+        State("dropdown-threshold-method", "value"),
+        State("dropdown-outlier-engine", "value"),
+        State("input-mcd-support-fraction", "value"),
+        State("mcd-subsample-switch", "value"),
+    ],
+    background=True,
+    prevent_initial_call=True,
+    running=[
+        (Output("button-save-outlier-model", "disabled"), True, False),
+    ],
+)
+def save_outlier_model(
+    n_clicks,
+    bundle_value,
+    age_group_value,
+    pca_df,
+    projection,
+    significance,
+    nu,
+    n_components,
+    threshold_method,
+    engine,
+    support_fraction,
+    mcd_subsample,
+):
+    """
+    Fits the outlier detector with the current parameters and saves it as a versioned artifact on the server,
+    the artifact is downloaded as well so it can be used by the command line scorer (outlier_model.py)
+    """
+    if (
+        pca_df is None
+        or projection is None
+        or significance is None
+        or nu is None
+        or n_components is None
+    ):
+        return no_update, no_update, no_update, no_update
+
+    try:
+        model, _ = outlier_model.fit_outlier_model(
+            pca_df,
+            projection,
+            int(n_components),
+            1 - (float(significance) / 100.0),
+            (float(nu) / 100.0),
+            threshold_method,
+            engine,
+            bundle_value,
+            age_group_value,
+            support_fraction=(
+                float(support_fraction) / 100.0 if support_fraction else None
+            ),
+            subsample=mcd_subsample,
+        )
+        path = outlier_model.save_outlier_model(model)
+    except Exception as e:
+        return no_update, no_update, f"Failed to save the outlier model: {e}", no_update
+    info = (
+        f"Saved {os.path.basename(path)}: {OUTLIER_ENGINES[engine]}, "
+        f"{model['n_reference']} reference scans, {int(n_components)} components"
+    )
+    return Serverside(model), dcc.send_file(path), info, False
+
+
+@app.callback(
+    [
+        Output("table-new-scan-scores", "data"),
+        Output("graph-2-dcc", "figure", allow_duplicate=True),
+        Output("outlier-model-info", "children", allow_duplicate=True),
+    ],
+    [Input("upload-new-scans", "contents")],
+    [
+        State("outlier-model-store", "data"),
+        State("kernel-pca-model-store", "data"),
+        State("pca-data-store", "data"),
+    ],
+    prevent_initial_call=True,
+)
+def score_new_scans(contents, model, kernel_pca_model, pca_df):
+    """
+    Scores the uploaded scans against the last saved outlier model, without refitting it
+    If the 2D scatter plot is a kernel PCA, the scans of its bundles are projected with the fitted landmark model
+    and added to the plot
+    """
+    if contents is None or model is None:
+        return no_update, no_update, no_update
+    # A malformed file, or a model of another format version, is reported instead of failing the callback
+    try:
+        new_scans_df = data_loading.transform_mat_to_df(
+            *data_loading.load_data(contents)
+        )
+        scores_df = outlier_model.score_new_scans(model, new_scans_df)
+
+        patched_figure = no_update
+        if kernel_pca_model is not None and pca_df is not None:
+            projected_df = dim_reduction_backend.transform_kernel_pca(
+                kernel_pca_model,
+                new_scans_df[new_scans_df["Bundle"].isin(pca_df["Bundle"].unique())],
+            )
+            if len(projected_df) > 0:
+                patched_figure = Patch()
+                patched_figure["data"].append(
+                    dim_reduction_viz.create_projected_scans_trace(projected_df)
+                )
+    except Exception as e:
+        return [], no_update, f"Failed to score the new scans: {e}"
+    return (
+        auxiliary_functions.truncate_floats_in_df(scores_df).to_dict("records"),
+        patched_figure,
+        f"{int(scores_df['Outlier'].sum())} of {len(scores_df)} new scans flagged",
+    )
+
+
+@app.callback(
+    [
+        Output("graph-outlier-sweep", "figure"),
+        Output("table-outlier-sweep-subjects", "data"),
+        Output("mcd-fit-store", "data", allow_duplicate=True),
+    ],
+    [Input("button-outlier-sweep", "n_clicks")],
+    [
+        State("dropdown-bundle-outlier-detection", "value"),
+        State("dropdown-age-group-outlier-detection", "value"),
+        State("pca-outlier-store", "data"),
+        State("input-sweep-significance-levels", "value"),
+        State("input-sweep-nu-levels", "value"),
+        State("input-sweep-n-components", "value"),
+        State("dropdown-threshold-method", "value"),
+        State("input-mcd-support-fraction", "value"),
+        State("mcd-subsample-switch", "value"),
+        State("mcd-fit-store", "data"),
+    ],
+    background=True,
+    prevent_initial_call=True,
+    running=[
+        (Output("button-outlier-sweep", "disabled"), True, False),
+    ],
+)
+def outlier_parameter_sweep(
+    n_clicks,
+    bundle_value,
+    age_group_value,
+    pca_df,
+    significance_values,
+    nu_values,
+    n_components_values,
+    threshold_method,
+    support_fraction,
+    mcd_subsample,
+    mcd_cache,
+):
+    """
+    Runs the outlier detection for a grid of significance levels, nu and numbers of components in one run,
+    shows the percentage of flagged rows per setting and the subjects ranked by how often they are flagged
+    """
+    if pca_df is None:
+        return no_update, no_update, no_update
+
+    pca_df_truncate = outlier_detection.pca_truncate_for_anomaly_detector(
+        pca_df, bundle_value, age_group_value
+    )
+    try:
+        # Keep the numbers of components available in the outlier PCA
+        n_pcs = len([column for column in pca_df.columns if column.startswith("PC")])
+        q_values = [
+            int(q)
+            for q in auxiliary_functions.parse_number_list(n_components_values)
+            if 1 <= q <= n_pcs
+        ]
+        alpha_values = [
+            1 - significance / 100.0
+            for significance in auxiliary_functions.parse_number_list(
+                significance_values
+            )
+        ]
+        nu_values = [
+            nu / 100.0 for nu in auxiliary_functions.parse_number_list(nu_values)
+        ]
+        if not q_values or not alpha_values or not nu_values:
+            raise ValueError("Every grid of the sweep needs at least one valid value")
+        sweep_df, flags_df, mcd_cache = outlier_detection.outlier_parameter_sweep(
+            pca_df_truncate,
+            q_values,
+            alpha_values,
+            nu_values,
+            threshold_method,
+            mcd_cache,
+            float(support_fraction) / 100.0 if support_fraction else None,
+            mcd_subsample,
+        )
+    except ValueError as e:
+        return dim_reduction_viz.create_placeholder_plot(str(e)), [], no_update
+
+    # Subjects ranked by the fraction of settings flagging them, the most stable outliers come first
+    subjects_df = pca_df_truncate[
+        ["Patient", "Patient_ID", "Bundle", "Age_Group"]
+    ].copy()
+    subjects_df["Flagged_Settings"] = 100.0 * flags_df.mean(axis=1)
+    subjects_df = subjects_df[subjects_df["Flagged_Settings"] > 0].sort_values(
+        "Flagged_Settings", ascending=False
+    )
+    return (
+        dim_reduction_viz.create_outlier_sweep_heatmap(sweep_df),
+        auxiliary_functions.truncate_floats_in_df(subjects_df).to_dict("records"),
+        Serverside(mcd_cache),
+    )
+
+
 @app.callback(
     [Output("graph-outlier-detection", "figure"), Output("graph-2-dcc", "figure")],
     [
@@ -1631,10 +2633,14 @@ def update_original_plot_with_outliers(load_outliers, _, fig_original):
     [Input("pca-outlier-store", "data")],
     prevent_initial_call=True,
 )
-def update_outlier_n_components_dropdown(pca_outlier_df):
+def update_outlier_n_components_dropdown(pca_outlier_df: SchemaOnly):
     """
     Update the dropdown for the number of components to use for outlier detection, based on the PCA data
     """
+    # The outlier data is cleared while a progressive PCA preview is shown
+    if pca_outlier_df is None:
+        return no_update, no_update, no_update
+
     # Filter column names
     pc_columns = [col for col in pca_outlier_df.columns if col.startswith("PC")]
 
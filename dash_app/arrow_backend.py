@@ -0,0 +1,261 @@
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from dash_extensions.enrich import (
+    FileSystemBackend,
+    ServersideBackend,
+    ServersideOutputTransform,
+)
+
+import cache_management
+import session_manager
+from constants import (
+    ARROW_BACKEND_DIR,
+    FILE_SYSTEM_BACKEND_DIR,
+    SERVERSIDE_HOT_CACHE_BYTES,
+    SESSION_MEMORY_BYTES,
+)
+
+# Marker of a value that is not in memory (None is a valid Serverside value)
+_MISSING = object()
+
+# The DataFrames read from the backend are shared: their buffers are memory-mapped (read-only), and the frames in memory
+# are handed to every session. The callbacks get copy-on-write views of them (see _view), which needs Copy-on-Write,
+# always enabled from pandas 3 and opt-in before
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+
+def _view(frame):
+    """
+    Returns a copy-on-write view of a shared DataFrame, writing to the view (e.g. df.loc[0, "PC1"] = 1) copies the
+    written columns first, so it neither fails on the read-only memory-mapped buffers nor changes the frame of the other sessions
+    Other values are returned as they are, they are pickled, so every read is a new object
+    """
+    if not isinstance(frame, pd.DataFrame):
+        return frame
+    view = frame.copy(deep=False)
+    # The view holds the shared frame, so its buffers always have another reference and pandas copies them on write
+    # (a frame read from the disk and not kept in memory would otherwise be written in place)
+    object.__setattr__(view, "_shared_frame", frame)
+    return view
+
+
+class Columns:
+    """
+    Annotation of a callback argument holding a Serverside DataFrame, only the given columns are read, e.g.
+        def callback(pca_df: Columns["Bundle", "Age_Group"]): ...
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+
+    def __class_getitem__(cls, columns):
+        return cls(columns if isinstance(columns, tuple) else (columns,))
+
+
+class SchemaOnly:
+    """
+    Annotation of a callback argument holding a Serverside DataFrame, only the columns and types are read (no rows), e.g.
+        def callback(pca_df: SchemaOnly): ...
+    """
+
+
+class ArrowBackend(ServersideBackend):
+    """
+    Serverside backend that stores DataFrames as uncompressed Arrow IPC (Feather v2) files, read back memory-mapped,
+    so the numeric columns are not copied and a subset of the columns can be read without touching the others.
+    Any other value is pickled by the file system backend, as before.
+    The DataFrames are stored once per content (see session_manager.content_key), the Serverside key only refers to it,
+    so identical datasets of several sessions share their file and their memory.
+    The deserialized values are kept in memory by the session manager, within the budgets of the sessions, so the
+    relayout, hover and click callbacks reading the same store over and over do not go back to the disk.
+    """
+
+    def __init__(
+        self,
+        cache_dir=ARROW_BACKEND_DIR,
+        fallback=None,
+        hot_cache_bytes=SERVERSIDE_HOT_CACHE_BYTES,
+        session_bytes=SESSION_MEMORY_BYTES,
+    ):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.fallback = (
+            fallback
+            if fallback is not None
+            else FileSystemBackend(cache_dir=FILE_SYSTEM_BACKEND_DIR, threshold=0)
+        )
+        # A budget of 0 disables the in-memory values
+        self.sessions = (
+            session_manager.SessionManager(hot_cache_bytes, session_bytes)
+            if hot_cache_bytes
+            else None
+        )
+
+    def _path(self, content):
+        return os.path.join(self.cache_dir, f"{content}.arrow")
+
+    def _ref_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.ref")
+
+    def _content(self, key):
+        """
+        Returns the content key a Serverside key refers to, or the key itself for values stored under their key
+        """
+        try:
+            with open(self._ref_path(key)) as file:
+                return file.read()
+        except FileNotFoundError:
+            return key
+
+    def _write_ref(self, key, content):
+        path = self._ref_path(key)
+        with open(f"{path}.tmp", "w") as file:
+            file.write(content)
+        os.replace(f"{path}.tmp", path)
+
+    def set(self, key, value):
+        session = session_manager.current_session()
+        if isinstance(value, pd.DataFrame):
+            try:
+                content = session_manager.content_key(value)
+                path = self._path(content)
+                if os.path.exists(path):
+                    # The same data is already stored, e.g. the same cohort uploaded in another session
+                    os.utime(path)
+                    cache_management.record("serverside", "deduplicated")
+                else:
+                    # Written to a temporary file first, so a reader never sees a partial file
+                    feather.write_feather(
+                        value, f"{path}.tmp", compression="uncompressed"
+                    )
+                    os.replace(f"{path}.tmp", path)
+                self._write_ref(key, content)
+                self._keep(session, key, content, value)
+                return True
+            except (pa.ArrowException, TypeError, ValueError):
+                # Frames Arrow cannot represent (e.g. mixed object columns) are pickled
+                pass
+        # A reference left by a previous value of the key would shadow the pickle
+        if os.path.exists(self._ref_path(key)):
+            os.remove(self._ref_path(key))
+        self._keep(session, key, key, value)
+        return self.fallback.set(key, value)
+
+    def _keep(self, session, key, content, value):
+        """
+        Keeps a value that was just set in memory, since it is likely read next
+        """
+        if self.sessions is None:
+            return
+        if content == key:
+            # The projections of the previous value of the key are stale
+            self.sessions.discard(lambda cache_key: cache_key[0] == key)
+        # A view is kept, so the frame returned by the callback can not change the value of the other sessions
+        self.sessions.put(session, (content, None, False), _view(value))
+
+    def get(self, key, ignore_expired=False, columns=None, schema_only=False):
+        """
+        Reads a value, DataFrames are read memory-mapped and the values already read are served from memory
+
+        Parameters:
+        - key (str): The Serverside key.
+        - ignore_expired (bool): Passed to the file system backend.
+        - columns (list): The columns to read, all by default. Columns that are not in the frame are ignored.
+        - schema_only (bool): Only read the columns and types, the frame has no rows.
+        """
+        if key is None:
+            return None
+        content = self._content(key)
+        value = self._lookup(key, content, ignore_expired, columns, schema_only)
+        # The reads are counted, and the files are touched so the cache management evicts the least recently read data
+        cache_management.record("serverside", "misses" if value is None else "hits")
+        if value is not None:
+            self._touch(key, content)
+        return _view(value)
+
+    def _lookup(self, key, content, ignore_expired, columns, schema_only):
+        if self.sessions is None:
+            return self._read(key, content, ignore_expired, columns, schema_only)
+
+        session = session_manager.current_session()
+        cache_key = (
+            content,
+            tuple(columns) if columns is not None else None,
+            schema_only,
+        )
+        if columns is not None or schema_only:
+            # A projection is cut from the full frame when it is already in memory
+            if isinstance(self.sessions.peek((content, None, False)), pd.DataFrame):
+                frame = self.sessions.get(session, (content, None, False))
+                if schema_only:
+                    return frame.iloc[:0]
+                return frame[[column for column in columns if column in frame.columns]]
+        value = self.sessions.get(session, cache_key, _MISSING)
+        if value is not _MISSING:
+            return value
+        value = self._read(key, content, ignore_expired, columns, schema_only)
+        # Missing or expired values are not kept, so they are looked up again
+        if value is not None:
+            self.sessions.put(session, cache_key, value)
+        return value
+
+    def _touch(self, key, content):
+        paths = [self._ref_path(key), self._path(content)]
+        if isinstance(self.fallback, FileSystemBackend):
+            paths.append(self.fallback._get_filename(key))
+        for path in paths:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                continue
+
+    def _read(self, key, content, ignore_expired, columns, schema_only):
+        path = self._path(content)
+        if not os.path.exists(path):
+            return self.fallback.get(key, ignore_expired=ignore_expired)
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            if schema_only:
+                return reader.schema.empty_table().to_pandas()
+            if columns is not None:
+                columns = [
+                    column for column in columns if column in reader.schema.names
+                ]
+            table = feather.read_table(source, columns=columns, memory_map=True)
+        return table.to_pandas(split_blocks=True)
+
+    def has(self, key):
+        return os.path.exists(self._path(self._content(key))) or self.fallback.has(key)
+
+    @property
+    def uid(self):
+        return f"{self.__class__.__name__}:{self.cache_dir}"
+
+
+class ArrowServersideOutputTransform(ServersideOutputTransform):
+    """
+    Serverside transform that passes the Columns and SchemaOnly annotations of the callback arguments to the Arrow backend
+    """
+
+    def _try_load(self, data, ann=None):
+        if (
+            not isinstance(data, str)
+            or not data.startswith(self.prefix)
+            or not (isinstance(ann, Columns) or ann is SchemaOnly)
+        ):
+            return super()._try_load(data, ann)
+        obj = json.loads(data[len(self.prefix) :])
+        backend = self._backend_registry[obj["backend_uid"]]
+        if not isinstance(backend, ArrowBackend):
+            return super()._try_load(data, ann)
+        return backend.get(
+            obj["key"],
+            ignore_expired=True,
+            columns=ann.columns if isinstance(ann, Columns) else None,
+            schema_only=ann is SchemaOnly,
+        )
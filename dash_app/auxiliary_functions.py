@@ -8,6 +8,8 @@ from dash import no_update
 import data_processing
 import dim_reduction_backend
 import dim_reduction_viz
+import quantile_sketches
+from constants import PROGRESSIVE_PCA_SAMPLE_ROWS
 
 
 def pack_params(*args):
@@ -34,9 +36,25 @@ def pack_params(*args):
         "modal_is_open": args[16],
         "close_button_clicks": args[17],
         "apply_button_clicks": args[18],
+        "reduction_method": args[19],
+        "umap_n_neighbors": args[20],
+        "umap_min_dist": args[21],
+        "umap_n_epochs": args[22],
+        "kpca_n_landmarks": args[23],
+        "kpca_gamma": args[24],
+        "progressive_pca": args[25],
+        "exact_quantile_transform": args[26],
     }
 
 
+def parse_number_list(text):
+    """
+    Parses a comma-separated list of numbers, e.g. the grids of the outlier parameter sweep
+    Returns the sorted unique values, and raises a ValueError if a value is not a number
+    """
+    return sorted({float(value) for value in str(text).split(",") if value.strip()})
+
+
 def make_patient_list(params):
     """
     Make a list of patients based on the selection mode
@@ -86,6 +104,18 @@ def checker_input_values(params):
         output += "Age values should be positive\n"
     if not params["sex_values"]:
         output += "Please select a sex\n"
+    if params["reduction_method"] == "umap":
+        if not params["umap_n_neighbors"] or params["umap_n_neighbors"] < 2:
+            output += "The number of UMAP neighbours should be at least 2\n"
+        if params["umap_min_dist"] is None or not 0 <= params["umap_min_dist"] <= 1:
+            output += "The UMAP minimum distance should be between 0 and 1\n"
+        if params["umap_n_epochs"] is not None and params["umap_n_epochs"] < 1:
+            output += "The number of UMAP epochs should be positive\n"
+    if params["reduction_method"] == "kernel-pca":
+        if not params["kpca_n_landmarks"] or params["kpca_n_landmarks"] < 2:
+            output += "The number of landmarks should be at least 2\n"
+        if params["kpca_gamma"] is not None and params["kpca_gamma"] <= 0:
+            output += "The kernel coefficient gamma should be positive\n"
     patient_list = make_patient_list(params)
     if not patient_list:
         output += "Please select at least 1 patient\n"
@@ -118,56 +148,163 @@ def run_filters(params, all_patients_df, patient_list):
     return df
 
 
-def run_pca(params, all_patients_df, patient_list):
+def create_scatter_figure(pca_df, params, axis_labels, title):
     """
-    Function to run PCA and return the figures and dataframes
+    Creates the 2D scatter plot of the reduced data, with the original measures in the hover data
+    Returns the figure and the list of hover data columns
     """
-    df = run_filters(params, all_patients_df, patient_list)
-
-    # Run PCA
-    pca_df, pca, components = dim_reduction_backend.run_pca_backend(
-        df, 2, normalize=True
-    )
-
-    # Run PCA for outlier detection, with different parameters (see dim_reduction_backend.py)
-    pca_outlier_df, pca_outlier, components = (
-        dim_reduction_backend.run_outlier_pca_backend(df)
-    )
-
-    # print(pca_df.head())
-    # print(df.head())
-
-    # Merge the PCA data with the original data, so we have all the information in one dataframe
-    concatenation_list = list(params["measure_values"])
-    concatenation_list.append("Patient_ID")
-    merged_df = pd.merge(df[concatenation_list], pca_df, on="Patient_ID", how="inner")
-    # print(merged_df.head())
+    # The PCA data already holds the measures of each row (aligned by position, see dim_reduction_backend.py),
+    # so no merge is needed and the plot has exactly one point per row of the selection
 
     # Create the hover data
     hover_data = ["Patient", "Patient_ID", "Bundle", "Age_Group", "Age", "Sex"]
     hover_data.extend(params["measure_values"])
     # print(hover_data)
 
-    # Create the figures
-
-    # 2D Scatter Plot with PCA
     fig = dim_reduction_viz.create_pca_scatter_plot(
-        merged_df,
+        pca_df,
         x="PC1",
         y="PC2",
         color="Bundle",
         hover_data=hover_data,
-        labels={
-            "PC1": "Principal Component 1",
-            "PC2": "Principal Component 2",
-        },
-        title="2D Scatter Plot with PCA",
+        labels=axis_labels,
+        title=title,
+    )
+    return fig, hover_data
+
+
+def run_pca_preview(params, all_patients_df, patient_list):
+    """
+    First stage of the progressive PCA: the PCA is fitted on a stratified subsample (per bundle),
+    all rows are projected on it and only the scatter plot and loadings are created, so the first plot is shown quickly
+    The exact PCA, and the slower plots, are computed afterwards by run_pca
+    Returns None if the selection is small enough for the exact PCA to be fast
+    """
+    df = run_filters(params, all_patients_df, patient_list)
+    if len(df) <= PROGRESSIVE_PCA_SAMPLE_ROWS:
+        return None
+
+    # Percentage of rows per bundle, such that about PROGRESSIVE_PCA_SAMPLE_ROWS rows are fitted
+    sample_percentage = 100.0 * PROGRESSIVE_PCA_SAMPLE_ROWS / len(df)
+    pca_df, pca, components = dim_reduction_backend.run_pca_backend(
+        df, 2, normalize=True, sample_percentage=sample_percentage
     )
 
-    # PCA Loadings Line Plot
+    fig, hover_data = create_scatter_figure(
+        pca_df,
+        params,
+        {"PC1": "Principal Component 1", "PC2": "Principal Component 2"},
+        "2D Scatter Plot with PCA (preview, refining in the background)",
+    )
     fig_pca_loadings = dim_reduction_viz.create_loadings_line_plot(
         pca, params["measure_values"]
     )
+    return fig, fig_pca_loadings, pca_df, hover_data
+
+
+def run_pca(
+    params,
+    all_patients_df,
+    patient_list,
+    knn_graph=None,
+    reference_pca_df=None,
+    cell_sketches=None,
+):
+    """
+    Function to run PCA (or the selected dimensionality reduction method) and return the figures and dataframes
+    knn_graph is the cached UMAP nearest-neighbour graph of the previous run, if any
+    reference_pca_df is the preview of the progressive PCA, if any, used to keep the signs of the components
+    cell_sketches are the quantile sketches computed at upload, used for the outlier normal-score transform
+    The fitted kernel PCA model is returned as well, so new rows can be projected without refitting
+    and so is the projection of the outlier PCA (scaler and PCA), used by the persisted outlier models
+    """
+    df = run_filters(params, all_patients_df, patient_list)
+    reduction_model = None
+
+    if params["reduction_method"] == "umap":
+        # Run UMAP, the graph is reused if the selection did not change
+        pca_df, _, knn_graph = dim_reduction_backend.run_umap_backend(
+            df,
+            2,
+            n_neighbors=int(params["umap_n_neighbors"]),
+            min_dist=float(params["umap_min_dist"]),
+            n_epochs=(
+                int(params["umap_n_epochs"]) if params["umap_n_epochs"] else None
+            ),
+            normalize=True,
+            knn_graph=knn_graph,
+        )
+        pca = None  # UMAP has no loadings nor explained variance
+        method_label = "UMAP"
+        axis_labels = {"PC1": "UMAP 1", "PC2": "UMAP 2"}
+    elif params["reduction_method"] == "kernel-pca":
+        # Run the Nystroem approximated kernel PCA
+        pca_df, reduction_model, components = (
+            dim_reduction_backend.run_kernel_pca_backend(
+                df,
+                2,
+                n_landmarks=int(params["kpca_n_landmarks"]),
+                gamma=float(params["kpca_gamma"]) if params["kpca_gamma"] else None,
+                normalize=True,
+            )
+        )
+        # The explained variance is the one in the approximated kernel feature space
+        pca = reduction_model.named_steps["pca"]
+        method_label = "Kernel PCA"
+        axis_labels = {
+            "PC1": "Kernel Principal Component 1",
+            "PC2": "Kernel Principal Component 2",
+        }
+    else:
+        # Run PCA
+        pca_df, pca, components = dim_reduction_backend.run_pca_backend(
+            df, 2, normalize=True
+        )
+        # Keep the orientation of the preview, so the refined plot does not mirror it
+        if reference_pca_df is not None:
+            dim_reduction_backend.align_component_signs(pca_df, pca, reference_pca_df)
+        method_label = "PCA"
+        axis_labels = {
+            "PC1": "Principal Component 1",
+            "PC2": "Principal Component 2",
+        }
+
+    # The quantile sketches only describe the selection if it keeps whole bundle x age group x sex cells,
+    # otherwise (or if requested) the exact quantile transform is fitted on the selection
+    if (
+        cell_sketches is None
+        or params["exact_quantile_transform"]
+        or not quantile_sketches.covers_whole_cells(df, cell_sketches)
+    ):
+        cell_sketches = None
+
+    # Run PCA for outlier detection, with different parameters (see dim_reduction_backend.py)
+    pca_outlier_df, pca_outlier, components, outlier_scaler = (
+        dim_reduction_backend.run_outlier_pca_backend(df, cell_sketches)
+    )
+    # Projection feeding the outlier detection, kept so a fitted outlier model can score new scans
+    outlier_projection = {
+        "measures": list(outlier_scaler.feature_names_in_),
+        "scaler": outlier_scaler,
+        "pca": pca_outlier,
+    }
+
+    # Create the figures
+
+    # 2D Scatter Plot with PCA (or UMAP)
+    fig, hover_data = create_scatter_figure(
+        pca_df, params, axis_labels, f"2D Scatter Plot with {method_label}"
+    )
+
+    # PCA Loadings Line Plot, the loadings are only defined for linear PCA
+    if params["reduction_method"] == "pca":
+        fig_pca_loadings = dim_reduction_viz.create_loadings_line_plot(
+            pca, params["measure_values"]
+        )
+    else:
+        fig_pca_loadings = dim_reduction_viz.create_placeholder_plot(
+            f"Loadings are not available for {method_label}"
+        )
 
     # Original Measures Plot Correlations and Correlation Heatmap
     fig_original_measures, fig_corr_heatmap = (
@@ -191,6 +328,9 @@ def run_pca(params, all_patients_df, patient_list):
         pca_df,
         pca_outlier_df,
         hover_data,
+        knn_graph,
+        reduction_model,
+        outlier_projection,
     )
 
 
@@ -201,46 +341,19 @@ def open_modal(params, output_checker=None, exception_message=None):
     """
     if exception_message:
         return (
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
+            *[no_update] * 15,
             not params["modal_is_open"],
             f"An error occurred while loading the scatter plot \n Usually this means that the created array through the selection, is empty \n {exception_message}",
         )
     elif output_checker:
         return (
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
+            *[no_update] * 15,
             not params["modal_is_open"],
             output_checker,
         )
     else:
         return (
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
-            no_update,
+            *[no_update] * 15,
             not params["modal_is_open"],
             no_update,
         )
@@ -0,0 +1,259 @@
+import os
+import threading
+import time
+
+import diskcache
+
+from constants import (
+    ARROW_BACKEND_DIR,
+    BACKGROUND_CACHE_EXPIRE,
+    CACHE_STATS_DIR,
+    CACHE_SWEEP_INTERVAL,
+    FILE_SYSTEM_BACKEND_DIR,
+    OUTLIER_MODEL_DIR,
+    OUTLIER_MODEL_EXPIRE,
+    OUTLIER_MODEL_SIZE_LIMIT,
+    SERVERSIDE_CACHE_EXPIRE,
+    SERVERSIDE_CACHE_SIZE_LIMIT,
+)
+
+# Hit, miss and eviction counters of the namespaces
+# A disk cache is used, so the counts of the server and the background processes add up
+counters = diskcache.Cache(CACHE_STATS_DIR)
+
+
+def record(namespace, event, count=1):
+    """
+    Adds count to a counter ("hits", "misses", "evictions" or "deduplicated") of a namespace
+    """
+    if count:
+        counters.incr(f"{namespace}:{event}", count)
+
+
+def counts(namespace):
+    """
+    Returns the hit, miss, eviction and deduplication counters of a namespace
+    """
+    return {
+        event: counters.get(f"{namespace}:{event}", 0)
+        for event in ["hits", "misses", "evictions", "deduplicated"]
+    }
+
+
+class ExpiringCache(diskcache.Cache):
+    """
+    Disk cache whose entries set without a TTL get default_expire, e.g. the results and progress of the background
+    callbacks, which Dash writes without any expiry. The expired entries are removed by Cache.expire in the sweeps.
+    Entries added with Cache.add (e.g. the signing secret of Dash) never expire.
+    """
+
+    def __init__(
+        self,
+        directory=None,
+        timeout=60,
+        disk=diskcache.Disk,
+        default_expire=None,
+        **settings,
+    ):
+        super().__init__(directory, timeout, disk, **settings)
+        self.default_expire = default_expire
+
+    def set(self, key, value, expire=None, read=False, tag=None, retry=False):
+        if expire is None:
+            expire = self.default_expire
+        return super().set(key, value, expire, read, tag, retry)
+
+    def __getstate__(self):
+        # The cache is pickled for the background processes, they need the default TTL too
+        return (*super().__getstate__(), self.default_expire)
+
+
+class DiskcacheNamespace:
+    """
+    Namespace stored in one or more disk caches (see managed_cache).
+    The entries expire with the TTL given when they are set, or, when the namespace has a TTL (expire), that long
+    after they were written, whoever wrote them. They are evicted least recently used first above the size limit of
+    their cache. The disk caches do not cull on set, the sweep does it, so the evictions are counted.
+    """
+
+    def __init__(self, name, expire=None):
+        self.name = name
+        self.expire = expire
+        self.caches = []
+
+    def size_limit(self):
+        return sum(cache.size_limit for cache in self.caches)
+
+    def volume(self):
+        return sum(cache.volume() for cache in self.caches)
+
+    def entries(self):
+        return sum(len(cache) for cache in self.caches)
+
+    def sweep(self):
+        """
+        Removes the expired entries, then the least recently used ones over the size limit
+        Returns the number of removed entries
+        """
+        evicted = sum(cache.expire() + cache.cull() for cache in self.caches)
+        record(self.name, "evictions", evicted)
+        return evicted
+
+    def stats(self):
+        # The hits and misses are kept by the disk caches themselves
+        cache_stats = [cache.stats() for cache in self.caches]
+        return {
+            "entries": self.entries(),
+            "bytes": self.volume(),
+            "size_limit": self.size_limit(),
+            "hits": sum(hits for hits, _ in cache_stats),
+            "misses": sum(misses for _, misses in cache_stats),
+            "evictions": counts(self.name)["evictions"],
+        }
+
+
+class DirectoryNamespace:
+    """
+    Namespace stored as one file per entry in one or more directories, e.g. the Serverside backends.
+    The modification time of a file is its last access (the backend touches it on every read), files that were
+    not read within the TTL are removed, then the least recently read ones over the size limit.
+    """
+
+    def __init__(self, name, directories, size_limit, expire):
+        self.name = name
+        self.directories = directories
+        self._size_limit = size_limit
+        self.expire = expire
+
+    def size_limit(self):
+        return self._size_limit
+
+    def _files(self):
+        """
+        Lists the (path, size, modification time) of the entries, without the bookkeeping files of the backends
+        and the files being written
+        """
+        files = []
+        for directory in self.directories:
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                if (
+                    not entry.is_file()
+                    or entry.name.startswith("__")
+                    or entry.name.endswith(".tmp")
+                ):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((entry.path, stat.st_size, stat.st_mtime))
+        return files
+
+    def volume(self):
+        return sum(size for _, size, _ in self._files())
+
+    def entries(self):
+        return len(self._files())
+
+    def sweep(self):
+        """
+        Removes the files not read within the TTL, then the least recently read ones over the size limit
+        Returns the number of removed files
+        """
+        files = sorted(self._files(), key=lambda file: file[2])
+        total = sum(size for _, size, _ in files)
+        now = time.time()
+        evicted = 0
+        for path, size, mtime in files:
+            if now - mtime <= self.expire and total <= self._size_limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Removed by a concurrent sweep
+                continue
+            total -= size
+            evicted += 1
+        record(self.name, "evictions", evicted)
+        return evicted
+
+    def stats(self):
+        files = self._files()
+        return {
+            "entries": len(files),
+            "bytes": sum(size for _, size, _ in files),
+            "size_limit": self._size_limit,
+            **counts(self.name),
+        }
+
+
+# The namespaces of the cache management, the disk caches are added by managed_cache
+namespaces = {
+    # Results and progress of the background callbacks
+    "background": DiskcacheNamespace("background", expire=BACKGROUND_CACHE_EXPIRE),
+    # Serverside data of the sessions, the hits and misses are recorded by the backend
+    "serverside": DirectoryNamespace(
+        "serverside",
+        [ARROW_BACKEND_DIR, FILE_SYSTEM_BACKEND_DIR],
+        SERVERSIDE_CACHE_SIZE_LIMIT,
+        SERVERSIDE_CACHE_EXPIRE,
+    ),
+    # Artefacts derived from the data, e.g. the memoized regressions and the regression outputs
+    "derived": DiskcacheNamespace("derived"),
+    # Saved outlier models, they are not read back by the app (it keeps its copy server side),
+    # so the modification time is the time of the save
+    "outlier_models": DirectoryNamespace(
+        "outlier_models",
+        [OUTLIER_MODEL_DIR],
+        OUTLIER_MODEL_SIZE_LIMIT,
+        OUTLIER_MODEL_EXPIRE,
+    ),
+}
+
+
+def managed_cache(directory, size_limit, namespace):
+    """
+    Creates a disk cache that is managed in the given namespace: least recently used eviction above size_limit,
+    hit and miss statistics, and culling left to the sweeps
+    """
+    cache = ExpiringCache(
+        directory,
+        default_expire=namespaces[namespace].expire,
+        size_limit=size_limit,
+        eviction_policy="least-recently-used",
+        cull_limit=0,
+        statistics=True,
+    )
+    namespaces[namespace].caches.append(cache)
+    return cache
+
+
+def stats():
+    """
+    Returns the statistics of every namespace: entries, bytes used and size limit, hits, misses and evictions
+    """
+    return {name: namespace.stats() for name, namespace in namespaces.items()}
+
+
+def sweep():
+    """
+    Sweeps every namespace, returns the number of removed entries per namespace
+    """
+    return {name: namespace.sweep() for name, namespace in namespaces.items()}
+
+
+def start_sweeper(interval=CACHE_SWEEP_INTERVAL):
+    """
+    Sweeps the namespaces every interval seconds in a daemon thread
+    """
+
+    def run():
+        while True:
+            sweep()
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="cache-sweeper", daemon=True)
+    thread.start()
+    return thread
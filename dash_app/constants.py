@@ -19,6 +19,21 @@ DEFAULT_MEASURES = [
 DEFAULT_AGE_GROUPS = [1, 2, 3, 4]
 DEFAULT_SEXES = [70, 77]
 
+# Default parameters for the UMAP embedding (number of epochs is left to UMAP when empty)
+DEFAULT_UMAP_N_NEIGHBORS = 15
+DEFAULT_UMAP_MIN_DIST = 0.1
+
+# Default number of landmarks for the Nystroem kernel PCA (gamma defaults to 1 / number of measures)
+DEFAULT_KPCA_N_LANDMARKS = 300
+
+# Progressive PCA: number of rows (stratified per bundle) the preview PCA is fitted on
+# Keeps the time to the first scatter plot within a fixed budget, regardless of the selection size
+PROGRESSIVE_PCA_SAMPLE_ROWS = 5000
+
+# Maximum number of points of the quantile sketches used by the outlier normal-score transform
+# The quantile error of the merged sketches is at most 1 / QUANTILE_SKETCH_SIZE (see quantile_sketches.py)
+QUANTILE_SKETCH_SIZE = 200
+
 # Base directory for the data (3D images, screenshots)
 BASE_DIR_FALLBACK = os.getenv("BASE_DIR_FALLBACK")
 BASE_DIR_FULL = os.getenv("BASE_DIR_FULL")
@@ -46,3 +61,90 @@ IMAGE_DOWNLOAD_OPTIONS = {
         "scale": 1,  # Multiply title/legend/axis/canvas sizes by this factor
     }
 }
+
+# Maximum number of robust MCD fits kept in the outlier detection cache (least recently used are evicted)
+MCD_CACHE_MAX_ENTRIES = 16
+# Number of rows the MCD is fitted on in the subsampled mode, for very large groups
+MCD_SUBSAMPLE_ROWS = 2000
+
+# Engines of the second stage of the outlier detection, see outlier_detection.fit_one_class_detector
+OUTLIER_ENGINES = {
+    "ocsvm": "Exact OCSVM",
+    "nystroem-sgd": "Nyström + SGD OCSVM",
+    "isolation-forest": "Isolation Forest",
+    "ensemble": "Ensemble (majority vote)",
+}
+# Number of Nystroem features of the approximated OCSVM
+NYSTROEM_OCSVM_COMPONENTS = 300
+
+# Directory and format version of the saved outlier models (see outlier_model.py)
+OUTLIER_MODEL_DIR = "./outlier_models"
+OUTLIER_MODEL_VERSION = 1
+# Budget and TTL of the saved outlier models, the TTL counts from the save (see cache_management.py)
+OUTLIER_MODEL_SIZE_LIMIT = 1024 * 1024 * 1024
+OUTLIER_MODEL_EXPIRE = 30 * 24 * 60 * 60
+
+# Maximum number of rows of the outlier parameter sweep, the kernel matrices grow with the square of the rows
+OUTLIER_SWEEP_MAX_ROWS = 5000
+
+# Patient-level outlier scores, computed automatically for every selection (see outlier_detection.patient_level_scores)
+PATIENT_SCORE_N_COMPONENTS = 5
+PATIENT_SCORE_ALPHA = 0.025
+
+# Normative centile atlas (see normative_atlas.py): centiles of the curves and step of the age grid, in years
+NORMATIVE_CENTILES = [5, 25, 50, 75, 95]
+NORMATIVE_AGE_STEP = 1.0
+
+# Cross-validated knot selection of the age splines (see principal_components_age_corr_regression_viz.select_knots_cv)
+KNOT_SELECTION_MAX_KNOTS = 6
+KNOT_SELECTION_DEGREES = [1, 2, 3]
+KNOT_SELECTION_FOLDS = 5
+# Latency budget in seconds, the candidates not evaluated within it are skipped
+KNOT_SELECTION_TIME_BUDGET = 2.0
+
+# Subject-level bootstrap of the age splines (see SplineRegression.bootstrap_bands), resamples in total and per batch
+BOOTSTRAP_RESAMPLES = 500
+BOOTSTRAP_BATCH_SIZE = 50
+
+# Permutation test of the age and sex effects (see permutation_testing.py), permutations in total and per batch
+PERMUTATION_TEST_PERMUTATIONS = 1000
+PERMUTATION_TEST_BATCH_SIZE = 100
+
+# Server-side registry of the regression outputs (see regression_registry.py), entries expire after a day
+REGRESSION_REGISTRY_DIR = "./regression_outputs"
+REGRESSION_REGISTRY_EXPIRE = 24 * 60 * 60
+REGRESSION_REGISTRY_SIZE_LIMIT = 256 * 1024 * 1024
+
+# Memoization of the age regression fits and figures (see regression_cache.py), least recently used entries are evicted over the budget
+REGRESSION_CACHE_DIR = "./regression_cache"
+REGRESSION_CACHE_SIZE_LIMIT = 256 * 1024 * 1024
+REGRESSION_CACHE_EXPIRE = 7 * 24 * 60 * 60
+
+# Directories of the Serverside backends (see arrow_backend.py): Arrow IPC files for DataFrames, pickles for everything else
+ARROW_BACKEND_DIR = "./arrow_backend"
+FILE_SYSTEM_BACKEND_DIR = "./file_system_backend"
+
+# Per-process in-memory LRU of the deserialized Serverside values (see hot_cache.py), least recently used entries are evicted over the budget
+# It is the global budget of the sessions (see session_manager.py)
+SERVERSIDE_HOT_CACHE_BYTES = 512 * 1024 * 1024
+
+# Cache management (see cache_management.py), budgets and TTLs of the namespaces
+# Results of the background callbacks, only needed until the browser fetches them, removed BACKGROUND_CACHE_EXPIRE seconds after they were written
+BACKGROUND_CACHE_DIR = "./cache"
+BACKGROUND_CACHE_SIZE_LIMIT = 1024 * 1024 * 1024
+BACKGROUND_CACHE_EXPIRE = 60 * 60
+# Serverside data of the sessions (arrow_backend and file_system_backend folders), the TTL counts from the last read
+SERVERSIDE_CACHE_SIZE_LIMIT = 8 * 1024 * 1024 * 1024
+SERVERSIDE_CACHE_EXPIRE = 7 * 24 * 60 * 60
+# Hit, miss and eviction counters, shared by the server and background processes
+CACHE_STATS_DIR = "./cache_stats"
+# Seconds between two sweeps (expired entries removed, then least recently used entries evicted over the budgets)
+CACHE_SWEEP_INTERVAL = 10 * 60
+# Environment variable holding the shared secret of the admin endpoints (/admin/...), sent in the X-Admin-Token header
+# The endpoints are disabled when it is not set
+ADMIN_TOKEN_ENV = "DIFFREDUCE_ADMIN_TOKEN"
+
+# Sessions (see session_manager.py): name of the session id cookie, and memory budget of the server-side data of one session
+# The global budget of all the sessions of a server process is SERVERSIDE_HOT_CACHE_BYTES
+SESSION_COOKIE = "diffreduce_session"
+SESSION_MEMORY_BYTES = 128 * 1024 * 1024
@@ -1,6 +1,12 @@
 import dash_bootstrap_components as dbc
 from dash import dcc, html
 
+from constants import (
+    DEFAULT_KPCA_N_LANDMARKS,
+    DEFAULT_UMAP_MIN_DIST,
+    DEFAULT_UMAP_N_NEIGHBORS,
+)
+
 offcanvas_patient_selector = dbc.Offcanvas(
     html.Div(
         [
@@ -213,6 +219,167 @@ offcanvas_patient_selector = dbc.Offcanvas(
                 className="dbc",
             ),
             html.Hr(),
+            dbc.Label(
+                "Select the dimensionality reduction method",
+                style={"font-weight": "bold"},
+            ),
+            dbc.RadioItems(
+                id="reduction-method",
+                options=[
+                    {
+                        "label": "PCA",
+                        "value": "pca",
+                    },
+                    {
+                        "label": "Kernel PCA (Nystroem)",
+                        "value": "kernel-pca",
+                    },
+                    {
+                        "label": "UMAP",
+                        "value": "umap",
+                    },
+                ],
+                value="pca",  # Default value
+                labelStyle={"display": "block"},
+            ),
+            dbc.Collapse(
+                id="umap-area",
+                children=[
+                    dbc.Row(
+                        [
+                            dbc.Label(
+                                "Neighbours",
+                                html_for="umap-n-neighbors",
+                                width=4,
+                            ),
+                            dbc.Col(
+                                dbc.Input(
+                                    type="number",
+                                    id="umap-n-neighbors",
+                                    value=DEFAULT_UMAP_N_NEIGHBORS,
+                                    min=2,
+                                    style={
+                                        "textAlign": "center",
+                                        "width": "100%",
+                                    },
+                                ),
+                                width=8,
+                            ),
+                        ],
+                        style={"marginTop": "10px"},
+                        className="mb-3",
+                    ),
+                    dbc.Row(
+                        [
+                            dbc.Label(
+                                "Min. Distance",
+                                html_for="umap-min-dist",
+                                width=4,
+                            ),
+                            dbc.Col(
+                                dbc.Input(
+                                    type="number",
+                                    id="umap-min-dist",
+                                    value=DEFAULT_UMAP_MIN_DIST,
+                                    min=0,
+                                    max=1,
+                                    step=0.05,
+                                    style={
+                                        "textAlign": "center",
+                                        "width": "100%",
+                                    },
+                                ),
+                                width=8,
+                            ),
+                        ],
+                        className="mb-3",
+                    ),
+                    dbc.Row(
+                        [
+                            dbc.Label(
+                                "Epochs",
+                                html_for="umap-n-epochs",
+                                width=4,
+                            ),
+                            dbc.Col(
+                                dbc.Input(
+                                    type="number",
+                                    id="umap-n-epochs",
+                                    min=1,
+                                    placeholder="Auto",
+                                    style={
+                                        "textAlign": "center",
+                                        "width": "100%",
+                                    },
+                                ),
+                                width=8,
+                            ),
+                        ],
+                        className="mb-3",
+                    ),
+                    dbc.Tooltip(
+                        "The neighbour graph is cached for the current selection, changing only the minimum distance or the epochs reuses it.",
+                        target="umap-area",
+                    ),
+                ],
+            ),
+            dbc.Collapse(
+                id="kernel-pca-area",
+                children=[
+                    dbc.Row(
+                        [
+                            dbc.Label(
+                                "Landmarks",
+                                html_for="kpca-n-landmarks",
+                                width=4,
+                            ),
+                            dbc.Col(
+                                dbc.Input(
+                                    type="number",
+                                    id="kpca-n-landmarks",
+                                    value=DEFAULT_KPCA_N_LANDMARKS,
+                                    min=2,
+                                    style={
+                                        "textAlign": "center",
+                                        "width": "100%",
+                                    },
+                                ),
+                                width=8,
+                            ),
+                        ],
+                        style={"marginTop": "10px"},
+                        className="mb-3",
+                    ),
+                    dbc.Row(
+                        [
+                            dbc.Label(
+                                "Gamma",
+                                html_for="kpca-gamma",
+                                width=4,
+                            ),
+                            dbc.Col(
+                                dbc.Input(
+                                    type="number",
+                                    id="kpca-gamma",
+                                    min=0,
+                                    placeholder="1 / No. Measures",
+                                    style={
+                                        "textAlign": "center",
+                                        "width": "100%",
+                                    },
+                                ),
+                                width=8,
+                            ),
+                        ],
+                        className="mb-3",
+                    ),
+                    dbc.Tooltip(
+                        "RBF kernel PCA approximated with a number of landmark rows. More landmarks are more accurate, but slower.",
+                        target="kernel-pca-area",
+                    ),
+                ],
+            ),
+            html.Hr(),
             html.Div(
                 dbc.Accordion(
                     [
@@ -240,6 +407,24 @@ offcanvas_patient_selector = dbc.Offcanvas(
                 ),
             ),
             html.Hr(),
+            dbc.Label(
+                "Select whether to show a fast PCA preview, fitted on a stratified sample, which is refined to the exact PCA in the background."
+            ),
+            dbc.Switch(
+                id="progressive-pca-switch",
+                value=False,
+                label="Progressive PCA",
+            ),
+            html.Hr(),
+            dbc.Label(
+                "Select whether to fit the exact quantile transform of the outlier detection on the selection, instead of merging the quantile sketches computed at upload (only used when whole bundle, age group and sex cells are selected)."
+            ),
+            dbc.Switch(
+                id="exact-quantile-switch",
+                value=False,
+                label="Exact quantile transform",
+            ),
+            html.Hr(),
             dbc.Label(
                 "Select whether to load only data for which 3D images are available \n regardless of the selected range or list."
             ),
@@ -262,6 +447,18 @@ offcanvas_patient_selector = dbc.Offcanvas(
                     "width": "100%",
                 },
             ),
+            dbc.Button(
+                "Cancel",
+                id="cancel-changes-button",
+                n_clicks=0,
+                disabled=True,
+                color="secondary",
+                style={
+                    "textAlign": "center",
+                    "width": "100%",
+                    "marginTop": "10px",
+                },
+            ),
             dbc.Modal(
                 [
                     dbc.ModalHeader(dbc.ModalTitle("Error Encountered!")),
@@ -1,6 +1,8 @@
 import dash_bootstrap_components as dbc
 from dash import dash_table, dcc, html
 
+from constants import OUTLIER_ENGINES
+
 outliers_row = [
     dbc.Row(
         dbc.Col(
@@ -170,9 +172,209 @@ outliers_row = [
                     className="mb-3",
                 ),
             ),
+            dbc.Col(
+                [
+                    dcc.Dropdown(
+                        id="dropdown-threshold-method",
+                        options=[
+                            {"label": "Empirical Percentile", "value": "empirical"},
+                            {"label": "Chi-Square", "value": "chi2"},
+                        ],
+                        value="empirical",
+                        clearable=False,
+                        multi=False,
+                        className="dbc",
+                    ),
+                    dbc.Tooltip(
+                        "Threshold for the Mahalanobis Distance: percentile of the distances, or quantile of the chi-square distribution with one degree of freedom per component",
+                        id="tooltip_threshold_method",
+                        is_open=False,
+                        target="dropdown-threshold-method",
+                        trigger="hover",
+                    ),
+                ],
+            ),
+        ],
+        style={"marginBottom": "10px"},
+    ),
+    dbc.Row(
+        [
+            dbc.Col(
+                dbc.InputGroup(
+                    [
+                        dbc.Input(
+                            id="input-mcd-support-fraction",
+                            placeholder="MCD Support (optional)",
+                            type="number",
+                            min=50,
+                            max=100,
+                        ),
+                        dbc.InputGroupText("%"),
+                        dbc.Tooltip(
+                            "Percentage of points in the support of the Minimum Covariance Determinant (empty for the default)",
+                            id="tooltip_mcd_support_fraction",
+                            is_open=False,
+                            target="input-mcd-support-fraction",
+                            trigger="hover",
+                        ),
+                    ],
+                    className="mb-3",
+                ),
+            ),
+            dbc.Col(
+                [
+                    dbc.Switch(
+                        id="mcd-subsample-switch",
+                        value=False,
+                        label="Subsampled MCD (large groups)",
+                        style={
+                            "margin": "10px",
+                        },
+                    ),
+                    dcc.Store(id="mcd-fit-store"),
+                ],
+            ),
+            dbc.Col(
+                [
+                    dbc.Button(
+                        "Build Outlier Atlas",
+                        id="button-build-outlier-atlas",
+                        n_clicks=0,
+                        style={
+                            "textAlign": "center",
+                            "width": "100%",
+                        },
+                    ),
+                    dbc.Tooltip(
+                        "Runs the outlier detection for every bundle and age group with the current parameters, "
+                        "the outliers of a bundle and age group are then looked up instead of recomputed",
+                        id="tooltip_build_outlier_atlas",
+                        is_open=False,
+                        target="button-build-outlier-atlas",
+                        trigger="hover",
+                    ),
+                    dcc.Store(id="outlier-atlas-store"),
+                ],
+            ),
+            dbc.Col(
+                [
+                    dbc.Button(
+                        "Export QC Report",
+                        id="button-export-outlier-atlas",
+                        n_clicks=0,
+                        disabled=True,
+                        style={
+                            "textAlign": "center",
+                            "width": "100%",
+                        },
+                    ),
+                    dcc.Download(id="download-outlier-atlas"),
+                ],
+            ),
+        ],
+        style={"marginBottom": "10px"},
+    ),
+    dbc.Row(
+        [
+            dbc.Col(
+                [
+                    dcc.Dropdown(
+                        id="dropdown-outlier-engine",
+                        options=[
+                            {"label": label, "value": value}
+                            for value, label in OUTLIER_ENGINES.items()
+                        ],
+                        value="ocsvm",
+                        clearable=False,
+                        multi=False,
+                        className="dbc",
+                    ),
+                    dbc.Tooltip(
+                        "Detector used after the Mahalanobis Distance: the exact OCSVM, a linear-cost approximation of it, "
+                        "an Isolation Forest, or a majority vote of the three fitted concurrently",
+                        id="tooltip_outlier_engine",
+                        is_open=False,
+                        target="dropdown-outlier-engine",
+                        trigger="hover",
+                    ),
+                ],
+            ),
+            dbc.Col(
+                dbc.Switch(
+                    id="compare-exact-ocsvm-switch",
+                    value=False,
+                    label="Compare with Exact OCSVM",
+                    style={
+                        "margin": "10px",
+                    },
+                ),
+            ),
+            dbc.Col(
+                html.Div(id="outlier-engine-info", style={"margin": "10px"}),
+                width=6,
+            ),
+        ],
+        style={"marginBottom": "10px"},
+    ),
+    dbc.Row(
+        [
+            dbc.Col(
+                [
+                    dbc.Button(
+                        "Save Outlier Model",
+                        id="button-save-outlier-model",
+                        n_clicks=0,
+                        style={
+                            "textAlign": "center",
+                            "width": "100%",
+                        },
+                    ),
+                    dbc.Tooltip(
+                        "Fits the detector with the current parameters and saves it, with the projection that feeds it, "
+                        "so new scans can be scored against this reference population without refitting",
+                        id="tooltip_save_outlier_model",
+                        is_open=False,
+                        target="button-save-outlier-model",
+                        trigger="hover",
+                    ),
+                    dcc.Store(id="outlier-model-store"),
+                    dcc.Download(id="download-outlier-model"),
+                ],
+            ),
+            dbc.Col(
+                dcc.Upload(
+                    id="upload-new-scans",
+                    children=dbc.Button(
+                        "Score New Scans (.mat)",
+                        id="button-score-new-scans",
+                        disabled=True,
+                        style={
+                            "textAlign": "center",
+                            "width": "100%",
+                        },
+                    ),
+                    accept=".mat",
+                ),
+            ),
+            dbc.Col(
+                html.Div(id="outlier-model-info", style={"margin": "10px"}),
+                width=6,
+            ),
         ],
         style={"marginBottom": "10px"},
     ),
+    dbc.Row(
+        dbc.Col(
+            [
+                dash_table.DataTable(
+                    id="table-new-scan-scores",
+                    style_table={"overflowX": "scroll"},
+                    export_format="csv",
+                ),
+            ]
+        ),
+        style={"marginBottom": "10px"},
+    ),
     dbc.Row(
         [
             dbc.Col(
@@ -229,6 +431,24 @@ outliers_row = [
             ]
         ),
     ),
+    dbc.Row(
+        dbc.Col(
+            [
+                html.H6(
+                    "Patient-Level Anomaly Scores (all bundles)",
+                    className="mt-3",
+                ),
+                dash_table.DataTable(
+                    id="table-patient-outlier-scores",
+                    style_table={"overflowX": "scroll"},
+                    page_size=10,
+                    sort_action="native",
+                    export_format="csv",
+                ),
+            ]
+        ),
+        style={"marginBottom": "10px"},
+    ),
     dbc.Row(
         dbc.Col(
             [
@@ -249,4 +469,93 @@ outliers_row = [
             ],
         ),
     ),
+    dbc.Row(
+        [
+            dbc.Col(
+                dbc.InputGroup(
+                    [
+                        dbc.InputGroupText("Significance"),
+                        dbc.Input(
+                            id="input-sweep-significance-levels",
+                            value="95, 97.5, 99",
+                            type="text",
+                        ),
+                        dbc.InputGroupText("%"),
+                    ],
+                    className="mb-3",
+                ),
+            ),
+            dbc.Col(
+                dbc.InputGroup(
+                    [
+                        dbc.InputGroupText("Expected Outliers"),
+                        dbc.Input(
+                            id="input-sweep-nu-levels",
+                            value="1, 5, 10",
+                            type="text",
+                        ),
+                        dbc.InputGroupText("%"),
+                    ],
+                    className="mb-3",
+                ),
+            ),
+            dbc.Col(
+                dbc.InputGroup(
+                    [
+                        dbc.InputGroupText("Components"),
+                        dbc.Input(
+                            id="input-sweep-n-components",
+                            value="2, 3, 5",
+                            type="text",
+                        ),
+                    ],
+                    className="mb-3",
+                ),
+            ),
+            dbc.Col(
+                [
+                    dbc.Button(
+                        "Sweep Parameters",
+                        id="button-outlier-sweep",
+                        n_clicks=0,
+                        style={
+                            "textAlign": "center",
+                            "width": "100%",
+                        },
+                    ),
+                    dbc.Tooltip(
+                        "Runs the outlier detection (exact OCSVM) for every combination of the comma-separated values, "
+                        "for the selected bundle and age group, to choose the parameters in one run",
+                        id="tooltip_outlier_sweep",
+                        is_open=False,
+                        target="button-outlier-sweep",
+                        trigger="hover",
+                    ),
+                ],
+            ),
+        ],
+        style={"marginTop": "10px"},
+    ),
+    dbc.Row(
+        dbc.Col(
+            [
+                dcc.Graph(
+                    id="graph-outlier-sweep",
+                    style={"height": "500px"},
+                ),
+            ],
+        ),
+    ),
+    dbc.Row(
+        dbc.Col(
+            [
+                dash_table.DataTable(
+                    id="table-outlier-sweep-subjects",
+                    style_table={"overflowX": "scroll"},
+                    page_size=10,
+                    export_format="csv",
+                ),
+            ]
+        ),
+    ),
 ]
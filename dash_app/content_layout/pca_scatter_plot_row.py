@@ -1,8 +1,11 @@
 import dash_bootstrap_components as dbc
-from dash import dcc, html
+from dash import dash_table, dcc, html
+
+from constants import BOOTSTRAP_RESAMPLES
 
 pca_scatter_plot_row = [
-    dcc.Store("store-pca-scatter-plot-output"),
+    dcc.Store("store-pca-scatter-plot-output", data=[]),
+    dcc.Store("normative-atlas-store"),
     dbc.Row(
         dbc.Col(
             html.H5(
@@ -148,6 +151,13 @@ pca_scatter_plot_row = [
                         value=False,
                     ),
                 ),
+                dbc.Col(
+                    dbc.Checkbox(
+                        id="scatter-plot-knots-cv",
+                        label="Select Knots and Degree by Cross-Validation",
+                        value=False,
+                    ),
+                ),
                 dbc.Collapse(
                     id="scatter-plot-knots-collapse",
                     children=[
@@ -174,6 +184,160 @@ pca_scatter_plot_row = [
         ),
         style={"margin-bottom": "50px"},
     ),
+    dbc.Row(
+        dbc.Col(
+            dcc.Graph(
+                id="graph-knot-selection-cv",
+                style={"height": "400px"},
+            ),
+        ),
+    ),
+    dbc.Row(
+        [
+            dbc.Col(
+                [
+                    dbc.Button(
+                        "Fit All Bundles",
+                        id="button-fit-all-bundles-regression",
+                        n_clicks=0,
+                        style={
+                            "textAlign": "center",
+                            "width": "100%",
+                        },
+                    ),
+                    dbc.Button(
+                        "Permutation Test (All Bundles)",
+                        id="button-permutation-test",
+                        n_clicks=0,
+                        style={
+                            "textAlign": "center",
+                            "width": "100%",
+                            "marginTop": "10px",
+                        },
+                    ),
+                ],
+                width=2,
+            ),
+            dbc.Col(
+                dash_table.DataTable(
+                    id="table-all-bundles-regression-r2",
+                    style_table={"overflowX": "scroll"},
+                    page_size=10,
+                    sort_action="native",
+                    export_format="csv",
+                ),
+                width=10,
+            ),
+        ],
+        style={"margin-bottom": "50px"},
+    ),
+    dbc.Row(
+        [
+            dbc.Col(
+                dbc.Button(
+                    "Bootstrap Bands",
+                    id="button-bootstrap-bands",
+                    n_clicks=0,
+                    style={
+                        "textAlign": "center",
+                        "width": "100%",
+                    },
+                ),
+                width=2,
+            ),
+            dbc.Col(
+                dbc.InputGroup(
+                    [
+                        dbc.InputGroupText("Resamples"),
+                        dbc.Input(
+                            id="input-bootstrap-resamples",
+                            type="number",
+                            min=50,
+                            step=50,
+                            value=BOOTSTRAP_RESAMPLES,
+                        ),
+                    ]
+                ),
+                width=3,
+            ),
+            dbc.Col(html.Div(id="bootstrap-bands-info")),
+        ],
+    ),
+    dbc.Row(
+        # The regression plots of the current selection, with the bootstrap bands added
+        dbc.Col(html.Div(id="bootstrap-bands-div")),
+        style={"margin-bottom": "50px"},
+    ),
+    dbc.Row(
+        [
+            dbc.Col(
+                dbc.Button(
+                    "Build Normative Atlas",
+                    id="button-build-normative-atlas",
+                    n_clicks=0,
+                    style={
+                        "textAlign": "center",
+                        "width": "100%",
+                    },
+                ),
+                width=2,
+            ),
+            dbc.Col(
+                # Atlas built offline with normative_atlas.py
+                dcc.Upload(
+                    id="upload-normative-atlas",
+                    children=dbc.Button(
+                        "Load Normative Atlas (.csv)",
+                        style={
+                            "textAlign": "center",
+                            "width": "100%",
+                        },
+                    ),
+                    accept=".csv",
+                ),
+                width=2,
+            ),
+            dbc.Col(
+                dcc.Dropdown(
+                    id="normative-measure-dropdown",
+                    placeholder="Measure",
+                    multi=False,
+                    className="dbc",
+                ),
+            ),
+            dbc.Col(
+                dcc.Dropdown(
+                    id="normative-subject-dropdown",
+                    placeholder="Subject to z-score",
+                    multi=False,
+                    className="dbc",
+                ),
+            ),
+        ],
+    ),
+    dbc.Row(dbc.Col(html.Div(id="normative-atlas-info", style={"margin": "10px"}))),
+    dbc.Row(
+        [
+            dbc.Col(
+                dcc.Graph(
+                    id="graph-normative-centiles",
+                    style={"height": "600px"},
+                ),
+                width=8,
+            ),
+            dbc.Col(
+                dash_table.DataTable(
+                    id="table-normative-z-scores",
+                    style_table={"overflowX": "scroll"},
+                    page_size=15,
+                    sort_action="native",
+                    export_format="csv",
+                ),
+                width=4,
+            ),
+        ],
+        style={"margin-bottom": "50px"},
+    ),
     dbc.Row(
         [
             dbc.Col(
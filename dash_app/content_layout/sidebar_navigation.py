@@ -82,8 +82,19 @@ sidebar_layout = (
                     dcc.Store(id="pca-outlier-store"),
                     dcc.Store(id="patient-list-store"),
                     dcc.Store(id="hover-data-store"),
+                    dcc.Store(id="umap-knn-store"),
+                    dcc.Store(id="kernel-pca-model-store"),
+                    dcc.Store(id="pca-refine-store"),
+                    dcc.Store(id="quantile-sketch-store"),
+                    dcc.Store(id="outlier-projection-store"),
                 ],
             ),
+            dbc.Label(
+                id="pca-refine-status",
+                style={
+                    "margin": "10px",
+                },
+            ),
             dbc.Container(
                 id="image_loading_container",
                 children=[
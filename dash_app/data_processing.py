@@ -1,3 +1,5 @@
+import hashlib
+
 import pandas as pd
 
 
@@ -145,3 +147,22 @@ def truncate_data(
         raise ValueError("Invalid patient_list format")
 
     return filtered_df
+
+
+def dataframe_fingerprint(df, *params):
+    """
+    Computes a content hash of a DataFrame and optional extra parameters.
+    Used as a cache key, so that results computed for a selection can be reused when the selection is unchanged.
+
+    Parameters:
+    - df (DataFrame): The DataFrame to hash.
+    - params: Any extra values that should be part of the key (e.g. number of neighbours).
+
+    Returns:
+    - fingerprint (str): Hexadecimal digest of the contents.
+    """
+    hasher = hashlib.sha1()
+    hasher.update(repr(list(df.columns)).encode())
+    hasher.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    hasher.update(repr(params).encode())
+    return hasher.hexdigest()
@@ -1,10 +1,21 @@
 import numpy as np
 import pandas as pd
 from sklearn.decomposition import PCA
+from sklearn.kernel_approximation import Nystroem
+from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import QuantileTransformer, StandardScaler
+from umap import UMAP
+from umap.umap_ import nearest_neighbors
 
+import data_processing
+from dim_reduction_viz import stratified_sampling
+from quantile_sketches import SketchQuantileTransformer
 
-def run_pca_backend(df, n_components, normalize=True):
+# Columns that identify a row, everything else in the filtered DataFrame is a measure
+ID_COLUMNS = ["Patient", "Patient_ID", "Bundle", "Sex", "Age", "Age_Group"]
+
+
+def run_pca_backend(df, n_components, normalize=True, sample_percentage=None):
     """
     Runs Principal Component Analysis (PCA) on a DataFrame.
 
@@ -12,9 +23,11 @@ def run_pca_backend(df, n_components, normalize=True):
     - df (DataFrame): The input DataFrame.
     - n_components (int): The number of components to keep.
     - normalize (bool): Whether to normalize the data or not. Default is True.
+    - sample_percentage (float): If given, the scaler and PCA are fitted on a stratified sample (per bundle)
+      of this percentage of the rows, and all rows are projected on it. Default is None (fit on all rows).
 
     Returns:
-    - df_final (DataFrame): The DataFrame with PCA applied.
+    - df_final (DataFrame): The identifying columns, the measures and the PC columns, one row per input row (without NaN).
     """
     # Drop rows with NaN values
     df = df.dropna().reset_index(drop=True)
@@ -24,30 +37,36 @@ def run_pca_backend(df, n_components, normalize=True):
     bundle_categories = df["Bundle"].cat.categories  # Save the original categories
     df["Bundle"] = df["Bundle"].cat.codes
     # print(df.head())
+    # Rows used to fit the scaler and the PCA, all rows are projected afterwards
+    if sample_percentage:
+        df_fit = stratified_sampling(df, sample_percentage)
+    else:
+        df_fit = df
+    features = df.drop(
+        ["Patient", "Patient_ID", "Bundle", "Sex", "Age", "Age_Group"], axis=1
+    )
+    features_fit = df_fit[features.columns]
+
     # Normalize the data if specified
     if normalize:
-        features_to_normalize = df.drop(
-            ["Patient", "Patient_ID", "Bundle", "Sex", "Age", "Age_Group"], axis=1
-        )
-        scaler = StandardScaler()
-        df_normalized = scaler.fit_transform(features_to_normalize)
+        scaler = StandardScaler().fit(features_fit)
+        df_normalized = scaler.transform(features)
+        df_fit_normalized = scaler.transform(features_fit)
     else:
-        df_normalized = df.drop(
-            ["Patient", "Patient_ID", "Bundle", "Sex", "Age", "Age_Group"], axis=1
-        )
+        df_normalized = features
+        df_fit_normalized = features_fit
 
     # Apply PCA
     pca = PCA(n_components=n_components)
-    components = pca.fit_transform(df_normalized)
+    pca.fit(df_fit_normalized)
+    components = pca.transform(df_normalized)
     df_pca = pd.DataFrame(
         components, columns=[f"PC{i}" for i in range(1, n_components + 1)]
     )
 
     # Create a DataFrame for the reduced data
-    df_final = pd.concat(
-        [df[["Patient", "Patient_ID", "Bundle", "Sex", "Age", "Age_Group"]], df_pca],
-        axis=1,
-    )
+    # The identifying columns, measures and components come from the same rows, so they are aligned by position
+    df_final = pd.concat([df, df_pca], axis=1)
 
     # Map back the original names to 'Bundle'
     df_final["Bundle"] = pd.Categorical.from_codes(
@@ -57,10 +76,38 @@ def run_pca_backend(df, n_components, normalize=True):
     return df_final, pca, components
 
 
-def run_outlier_pca_backend(df):
+def align_component_signs(pca_df, pca, reference_pca_df):
+    """
+    Flips the principal components that point in the opposite direction of a reference result with the same rows.
+    Components are only defined up to their sign, so without this a refined PCA can mirror the preview.
+    pca_df and the components of pca are modified in place.
+    """
+    if len(pca_df) != len(reference_pca_df):
+        return
+    for i in range(pca.n_components_):
+        column = f"PC{i + 1}"
+        if (
+            column in reference_pca_df
+            and np.dot(pca_df[column], reference_pca_df[column]) < 0
+        ):
+            pca_df[column] = -pca_df[column]
+            pca.components_[i] = -pca.components_[i]
+
+
+def run_outlier_pca_backend(df, cell_sketches=None):
     # Drop rows with NaN values
     df = df.dropna().reset_index(drop=True)
 
+    # If the precomputed quantile sketches of the cells are given, the normal-score transform is built by merging them
+    # instead of sorting the data (see quantile_sketches.py), this must be done before the bundles are encoded
+    if cell_sketches is not None:
+        scaler = SketchQuantileTransformer(cell_sketches).fit(df)
+    else:
+        scaler = QuantileTransformer(
+            output_distribution="normal"
+        )  # Use a quantile transformer with a normal distribution, which is robust to outliers
+        # This is the only difference from the previous function
+
     # Encode categorical variable 'Bundle' with names
     df["Bundle"] = df["Bundle"].astype("category")
     bundle_categories = df["Bundle"].cat.categories  # Save the original categories
@@ -70,11 +117,10 @@ def run_outlier_pca_backend(df):
     features_to_normalize = df.drop(
         ["Patient", "Patient_ID", "Bundle", "Sex", "Age", "Age_Group"], axis=1
     )
-    scaler = QuantileTransformer(
-        output_distribution="normal"
-    )  # Use a quantile transformer with a normal distribution, which is robust to outliers
-    # This is the only difference from the previous function
-    df_normalized = scaler.fit_transform(features_to_normalize)
+    if cell_sketches is not None:
+        df_normalized = scaler.transform(features_to_normalize)
+    else:
+        df_normalized = scaler.fit_transform(features_to_normalize)
 
     # Apply PCA
     pca = PCA(n_components=0.95)  # Keep components that explain 95% of the variance
@@ -108,4 +154,170 @@ def run_outlier_pca_backend(df):
         df_final["Bundle"], categories=bundle_categories
     )
 
-    return df_final, pca, components
+    # The fitted scaler is returned as well, so the projection can be applied to new scans (see outlier_model.py)
+    return df_final, pca, components, scaler
+
+
+def build_umap_knn_graph(features, n_neighbors=15, random_state=42):
+    """
+    Builds the nearest-neighbour graph used by UMAP for a filtered selection.
+    The graph only depends on the features and the number of neighbours, so it can be cached
+    and reused when only min_dist or the number of epochs change.
+
+    Parameters:
+    - features (ndarray): The (normalized) feature matrix.
+    - n_neighbors (int): The number of neighbours of each point.
+    - random_state (int): Seed for the approximate nearest-neighbour search.
+
+    Returns:
+    - knn_graph (dict): The neighbour indices and the neighbour distances.
+    """
+    knn_indices, knn_dists, _ = nearest_neighbors(
+        features,
+        n_neighbors=n_neighbors,
+        metric="euclidean",
+        metric_kwds={},
+        angular=False,
+        random_state=np.random.RandomState(random_state),
+    )
+    return {
+        "indices": knn_indices,
+        "distances": knn_dists,
+    }
+
+
+def run_umap_backend(
+    df,
+    n_components=2,
+    n_neighbors=15,
+    min_dist=0.1,
+    n_epochs=None,
+    normalize=True,
+    knn_graph=None,
+):
+    """
+    Runs UMAP on a DataFrame, reusing a cached nearest-neighbour graph when it matches the selection.
+
+    Parameters:
+    - df (DataFrame): The input DataFrame.
+    - n_components (int): The number of embedding dimensions.
+    - n_neighbors (int): The number of neighbours used to build the graph.
+    - min_dist (float): The minimum distance between embedded points.
+    - n_epochs (int): The number of optimization epochs, None lets UMAP decide.
+    - normalize (bool): Whether to normalize the data or not. Default is True.
+    - knn_graph (dict): The graph returned by a previous call, if any.
+
+    Returns:
+    - df_final (DataFrame): The identifying columns, the measures and the embedding in PC1..PCk columns, like run_pca_backend.
+    - reducer (UMAP): The fitted UMAP object.
+    - knn_graph (dict): The graph used for the embedding, to be cached for the next call.
+    """
+    # Drop rows with NaN values
+    df = df.dropna().reset_index(drop=True)
+    features = df.drop(ID_COLUMNS, axis=1).values
+    if normalize:
+        features = StandardScaler().fit_transform(features)
+
+    # UMAP needs at least one neighbour besides the point itself
+    n_neighbors = max(2, min(n_neighbors, len(df) - 1))
+
+    # Only rebuild the graph if the selection or the number of neighbours changed
+    key = data_processing.dataframe_fingerprint(pd.DataFrame(features), n_neighbors)
+    if knn_graph is None or knn_graph["key"] != key:
+        knn_graph = build_umap_knn_graph(features, n_neighbors)
+        knn_graph["key"] = key
+
+    reducer = UMAP(
+        n_components=n_components,
+        n_neighbors=n_neighbors,
+        min_dist=min_dist,
+        n_epochs=n_epochs,
+        random_state=42,
+        # UMAP modifies the graph in place, so pass copies to keep the cached one intact
+        precomputed_knn=(
+            knn_graph["indices"].copy(),
+            knn_graph["distances"].copy(),
+            None,
+        ),
+    )
+    components = reducer.fit_transform(features)
+    df_umap = pd.DataFrame(
+        components, columns=[f"PC{i}" for i in range(1, n_components + 1)]
+    )
+
+    # Create a DataFrame for the reduced data
+    df_final = pd.concat([df, df_umap], axis=1)
+
+    return df_final, reducer, knn_graph
+
+
+def run_kernel_pca_backend(
+    df, n_components, n_landmarks=300, gamma=None, normalize=True, random_state=42
+):
+    """
+    Runs an approximate RBF kernel PCA on a DataFrame, using a Nystroem approximation of the kernel.
+    The kernel is approximated with n_landmarks sampled rows, so the fit is linear in the number of rows
+    (O(n * n_landmarks^2)) instead of the O(n^2) memory of an exact KernelPCA.
+
+    Parameters:
+    - df (DataFrame): The input DataFrame.
+    - n_components (int): The number of components to keep.
+    - n_landmarks (int): The number of landmark rows used for the Nystroem approximation.
+    - gamma (float): The RBF kernel coefficient, None uses 1 / number of measures.
+    - normalize (bool): Whether to normalize the data or not. Default is True.
+    - random_state (int): Seed for the landmark sampling.
+
+    Returns:
+    - df_final (DataFrame): The identifying columns, the measures and the kernel PCs in PC1..PCk columns, like run_pca_backend.
+    - model (Pipeline): The fitted (scaler), landmark and PCA model, used for out-of-sample transforms.
+    - components (ndarray): The kernel principal components.
+    """
+    # Drop rows with NaN values
+    df = df.dropna().reset_index(drop=True)
+    features = df.drop(ID_COLUMNS, axis=1)
+
+    # The landmarks are a subset of the rows, so there can not be more landmarks than rows
+    n_landmarks = min(n_landmarks, len(df))
+
+    steps = [("scaler", StandardScaler())] if normalize else []
+    steps += [
+        (
+            "nystroem",
+            Nystroem(
+                kernel="rbf",
+                gamma=gamma,
+                n_components=n_landmarks,
+                random_state=random_state,
+            ),
+        ),
+        ("pca", PCA(n_components=n_components)),
+    ]
+    model = Pipeline(steps)
+    components = model.fit_transform(features)
+    df_pca = pd.DataFrame(
+        components, columns=[f"PC{i}" for i in range(1, n_components + 1)]
+    )
+
+    # Create a DataFrame for the reduced data
+    df_final = pd.concat([df, df_pca], axis=1)
+
+    return df_final, model, components
+
+
+def transform_kernel_pca(model, df):
+    """
+    Projects new rows into a kernel PCA fitted by run_kernel_pca_backend, without refitting the landmarks.
+
+    Parameters:
+    - model (Pipeline): The model returned by run_kernel_pca_backend.
+    - df (DataFrame): The rows to project, with the same measures the model was fitted on.
+
+    Returns:
+    - df_final (DataFrame): The identifying columns, the measures and the PC1..PCk columns of the projected rows.
+    """
+    df = df[ID_COLUMNS + list(model.feature_names_in_)].dropna().reset_index(drop=True)
+    components = model.transform(df[model.feature_names_in_])
+    df_pca = pd.DataFrame(
+        components, columns=[f"PC{i}" for i in range(1, components.shape[1] + 1)]
+    )
+    return pd.concat([df, df_pca], axis=1)
@@ -3,18 +3,42 @@ import plotly.express as px
 import plotly.graph_objects as go
 
 
+def create_placeholder_plot(message):
+    """
+    Create an empty plot with a message, used when a plot does not apply to the selected method
+    """
+    fig = go.Figure()
+    fig.add_annotation(
+        text=message,
+        xref="paper",
+        yref="paper",
+        x=0.5,
+        y=0.5,
+        showarrow=False,
+    )
+    fig.update_xaxes(visible=False)
+    fig.update_yaxes(visible=False)
+    return fig
+
+
 def create_explained_variance_plot(pca, pca_outlier):
     """
     Create a plot of the explained variance for PCA.
+    pca can be None if the scatter plot was made with a method without explained variance (e.g. UMAP)
     """
-    # Calculate the cumulative explained variance for PCA
-    exp_var_cumul = np.cumsum(pca.explained_variance_ratio_)
-
-    fig_pca = px.area(
-        x=range(1, exp_var_cumul.shape[0] + 1),  # Number of components
-        y=exp_var_cumul,
-        labels={"x": "# Components", "y": "Explained Variance"},
-    )
+    if pca is not None:
+        # Calculate the cumulative explained variance for PCA
+        exp_var_cumul = np.cumsum(pca.explained_variance_ratio_)
+
+        fig_pca = px.area(
+            x=range(1, exp_var_cumul.shape[0] + 1),  # Number of components
+            y=exp_var_cumul,
+            labels={"x": "# Components", "y": "Explained Variance"},
+        )
+    else:
+        fig_pca = create_placeholder_plot(
+            "Explained variance is not available for UMAP"
+        )
 
     """
     Create a plot of the explained variance for outlier PCA
@@ -31,6 +55,47 @@ def create_explained_variance_plot(pca, pca_outlier):
     return fig_pca, fig_outlier_pca
 
 
+def create_outlier_sweep_heatmap(sweep_df):
+    """
+    Create the heatmaps of the outlier parameter sweep, the percentage of flagged rows for each significance level
+    and nu, with one heatmap per number of components
+    """
+    q_values = sorted(sweep_df["q"].unique())
+    # One (alpha x nu) grid per q, stacked so they are shown side by side
+    grids = np.stack(
+        [
+            sweep_df[sweep_df["q"] == q]
+            .pivot(index="alpha", columns="nu", values="Outlier_Percentage")
+            .sort_index()
+            .sort_index(axis=1)
+            .values
+            for q in q_values
+        ]
+    )
+    alpha_values = sorted(sweep_df["alpha"].unique())
+    nu_values = sorted(sweep_df["nu"].unique())
+
+    fig = px.imshow(
+        grids,
+        facet_col=0,
+        x=[f"{100 * nu:g}%" for nu in nu_values],
+        y=[f"{100 * (1 - alpha):g}%" for alpha in alpha_values],
+        labels={
+            "x": "Expected Outliers (nu)",
+            "y": "Significance",
+            "color": "% Flagged",
+        },
+        text_auto=".1f",
+        aspect="auto",
+        color_continuous_scale="Reds",
+        title="Outlier Parameter Sweep",
+    )
+    # Name the facets with the number of components
+    for i, q in enumerate(q_values):
+        fig.layout.annotations[i].text = f"{q} components"
+    return fig
+
+
 def stratified_sampling(dataframe, percentage, stratify_column="Bundle"):
     """
     Perform stratified sampling based on a given percentage.
@@ -198,6 +263,22 @@ def create_pca_scatter_plot(
     return fig
 
 
+def create_projected_scans_trace(projected_df):
+    """
+    Create the scatter trace of new scans projected on a fitted reduction (see dim_reduction_backend.transform_kernel_pca),
+    added to the 2D scatter plot, so new scans are shown against the reference selection
+    """
+    return go.Scatter(
+        x=projected_df["PC1"],
+        y=projected_df["PC2"],
+        mode="markers",
+        marker=dict(symbol="x", size=9, color="black"),
+        name="New Scans (projected)",
+        text=projected_df["Patient"].astype(str) + ", " + projected_df["Bundle"],
+        hovertemplate="%{text}<extra>New Scans</extra>",
+    )
+
+
 def create_color_palette():
     """
     72 colors from plotly, for a more diverse color palette, for a maximum of 72 bundles
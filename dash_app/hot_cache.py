@@ -0,0 +1,129 @@
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from constants import SERVERSIDE_HOT_CACHE_BYTES
+
+
+def estimate_nbytes(value):
+    """
+    Estimates the memory footprint of a value in bytes, DataFrames and arrays are measured exactly,
+    containers are summed recursively and anything else falls back to sys.getsizeof
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        usage = value.memory_usage(deep=True)
+        return int(usage.sum() if isinstance(usage, pd.Series) else usage)
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            estimate_nbytes(key) + estimate_nbytes(item) for key, item in value.items()
+        )
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(estimate_nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class HotCache:
+    """
+    Thread-safe in-memory LRU of already deserialized values, bounded by a byte budget.
+    Each worker process has its own copy, so repeated reads of the same Serverside value
+    (relayout, hover and click callbacks) do not pay the disk I/O and deserialization again.
+    The values are returned by reference, callers must not modify them in place.
+    """
+
+    def __init__(self, max_bytes=SERVERSIDE_HOT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Returns the value of key and marks it as most recently used, or default if it is not cached
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def peek(self, key, default=None):
+        """
+        Returns the value of key without counting a hit or miss, nor changing the order of the entries
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return default if entry is None else entry[0]
+
+    def size(self, key):
+        """
+        Returns the estimated bytes of the value of key, 0 if it is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return 0 if entry is None else entry[1]
+
+    def put(self, key, value, nbytes=None):
+        """
+        Stores a value, then evicts the least recently used entries until the cache is within its budget.
+        Values larger than the whole budget are not stored. nbytes is estimated when not given.
+        """
+        if nbytes is None:
+            nbytes = estimate_nbytes(value)
+        with self._lock:
+            self._discard(key)
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self._nbytes -= evicted_nbytes
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def discard(self, match):
+        """
+        Removes the entries whose key satisfies match (a callable), e.g. every projection of a Serverside key
+        """
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        """
+        Returns the counters of the cache: entries, bytes used and budget, hits, misses, evictions and hit rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,242 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import dim_reduction_backend
+import outlier_model
+from constants import NORMATIVE_AGE_STEP, NORMATIVE_CENTILES
+from principal_components_age_corr_regression_viz import SplineBasis
+
+# Columns that identify a row, every other column is a measure (raw measure or PC)
+ID_COLUMNS = dim_reduction_backend.ID_COLUMNS
+# E[log|Z|] of a standard normal variable, the scale model is fitted on the log of the absolute residuals
+LOG_ABS_NORMAL_MEAN = -(np.euler_gamma + np.log(2)) / 2
+
+
+def centile_columns(centiles=NORMATIVE_CENTILES):
+    # Names of the centile columns of the atlas
+    return [f"P{centile}" for centile in centiles]
+
+
+def _fit_location_scale(x, y, basis):
+    """
+    Fits the location-scale spline model of all the columns of y at once
+    The mean is a spline of age, and the log of the standard deviation is a spline of age fitted on the log of the absolute residuals
+    Returns the coefficients of the mean and of the log standard deviation, of shape (n_basis, n_columns)
+    """
+    X = basis.design_matrix(x)
+    mean_coefficients = np.linalg.lstsq(X, y, rcond=None)[0]
+    log_residuals = np.log(np.maximum(np.abs(y - X @ mean_coefficients), 1e-12))
+    scale_coefficients = np.linalg.lstsq(X, log_residuals, rcond=None)[0]
+    return mean_coefficients, scale_coefficients
+
+
+def _fit_bundle(task):
+    """
+    Fits the centile curves of every measure of one bundle, for every sex, runs in a worker process
+    The columns with the same missing values share the design matrix and are fitted together
+    """
+    bundle, bundle_df, measures, age_grid, degree, centiles = task
+    z = stats.norm.ppf(np.asarray(centiles) / 100)
+    curves = []
+    for sex, sex_df in bundle_df.groupby("Sex"):
+        x = sex_df["Age"].to_numpy(dtype=float)
+        y = sex_df[measures].to_numpy(dtype=float)
+        observed = ~np.isnan(y)
+        _, pattern_ids = np.unique(observed, axis=1, return_inverse=True)
+        pattern_ids = pattern_ids.ravel()
+        for pattern_id in np.unique(pattern_ids):
+            columns = np.flatnonzero(pattern_ids == pattern_id)
+            rows = observed[:, columns[0]]
+            # Knots at the quartiles, as in SplineRegression, a few more rows than coefficients are needed
+            if rows.sum() <= degree + 8:
+                continue
+            basis = SplineBasis(x[rows], degree=degree)
+            mean_coefficients, scale_coefficients = _fit_location_scale(
+                x[rows], y[np.ix_(rows, columns)], basis
+            )
+            # The curves are only stored within the age range of the data, no extrapolation
+            grid = age_grid[
+                (age_grid >= basis.lower_bound) & (age_grid <= basis.upper_bound)
+            ]
+            X_grid = basis.design_matrix(grid)
+            mu = X_grid @ mean_coefficients
+            sigma = np.exp(X_grid @ scale_coefficients - LOG_ABS_NORMAL_MEAN)
+            # One block of rows per column, the curves of a column are contiguous
+            n_grid = len(grid)
+            curve_df = pd.DataFrame(
+                {
+                    "Bundle": bundle,
+                    "Sex": sex,
+                    "Measure": np.repeat(np.asarray(measures)[columns], n_grid),
+                    "Age": np.tile(grid, len(columns)),
+                    "Mu": mu.ravel(order="F"),
+                    "Sigma": sigma.ravel(order="F"),
+                }
+            )
+            centile_values = mu[:, :, None] + sigma[:, :, None] * z
+            for i, column in enumerate(centile_columns(centiles)):
+                curve_df[column] = centile_values[:, :, i].ravel(order="F")
+            curves.append(curve_df)
+    return pd.concat(curves) if curves else None
+
+
+def build_normative_atlas(
+    df,
+    measures=None,
+    age_step=NORMATIVE_AGE_STEP,
+    degree=3,
+    centiles=NORMATIVE_CENTILES,
+    max_workers=None,
+):
+    """
+    Fits the normative centile curves of every bundle x measure x sex, in parallel worker processes (one task per bundle).
+    Each curve is a location-scale spline model, so the centiles follow from the mean and the standard deviation at each age.
+
+    Parameters:
+    - df (DataFrame): The data, with the identifying columns and the measures (raw measures and/or PCs).
+    - measures (list): The measures to fit, defaults to every column that is not an identifier.
+    - age_step (float): The step of the age grid the curves are stored on, in years.
+    - degree (int): The degree of the splines.
+    - centiles (list): The centiles of the curves.
+    - max_workers (int): The number of worker processes, defaults to the number of CPUs.
+
+    Returns:
+    - atlas_df (DataFrame): One row per bundle, sex, measure and age of the grid, with the mean (Mu),
+      the standard deviation (Sigma) and the centiles (P5, P25, ...), stored as float32.
+    """
+    if measures is None:
+        measures = [column for column in df.columns if column not in ID_COLUMNS]
+    age_grid = np.arange(
+        np.floor(df["Age"].min()), np.ceil(df["Age"].max()) + age_step, age_step
+    )
+    tasks = [
+        (str(bundle), bundle_df, measures, age_grid, degree, centiles)
+        for bundle, bundle_df in df.groupby("Bundle", observed=True)
+    ]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        bundle_atlases = [
+            atlas for atlas in executor.map(_fit_bundle, tasks) if atlas is not None
+        ]
+    atlas_df = pd.concat(bundle_atlases, ignore_index=True)
+    value_columns = ["Age", "Mu", "Sigma"] + centile_columns(centiles)
+    atlas_df[value_columns] = atlas_df[value_columns].astype(np.float32)
+    atlas_df[["Bundle", "Measure"]] = atlas_df[["Bundle", "Measure"]].astype("category")
+    return atlas_df
+
+
+def load_normative_atlas(source):
+    """
+    Loads an atlas written by the command line entry point (see main), with the same types as build_normative_atlas
+
+    Parameters:
+    - source (str or file): The path or the file object of the CSV file.
+
+    Returns:
+    - atlas_df (DataFrame): The atlas, see build_normative_atlas.
+    """
+    atlas_df = pd.read_csv(source)
+    missing = [
+        column
+        for column in ["Bundle", "Sex", "Measure", "Age", "Mu", "Sigma"]
+        if column not in atlas_df.columns
+    ]
+    if missing:
+        raise ValueError(f"Not a normative atlas, missing columns {missing}")
+    value_columns = [
+        column
+        for column in ["Age", "Mu", "Sigma"] + centile_columns()
+        if column in atlas_df.columns
+    ]
+    atlas_df[value_columns] = atlas_df[value_columns].astype(np.float32)
+    atlas_df[["Bundle", "Measure"]] = (
+        atlas_df[["Bundle", "Measure"]].astype(str).astype("category")
+    )
+    return atlas_df
+
+
+def normative_z_scores(atlas_df, df, measures=None):
+    """
+    Z-scores subjects against the atlas, the mean and standard deviation are interpolated at the age of each subject
+    Subjects outside of the age range of a curve use the closest age of the curve
+
+    Parameters:
+    - atlas_df (DataFrame): The atlas, see build_normative_atlas.
+    - df (DataFrame): The rows to score, with the identifying columns and the measures.
+    - measures (list): The measures to score, defaults to the measures of the atlas present in df.
+
+    Returns:
+    - z_df (DataFrame): One row per subject row and measure, with the value, the z-score and the centile.
+    """
+    if measures is None:
+        measures = [
+            measure for measure in atlas_df["Measure"].unique() if measure in df.columns
+        ]
+    long_df = df.melt(
+        id_vars=[column for column in ID_COLUMNS if column in df.columns],
+        value_vars=measures,
+        var_name="Measure",
+        value_name="Value",
+    )
+    long_df["Bundle"] = long_df["Bundle"].astype(str)
+    keys = ["Bundle", "Sex", "Measure"]
+
+    # Positions of the rows of every curve, the atlas is grouped once
+    curve_rows = atlas_df.groupby(keys, sort=False, observed=True).indices
+    age = long_df["Age"].to_numpy(dtype=float)
+    curve_age = atlas_df["Age"].to_numpy(dtype=float)
+    curve_mu = atlas_df["Mu"].to_numpy(dtype=float)
+    curve_sigma = atlas_df["Sigma"].to_numpy(dtype=float)
+    mu = np.full(len(long_df), np.nan)
+    sigma = np.full(len(long_df), np.nan)
+    for key, rows in long_df.groupby(keys, sort=False).indices.items():
+        if key not in curve_rows:
+            continue
+        curve = curve_rows[key]
+        mu[rows] = np.interp(age[rows], curve_age[curve], curve_mu[curve])
+        sigma[rows] = np.interp(age[rows], curve_age[curve], curve_sigma[curve])
+    long_df["Z_Score"] = (long_df["Value"].to_numpy(dtype=float) - mu) / sigma
+
+    long_df["Centile"] = 100 * stats.norm.cdf(long_df["Z_Score"])
+    return long_df
+
+
+def main(argv=None):
+    """
+    Command line entry point, builds the atlas offline:
+        python normative_atlas.py data.mat --output atlas.csv --n-components 10
+    """
+    parser = argparse.ArgumentParser(
+        description="Build the normative centile atlas of every bundle and measure"
+    )
+    parser.add_argument("data", help="Path of the data (.mat or .csv)")
+    parser.add_argument(
+        "--output", required=True, help="Path of the CSV file for the atlas"
+    )
+    parser.add_argument(
+        "--n-components",
+        type=int,
+        default=0,
+        help="Number of principal components to add to the raw measures",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="Number of worker processes"
+    )
+    args = parser.parse_args(argv)
+
+    df = outlier_model.load_scans(args.data)
+    if args.n_components:
+        df, _, _ = dim_reduction_backend.run_pca_backend(df, args.n_components)
+    atlas_df = build_normative_atlas(df, max_workers=args.workers)
+    atlas_df.to_csv(args.output, index=False)
+    print(
+        f"{atlas_df.groupby(['Bundle', 'Sex', 'Measure']).ngroups} curves written to {args.output}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,182 @@
+import io
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import data_processing
+import outlier_detection
+
+# Columns of the atlas, besides the (Patient, Bundle) index
+# The atlas is keyed by scan (Patient), a subject (Patient_ID) can have several scans
+ATLAS_COLUMNS = [
+    "Patient_ID",
+    "Age_Group",
+    "Mahalanobis_Distance",
+    "Mahalanobis_Outlier",
+    "Detector_Score",
+    "Outlier",
+]
+
+
+def contribution_columns(q):
+    """
+    Returns the columns of the contributions of the q components to the Mahalanobis distance
+    """
+    return [f"PC{i}_Contribution" for i in range(1, q + 1)]
+
+
+def atlas_key(
+    pca_outlier_df,
+    q,
+    significance,
+    nu,
+    threshold_method,
+    engine,
+    support_fraction=None,
+    subsample=False,
+):
+    """
+    Computes the key of an atlas, from the data and every parameter of the detector, so an atlas is only
+    used in place of the detector when it was built with the same settings
+    The significance and nu are in percent, as entered in the app
+    """
+    return data_processing.dataframe_fingerprint(
+        pca_outlier_df,
+        int(q),
+        float(significance),
+        float(nu),
+        threshold_method,
+        engine,
+        None if support_fraction is None else float(support_fraction),
+        bool(subsample),
+    )
+
+
+def _score_cell(task):
+    """
+    Scores one bundle x age group cell, runs in a worker process
+    Cells with too few rows for the robust covariance of q components are returned without scores
+    """
+    (
+        cell_df,
+        q,
+        alpha,
+        nu,
+        threshold_method,
+        engine,
+        support_fraction,
+        subsample,
+    ) = task
+    atlas_df = cell_df[["Patient", "Patient_ID", "Bundle", "Age_Group"]].copy()
+    if len(cell_df) <= 2 * q:
+        atlas_df["Mahalanobis_Distance"] = float("nan")
+        atlas_df["Mahalanobis_Outlier"] = False
+        atlas_df["Detector_Score"] = float("nan")
+        atlas_df["Outlier"] = False
+        for column in contribution_columns(q):
+            atlas_df[column] = float("nan")
+        return atlas_df
+    scores_df, _, _ = outlier_detection.anomaly_detector_scores(
+        cell_df,
+        q,
+        alpha,
+        nu,
+        threshold_method,
+        support_fraction=support_fraction,
+        subsample=subsample,
+        engine=engine,
+    )
+    return pd.concat([atlas_df, scores_df], axis=1)
+
+
+def build_outlier_atlas(
+    pca_outlier_df,
+    q,
+    alpha=0.01,
+    nu=0.1,
+    threshold_method="empirical",
+    engine="ocsvm",
+    support_fraction=None,
+    subsample=False,
+    max_workers=None,
+):
+    """
+    Runs the anomaly detector (MCD + OCSVM) for every bundle x age group combination, in parallel worker processes.
+
+    Parameters:
+    - pca_outlier_df (DataFrame): The outlier PCA data, as returned by dim_reduction_backend.run_outlier_pca_backend.
+    - q (int): The number of principal components to use.
+    - alpha (float): The significance level of the Mahalanobis distance.
+    - nu (float): The expected fraction of outliers for the OCSVM.
+    - threshold_method (str): "empirical" or "chi2", see outlier_detection.determine_threshold.
+    - engine (str): The one-class detector, see outlier_detection.fit_one_class_detector.
+    - support_fraction, subsample: The settings of the robust MCD fit, see outlier_detection.calculate_parameters_mcd_cached.
+    - max_workers (int): The number of worker processes, defaults to the number of CPUs.
+
+    Returns:
+    - atlas_df (DataFrame): Scores, flags and contributions of the components of every row, indexed by (Patient, Bundle).
+    """
+    tasks = [
+        (cell_df, q, alpha, nu, threshold_method, engine, support_fraction, subsample)
+        for _, cell_df in pca_outlier_df.groupby(["Bundle", "Age_Group"], observed=True)
+    ]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        cell_atlases = list(executor.map(_score_cell, tasks))
+    atlas_df = pd.concat(cell_atlases)
+    # The scan and bundle names are stored as strings, so the lookups do not depend on the categories of the selection
+    atlas_df["Patient"] = atlas_df["Patient"].astype(str)
+    atlas_df["Bundle"] = atlas_df["Bundle"].astype(str)
+    atlas_df = atlas_df.set_index(["Patient", "Bundle"]).sort_index()
+    return atlas_df[ATLAS_COLUMNS + contribution_columns(q)]
+
+
+def lookup_outliers(atlas_df, pca_df):
+    """
+    Returns the rows of pca_df flagged as outliers in the atlas, in the same format as
+    outlier_detection.anomaly_detector_caller (with the Mahalanobis distance and the contributions of the components),
+    without running the detector
+    """
+    keys = pd.MultiIndex.from_arrays(
+        [pca_df["Patient"].astype(str), pca_df["Bundle"].astype(str)]
+    )
+    flags = atlas_df["Outlier"].reindex(keys, fill_value=False).values
+    score_columns = ["Mahalanobis_Distance"] + [
+        column for column in atlas_df.columns if column.endswith("_Contribution")
+    ]
+    scores_df = atlas_df[score_columns].reindex(keys[flags])
+    scores_df.index = pca_df.index[flags]
+    return pd.concat([pca_df[flags], scores_df], axis=1)
+
+
+def create_qc_report(atlas_df):
+    """
+    Creates the cohort-level QC report as an Excel file: a summary per bundle x age group, the flagged rows,
+    the number of flagged bundles per patient and the full atlas
+    Returns the bytes of the file
+    """
+    atlas_df = atlas_df.reset_index()
+    summary_df = atlas_df.groupby(["Bundle", "Age_Group"], observed=True).agg(
+        Rows=("Outlier", "size"),
+        Mahalanobis_Outliers=("Mahalanobis_Outlier", "sum"),
+        Outliers=("Outlier", "sum"),
+    )
+    summary_df["Outlier_Percentage"] = (
+        100.0 * summary_df["Outliers"] / summary_df["Rows"]
+    )
+    patients_df = (
+        atlas_df[atlas_df["Outlier"]]
+        .groupby(["Patient_ID", "Patient"])
+        .agg(Flagged_Bundles=("Bundle", "size"), Bundles=("Bundle", ", ".join))
+        .sort_values("Flagged_Bundles", ascending=False)
+    )
+
+    # Create a BytesIO object to store the Excel file
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        summary_df.to_excel(writer, sheet_name="summary", index=True)
+        patients_df.to_excel(writer, sheet_name="patients", index=True)
+        atlas_df[atlas_df["Outlier"]].to_excel(
+            writer, sheet_name="outliers", index=False
+        )
+        atlas_df.to_excel(writer, sheet_name="atlas", index=False)
+    return output.getvalue()
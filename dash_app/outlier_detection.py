@@ -1,30 +1,74 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
+from scipy import linalg, stats
 from sklearn.covariance import MinCovDet
+from sklearn.ensemble import IsolationForest
+from sklearn.kernel_approximation import Nystroem
+from sklearn.linear_model import SGDOneClassSVM
+from sklearn.metrics.pairwise import euclidean_distances
+from sklearn.pipeline import Pipeline
 from sklearn.svm import OneClassSVM
 
+import data_processing
+from constants import (
+    MCD_CACHE_MAX_ENTRIES,
+    MCD_SUBSAMPLE_ROWS,
+    NYSTROEM_OCSVM_COMPONENTS,
+    OUTLIER_SWEEP_MAX_ROWS,
+)
+
 
-def calculate_parameters_mcd(data):
+def calculate_parameters_mcd(
+    data, support_fraction=None, max_fit_rows=None, random_state=42
+):
     """
-    Calculate the mean vector and inverse covariance matrix using Minimum Covariance Determinant (MCD).
+    Calculate the mean vector and covariance matrix using Minimum Covariance Determinant (MCD).
+    The covariance matrix is not inverted, the distances are computed from its Cholesky factor (see mahalanobis_distances)
+    support_fraction is the fraction of points in the MCD support, None uses the default of scikit-learn
+    If max_fit_rows is given, the MCD is fitted on a random subsample of at most that many rows (for very large groups)
     """
-    mcd = MinCovDet().fit(data)
+    if max_fit_rows is not None and len(data) > max_fit_rows:
+        rng = np.random.default_rng(random_state)
+        data = data[rng.choice(len(data), max_fit_rows, replace=False)]
+    mcd = MinCovDet(support_fraction=support_fraction, random_state=random_state).fit(
+        data
+    )
     mean_vector = mcd.location_
     covariance_matrix = mcd.covariance_
+    return mean_vector, covariance_matrix
 
-    try:
-        inv_covariance_matrix = np.linalg.inv(
-            covariance_matrix
-        )  # Calculate the inverse of the covariance matrix
-    except np.linalg.LinAlgError:
-        print(
-            "Warning: Covariance matrix is singular. Using pseudoinverse instead."
-        )  # Handle singular covariance matrix
-        inv_covariance_matrix = np.linalg.pinv(
-            covariance_matrix
-        )  # Calculate the pseudoinverse of the covariance matrix
 
-    return mean_vector, inv_covariance_matrix
+def calculate_parameters_mcd_cached(
+    pca_df, pc_list, mcd_cache=None, support_fraction=None, subsample=False
+):
+    """
+    Same as calculate_parameters_mcd, but the fits are kept in mcd_cache, a dictionary stored server side by the app.
+    The key is a hash of the component values, so it covers the dataset, the filter, the bundle, the age group
+    and the number of components; changing only alpha or nu reuses the robust fit.
+    Returns the mean vector, the covariance matrix and the updated cache
+    """
+    if mcd_cache is None:
+        mcd_cache = {}
+    max_fit_rows = MCD_SUBSAMPLE_ROWS if subsample else None
+    key = data_processing.dataframe_fingerprint(
+        pca_df[pc_list], support_fraction, max_fit_rows
+    )
+    if key in mcd_cache:
+        # Move the entry to the end, so the least recently used fit is evicted first
+        mcd_cache[key] = mcd_cache.pop(key)
+        print("Reusing the cached MCD fit")
+    else:
+        mcd_cache[key] = calculate_parameters_mcd(
+            pca_df[pc_list].values, support_fraction, max_fit_rows
+        )
+        # Keep the cache bounded
+        while len(mcd_cache) > MCD_CACHE_MAX_ENTRIES:
+            del mcd_cache[next(iter(mcd_cache))]
+    mean_vector, covariance_matrix = mcd_cache[key]
+    return mean_vector, covariance_matrix, mcd_cache
 
 
 def MahalanobisDist(x, mean_vec, inv_covmat):
@@ -40,21 +84,115 @@ def MahalanobisDist(x, mean_vec, inv_covmat):
     return md
 
 
-def determine_threshold(md, alpha=0.01):
+def mahalanobis_distances(data, mean_vec, covariance_matrix):
+    """
+    Compute the Mahalanobis distances of all the data points in one batch.
+    With the Cholesky factorisation covariance = L L^T, the squared distance of x is ||L^-1 (x - mean)||^2,
+    so a single triangular solve for all the rows replaces the inversion of the covariance matrix.
+    """
+    diff = (
+        data - mean_vec
+    )  # Differences between the data points and the mean vector, one row per point
+    try:
+        cholesky_factor = linalg.cholesky(covariance_matrix, lower=True)
+        # Solve L z = diff^T for all the points at once, z has one column per point
+        z = linalg.solve_triangular(cholesky_factor, diff.T, lower=True)
+        squared_distances = np.einsum("ij,ij->j", z, z)
+    except linalg.LinAlgError:
+        print(
+            "Warning: Covariance matrix is singular. Using pseudoinverse instead."
+        )  # Handle singular covariance matrix
+        inv_covmat = np.linalg.pinv(covariance_matrix)
+        squared_distances = np.einsum("ij,jk,ik->i", diff, inv_covmat, diff)
+    # Rounding errors can make the squared distance slightly negative for points at the mean
+    return np.sqrt(np.maximum(squared_distances, 0))
+
+
+def mahalanobis_contributions(data, mean_vec, covariance_matrix):
+    """
+    Compute the contribution of each component to the squared Mahalanobis distance of each data point, in one batch.
+    The squared distance is the sum over the components k of diff_k * (covariance^-1 diff)_k, so the contributions
+    of a point add up to its squared distance (a contribution can be negative if the components are correlated).
+    covariance^-1 diff is obtained with two triangular solves against the Cholesky factor.
+    """
+    diff = data - mean_vec
+    try:
+        cholesky_factor = linalg.cholesky(covariance_matrix, lower=True)
+        z = linalg.solve_triangular(cholesky_factor, diff.T, lower=True)
+        precision_diff = linalg.solve_triangular(cholesky_factor.T, z, lower=False).T
+    except linalg.LinAlgError:
+        precision_diff = diff @ np.linalg.pinv(covariance_matrix)
+    return diff * precision_diff
+
+
+def measure_contributions(contributions_df, pca, measures):
+    """
+    Breaks the contributions of the principal components down to the original measures, through the PCA loadings.
+    The contribution of a component is shared between the measures in proportion to their squared loadings
+    (which add up to 1 for each component), so the contributions of the measures add up to the same squared distance.
+
+    Parameters:
+    - contributions_df (DataFrame): The PC{k}_Contribution columns, see anomaly_detector_scores.
+    - pca (PCA): The fitted outlier PCA.
+    - measures (list): The measures the PCA was fitted on.
+
+    Returns:
+    - DataFrame: One {measure}_Contribution column per measure, with the index of contributions_df.
+    """
+    q = contributions_df.shape[1]
+    squared_loadings = pca.components_[:q] ** 2  # components x measures
+    return pd.DataFrame(
+        contributions_df.values @ squared_loadings,
+        index=contributions_df.index,
+        columns=[f"{measure}_Contribution" for measure in measures],
+    )
+
+
+def add_measure_contributions(outlier_df, projection):
+    """
+    Adds the contributions of the measures (see measure_contributions) to outliers in the format of
+    anomaly_detector_caller, projection holds the outlier PCA and its measures (outlier-projection-store)
+    """
+    component_columns = [
+        column
+        for column in outlier_df.columns
+        if column.startswith("PC") and column.endswith("_Contribution")
+    ]
+    return pd.concat(
+        [
+            outlier_df,
+            measure_contributions(
+                outlier_df[component_columns],
+                projection["pca"],
+                projection["measures"],
+            ),
+        ],
+        axis=1,
+    )
+
+
+def determine_threshold(md, alpha=0.01, method="empirical", dof=None):
     """
     Determine the threshold for the Mahalanobis distance based on the desired alpha level.
-    This percentile is used to identify outliers in the data.
+    With the "empirical" method, the (1 - alpha) percentile of the distances is used to identify outliers in the data.
+    With the "chi2" method, the threshold is the (1 - alpha) quantile of the distance of Normal data with dof dimensions,
+    i.e. the square root of the chi-square quantile, so the number of outliers is not fixed in advance.
     """
-    threshold = np.percentile(md, 100 * (1 - alpha))
+    if method == "chi2":
+        if dof is None:
+            raise ValueError(
+                "The chi-square threshold requires the number of dimensions"
+            )
+        threshold = np.sqrt(stats.chi2.ppf(1 - alpha, dof))
+    else:
+        threshold = np.percentile(md, 100 * (1 - alpha))
     return threshold
 
 
-def detect_outliers(data, mean_vec, inv_covmat, threshold):
+def detect_outliers(m_distances, threshold):
     """
-    Detect outliers in the data based on the Mahalanobis distance and the threshold.
+    Detect outliers in the data based on the Mahalanobis distances (see mahalanobis_distances) and the threshold.
     """
-    # Calculate the Mahalanobis distance for each data point
-    m_distances = np.array([MahalanobisDist(x, mean_vec, inv_covmat) for x in data])
     # Determine the outliers based on the threshold
     outliers = m_distances > threshold
     return outliers
@@ -72,41 +210,387 @@ def pca_truncate_for_anomaly_detector(pca_df, bundle=None, age_group=None):
     return pca_df
 
 
-def anomaly_detector_caller(pca_df, q, alpha=0.01, nu=0.1):
+def fit_one_class_detector(engine, data, nu, random_state=42):
+    """
+    Fits the one-class detector of the second stage, on the data without the Mahalanobis outliers.
+    - "ocsvm": the exact OCSVM with an RBF kernel, its cost grows super-linearly with the number of rows
+    - "nystroem-sgd": Nystroem features of the same RBF kernel and a linear one-class SVM trained with SGD, linear cost
+    - "isolation-forest": an Isolation Forest with nu as the contamination
+    All the detectors have a decision_function which is negative for the outliers
+    """
+    if engine == "nystroem-sgd":
+        # Same kernel coefficient as gamma="scale" in the exact OCSVM
+        gamma = 1.0 / (data.shape[1] * data.var())
+        detector = Pipeline(
+            [
+                (
+                    "nystroem",
+                    Nystroem(
+                        gamma=gamma,
+                        n_components=min(NYSTROEM_OCSVM_COMPONENTS, len(data)),
+                        random_state=random_state,
+                    ),
+                ),
+                ("sgd", SGDOneClassSVM(nu=nu, random_state=random_state)),
+            ]
+        )
+    elif engine == "isolation-forest":
+        detector = IsolationForest(contamination=nu, random_state=random_state)
+    else:
+        detector = OneClassSVM(kernel="rbf", nu=nu)  # RBF kernel with nu hyperparameter
+    return detector.fit(data)
+
+
+def fit_one_class_engine(engine, fit_data, nu):
+    """
+    Fits the selected engine on fit_data, returns the list of fitted detectors.
+    In the "ensemble" mode, the three detectors are fitted concurrently in a thread pool.
+    """
+    if engine == "ensemble":
+        engines = ["ocsvm", "nystroem-sgd", "isolation-forest"]
+        with ThreadPoolExecutor(max_workers=len(engines)) as executor:
+            return list(
+                executor.map(
+                    lambda member: fit_one_class_detector(member, fit_data, nu),
+                    engines,
+                )
+            )
+    return [fit_one_class_detector(engine, fit_data, nu)]
+
+
+def engine_decision_function(detectors, data):
+    """
+    Scores data with the detectors of fit_one_class_engine, negative scores are outliers.
+    With several detectors, the score is the mean vote (+1 inlier, -1 outlier), so a row is an outlier if most detectors flag it.
+    Returns the scores, and the scores of each detector
+    """
+    member_scores = [detector.decision_function(data) for detector in detectors]
+    if len(member_scores) == 1:
+        return member_scores[0], member_scores
+    votes = np.mean([np.where(score < 0, -1, 1) for score in member_scores], axis=0)
+    return votes, member_scores
+
+
+def one_class_scores(engine, fit_data, data, nu, compare_exact=False):
+    """
+    Fits the selected engine on fit_data and scores data, negative scores are outliers.
+    Returns the scores, the scores of the exact OCSVM if they were computed (ensemble, or compare_exact)
+    and the fit time of the engine, without the comparison
+    """
+    start_time = time.perf_counter()
+    detectors = fit_one_class_engine(engine, fit_data, nu)
+    scores, member_scores = engine_decision_function(detectors, data)
+    fit_time = time.perf_counter() - start_time
+    # The exact OCSVM is the first member of the ensemble
+    if engine in ("ocsvm", "ensemble"):
+        return scores, member_scores[0], fit_time
+    if compare_exact:
+        exact_scores = fit_one_class_detector("ocsvm", fit_data, nu).decision_function(
+            data
+        )
+        return scores, exact_scores, fit_time
+    return scores, None, fit_time
+
+
+def anomaly_detector_scores(
+    pca_df,
+    q,
+    alpha=0.01,
+    nu=0.1,
+    threshold_method="empirical",
+    mcd_cache=None,
+    support_fraction=None,
+    subsample=False,
+    engine="ocsvm",
+    compare_exact=False,
+):
     """
-    Entry function to call the anomaly detector, which combines Mahalanobis distance and OCSVM.
+    Scores every row with the anomaly detector, which combines Mahalanobis distance and a one-class detector
+    (OCSVM by default, see fit_one_class_detector for the engines).
+    Returns a DataFrame aligned with pca_df, with the Mahalanobis distance, the Mahalanobis flag, the detector
+    score (negative for outliers) and the final outlier flag, the updated MCD cache (see calculate_parameters_mcd_cached),
+    and a dictionary with the engine, its fit time and its agreement with the exact OCSVM (if it was computed)
     """
 
     # List of principal components
     pc_list = [f"PC{i}" for i in range(1, q + 1)]
-    # Calculate parameters from the full data
+    # Calculate parameters from the full data, or reuse the cached robust fit
     pca_array = pca_df[pc_list].values
-    mean_vector, inv_covariance_matrix = calculate_parameters_mcd(pca_array)
-    # Calculate Mahalanobis distances and determine the threshold
-    md = np.array(
-        [MahalanobisDist(x, mean_vector, inv_covariance_matrix) for x in pca_array]
+    mean_vector, covariance_matrix, mcd_cache = calculate_parameters_mcd_cached(
+        pca_df, pc_list, mcd_cache, support_fraction, subsample
     )
-    threshold = determine_threshold(md, alpha=alpha)
+    # Calculate Mahalanobis distances once, and determine the threshold
+    md = mahalanobis_distances(pca_array, mean_vector, covariance_matrix)
+    threshold = determine_threshold(md, alpha=alpha, method=threshold_method, dof=q)
     # Detect outliers in the data using the Mahalanobis distance
-    test_outliers = detect_outliers(
-        pca_array, mean_vector, inv_covariance_matrix, threshold
-    )
+    test_outliers = detect_outliers(md, threshold)
 
     # Remove the Mahalanobis outliers from the data
     non_outliers = pca_df[~test_outliers]
 
-    # Train OCSVM on the data without the Mahalanobis outliers
-    ocsvm = OneClassSVM(kernel="rbf", nu=nu)  # RBF kernel with nu hyperparameter
-    ocsvm.fit(
-        non_outliers[pc_list]
-    )  # Fit the OCSVM on the non-outliers, using the principal components
-
-    # Predict outliers using the OCSVM
-    ocsvm_outliers = (
-        ocsvm.predict(pca_df[pc_list]) == -1
-    )  # Predict outliers using the OCSVM
-    outlier_indices = np.where(ocsvm_outliers)[0]  # Get the indices of the outliers
-    # Extract the outliers from the PCA DataFrame
-    outlier_df = pca_df.iloc[outlier_indices]
-
-    return outlier_df
+    # Train the detector on the data without the Mahalanobis outliers, and score all the rows
+    # The rows with a negative score are predicted as outliers
+    detector_scores, exact_scores, fit_time = one_class_scores(
+        engine,
+        non_outliers[pc_list].values,
+        pca_array,
+        nu,
+        compare_exact,
+    )
+    engine_info = {"engine": engine, "fit_time": fit_time, "agreement": None}
+    # Fraction of rows with the same flag as the exact OCSVM
+    if exact_scores is not None and engine != "ocsvm":
+        engine_info["agreement"] = float(
+            np.mean((detector_scores < 0) == (exact_scores < 0))
+        )
+
+    scores_df = pd.DataFrame(
+        {
+            "Mahalanobis_Distance": md,
+            "Mahalanobis_Outlier": test_outliers,
+            "Detector_Score": detector_scores,
+            "Outlier": detector_scores < 0,
+        },
+        index=pca_df.index,
+    )
+
+    # Contributions of the components to the squared Mahalanobis distance, only for the flagged rows
+    contributions = np.full((len(pca_df), q), np.nan)
+    outlier_rows = scores_df["Outlier"].values
+    contributions[outlier_rows] = mahalanobis_contributions(
+        pca_array[outlier_rows], mean_vector, covariance_matrix
+    )
+    for i, pc in enumerate(pc_list):
+        scores_df[f"{pc}_Contribution"] = contributions[:, i]
+    return scores_df, mcd_cache, engine_info
+
+
+def anomaly_detector_caller(
+    pca_df,
+    q,
+    alpha=0.01,
+    nu=0.1,
+    threshold_method="empirical",
+    mcd_cache=None,
+    support_fraction=None,
+    subsample=False,
+    engine="ocsvm",
+    compare_exact=False,
+):
+    """
+    Entry function to call the anomaly detector, which combines Mahalanobis distance and OCSVM (or another engine).
+    Returns the outliers (with their Mahalanobis distance and the contribution of each component to it),
+    the updated MCD cache (see calculate_parameters_mcd_cached) and the engine information
+    """
+    scores_df, mcd_cache, engine_info = anomaly_detector_scores(
+        pca_df,
+        q,
+        alpha,
+        nu,
+        threshold_method,
+        mcd_cache,
+        support_fraction,
+        subsample,
+        engine,
+        compare_exact,
+    )
+    # Extract the outliers from the PCA DataFrame, with their distance and the contributions of the components
+    outlier_rows = scores_df["Outlier"].values
+    contribution_columns = [f"PC{i}_Contribution" for i in range(1, q + 1)]
+    outlier_df = pd.concat(
+        [
+            pca_df[outlier_rows],
+            scores_df.loc[
+                outlier_rows, ["Mahalanobis_Distance"] + contribution_columns
+            ],
+        ],
+        axis=1,
+    )
+
+    return outlier_df, mcd_cache, engine_info
+
+
+def outlier_parameter_sweep(
+    pca_df,
+    q_values,
+    alpha_values,
+    nu_values,
+    threshold_method="empirical",
+    mcd_cache=None,
+    support_fraction=None,
+    subsample=False,
+    max_workers=None,
+):
+    """
+    Runs the Mahalanobis + exact OCSVM detector for every (q, alpha, nu) setting of a grid, in one call.
+    The robust MCD fit and the matrix of squared distances are computed once per q. For each (q, alpha), the RBF
+    kernel (same gamma="scale" as the OCSVM, computed on the Mahalanobis inliers) is computed once and shared by
+    all the values of nu, through OneClassSVM(kernel="precomputed"). The (q, alpha) pairs run in a thread pool.
+    The flags are the same as anomaly_detector_caller with the "ocsvm" engine.
+
+    Parameters:
+    - pca_df (DataFrame): The (truncated) outlier PCA data.
+    - q_values, alpha_values, nu_values (list): The values of the grid.
+    - threshold_method, mcd_cache, support_fraction, subsample: See anomaly_detector_scores.
+    - max_workers (int): The number of threads, defaults to the number of (q, alpha) pairs.
+
+    Returns:
+    - sweep_df (DataFrame): One row per setting, with the number and fraction of flagged rows.
+    - flags_df (DataFrame): The flags, one row per row of pca_df and one column per setting.
+    - mcd_cache (dict): The updated MCD cache.
+    """
+    if len(pca_df) > OUTLIER_SWEEP_MAX_ROWS:
+        raise ValueError(
+            f"The sweep is limited to {OUTLIER_SWEEP_MAX_ROWS} rows, select a bundle or an age group"
+        )
+
+    # Robust fits, distances and squared distance matrices, once per q (the MCD cache is not thread safe)
+    per_q = {}
+    for q in q_values:
+        pc_list = [f"PC{i}" for i in range(1, q + 1)]
+        pca_array = pca_df[pc_list].values
+        mean_vector, covariance_matrix, mcd_cache = calculate_parameters_mcd_cached(
+            pca_df, pc_list, mcd_cache, support_fraction, subsample
+        )
+        per_q[q] = (
+            pca_array,
+            mahalanobis_distances(pca_array, mean_vector, covariance_matrix),
+            euclidean_distances(pca_array, squared=True),
+        )
+
+    def sweep_q_alpha(q, alpha):
+        pca_array, md, squared_distances = per_q[q]
+        threshold = determine_threshold(md, alpha=alpha, method=threshold_method, dof=q)
+        inliers = ~detect_outliers(md, threshold)
+        # Kernel between all the rows and the inliers, the rows of the inliers are the training kernel
+        gamma = 1.0 / (q * pca_array[inliers].var())
+        kernel = np.exp(-gamma * squared_distances[:, inliers])
+        results = []
+        for nu in nu_values:
+            ocsvm = OneClassSVM(kernel="precomputed", nu=nu).fit(kernel[inliers])
+            results.append(((q, alpha, nu), ocsvm.decision_function(kernel) < 0))
+        return results
+
+    pairs = [(q, alpha) for q in q_values for alpha in alpha_values]
+    with ThreadPoolExecutor(max_workers=max_workers or len(pairs)) as executor:
+        pair_results = list(executor.map(lambda pair: sweep_q_alpha(*pair), pairs))
+
+    settings = [setting for results in pair_results for setting, _ in results]
+    flags_df = pd.DataFrame(
+        np.column_stack([flags for results in pair_results for _, flags in results]),
+        index=pca_df.index,
+        columns=pd.MultiIndex.from_tuples(settings, names=["q", "alpha", "nu"]),
+    )
+    sweep_df = pd.DataFrame(settings, columns=["q", "alpha", "nu"])
+    sweep_df["Outliers"] = flags_df.sum(axis=0).values
+    sweep_df["Outlier_Percentage"] = 100.0 * sweep_df["Outliers"] / len(pca_df)
+    return sweep_df, flags_df, mcd_cache
+
+
+def patient_level_scores(pca_df, q, alpha=0.025, n_steps=3):
+    """
+    Scores every scan over all the bundles at once, to answer which scans are bad overall.
+    The rows are arranged in a cube (scans x bundles x components), and a robust location and covariance is
+    estimated per bundle with a few vectorized reweighting steps: starting from the median, the rows beyond the
+    (1 - alpha) chi-square quantile are trimmed and the mean and covariance are recomputed from the remaining rows
+    (with the chi-square consistency factor). All the bundles are processed together with batched Cholesky solves,
+    so this is cheap enough to run after every selection, unlike one MCD fit per bundle.
+    The repeated scans of a subject (same Patient_ID) are scored separately, since one of them can be bad and not the others.
+
+    Parameters:
+    - pca_df (DataFrame): The outlier PCA data (one row per scan and bundle).
+    - q (int): The number of principal components to use.
+    - alpha (float): The significance level used to trim the rows and to flag the bundles.
+    - n_steps (int): The number of reweighting steps.
+
+    Returns:
+    - patient_df (DataFrame): One row per scan, with its subject, the maximum and mean robust distance over the bundles,
+      the number of flagged bundles and the number of bundles, ranked from the most to the least anomalous.
+    """
+    pc_list = [f"PC{i}" for i in range(1, q + 1)]
+    # One row of the cube per scan (Patient), not per subject, so repeated scans do not overwrite each other
+    patients, patient_codes = np.unique(
+        pca_df["Patient"].astype(str).values, return_inverse=True
+    )
+    bundles, bundle_codes = np.unique(
+        pca_df["Bundle"].astype(str).values, return_inverse=True
+    )
+
+    # Cube of the components, NaN where a scan has no row for a bundle
+    cube = np.full((len(patients), len(bundles), q), np.nan)
+    cube[patient_codes, bundle_codes] = pca_df[pc_list].values
+    present = ~np.isnan(cube[:, :, 0])
+    # Bundles with too few patients for a covariance estimate are not scored
+    present &= present.sum(axis=0)[None, :] > 2 * q
+    cube_filled = np.where(present[:, :, None], cube, 0.0)
+
+    cutoff = stats.chi2.ppf(1 - alpha, q)
+    # Consistency factor of the covariance of the rows within the cutoff, for Normal data
+    consistency = (1 - alpha) / stats.chi2.cdf(cutoff, q + 2)
+
+    def squared_distances(location, covariance):
+        # Batched Cholesky factors, one per bundle, and one solve for all the patients of each bundle
+        # The identity is used for the bundles that are not scored, and a tiny ridge keeps the others positive definite
+        covariance = np.where(
+            present.any(axis=0)[:, None, None], covariance, np.eye(q)[None]
+        )
+        covariance = (
+            covariance
+            + 1e-10
+            * np.trace(covariance, axis1=1, axis2=2)[:, None, None]
+            * np.eye(q)[None]
+        )
+        cholesky_factors = np.linalg.cholesky(covariance)
+        diff = (cube_filled - location[None]).transpose(
+            1, 2, 0
+        )  # bundles x components x patients
+        z = np.linalg.solve(cholesky_factors, diff)
+        return np.einsum("bip,bip->pb", z, z)
+
+    # Start from the median and the covariance around it, then reweight
+    location = np.nan_to_num(
+        np.nanmedian(np.where(present[:, :, None], cube, np.nan), axis=0)
+    )
+    weights = present.astype(float)
+    for step in range(n_steps + 1):
+        if step > 0:
+            weights = present & (md2 <= cutoff)
+            weights = weights.astype(float)
+            location = (
+                np.einsum("pb,pbi->bi", weights, cube_filled)
+                / np.maximum(weights.sum(axis=0), 1)[:, None]
+            )
+        diff = cube_filled - location[None]
+        covariance = (
+            np.einsum("pb,pbi,pbj->bij", weights, diff, diff)
+            / np.maximum(weights.sum(axis=0) - 1, 1)[:, None, None]
+        )
+        if step > 0:
+            covariance *= consistency
+        md2 = squared_distances(location, covariance)
+
+    md = np.where(present, np.sqrt(np.maximum(md2, 0)), np.nan)
+    flagged = present & (md2 > cutoff)
+
+    patient_df = pd.DataFrame(
+        {
+            "Patient": patients,
+            "Max_Distance": np.nanmax(md, axis=1),
+            "Mean_Distance": np.nanmean(md, axis=1),
+            "Flagged_Bundles": flagged.sum(axis=1),
+            "Bundles": present.sum(axis=1),
+        }
+    )
+    # Keep the subject of every scan
+    patient_df.insert(
+        1,
+        "Patient_ID",
+        pca_df.assign(Patient=pca_df["Patient"].astype(str))
+        .drop_duplicates("Patient")
+        .set_index("Patient")
+        .loc[patients, "Patient_ID"]
+        .values,
+    )
+    return patient_df.sort_values(
+        ["Flagged_Bundles", "Max_Distance"], ascending=False
+    ).reset_index(drop=True)
@@ -0,0 +1,205 @@
+import argparse
+import base64
+import datetime
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+
+import data_loading
+import data_processing
+import outlier_detection
+from constants import OUTLIER_MODEL_DIR, OUTLIER_MODEL_VERSION
+
+# Identifier columns copied to the scores of new scans
+ID_COLUMNS = ["Patient", "Patient_ID", "Bundle", "Sex", "Age", "Age_Group"]
+
+
+def fit_outlier_model(
+    pca_df,
+    projection,
+    q,
+    alpha=0.01,
+    nu=0.1,
+    threshold_method="empirical",
+    engine="ocsvm",
+    bundle=None,
+    age_group=None,
+    mcd_cache=None,
+    support_fraction=None,
+    subsample=False,
+):
+    """
+    Fits the outlier detector on a reference population and packs everything needed to score new scans.
+
+    Parameters:
+    - pca_df (DataFrame): The outlier PCA data of the reference population (pca-outlier-store).
+    - projection (dict): The measures, scaler and PCA that produced pca_df (outlier-projection-store).
+    - q (int): The number of principal components to use.
+    - alpha, nu, threshold_method, engine: The parameters of the detector, see outlier_detection.anomaly_detector_scores.
+    - bundle, age_group: The bundle and age group the reference population is restricted to, None for all.
+    - mcd_cache, support_fraction, subsample: See outlier_detection.calculate_parameters_mcd_cached.
+
+    Returns:
+    - model (dict): The versioned model artifact.
+    - mcd_cache (dict): The updated MCD cache.
+    """
+    pca_df = outlier_detection.pca_truncate_for_anomaly_detector(
+        pca_df, bundle, age_group
+    )
+    pc_list = [f"PC{i}" for i in range(1, q + 1)]
+    pca_array = pca_df[pc_list].values
+
+    # Robust location and covariance, the precision matrix is stored so a scan is scored with a single product
+    location, covariance, mcd_cache = outlier_detection.calculate_parameters_mcd_cached(
+        pca_df, pc_list, mcd_cache, support_fraction, subsample
+    )
+    md = outlier_detection.mahalanobis_distances(pca_array, location, covariance)
+    threshold = outlier_detection.determine_threshold(
+        md, alpha=alpha, method=threshold_method, dof=q
+    )
+    non_outliers = pca_array[~outlier_detection.detect_outliers(md, threshold)]
+    detectors = outlier_detection.fit_one_class_engine(engine, non_outliers, nu)
+
+    model = {
+        "version": OUTLIER_MODEL_VERSION,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        # Hash of the reference population, to trace which data a model was fitted on
+        "reference_key": data_processing.dataframe_fingerprint(pca_df[pc_list]),
+        "n_reference": len(pca_df),
+        "bundle": bundle,
+        "age_group": age_group,
+        "parameters": {
+            "q": q,
+            "alpha": alpha,
+            "nu": nu,
+            "threshold_method": threshold_method,
+            "engine": engine,
+        },
+        "measures": projection["measures"],
+        "scaler": projection["scaler"],
+        "pca": projection["pca"],
+        "location": location,
+        "precision": np.linalg.pinv(covariance),
+        "threshold": threshold,
+        "detectors": detectors,
+    }
+    return model, mcd_cache
+
+
+def save_outlier_model(model, directory=OUTLIER_MODEL_DIR):
+    """
+    Saves the model artifact with joblib, the file name holds the format version, the creation time
+    and the start of the reference key, so successive models do not overwrite each other
+    Returns the path of the file
+    """
+    os.makedirs(directory, exist_ok=True)
+    created = model["created"].replace(":", "").replace("-", "")
+    file_name = f"outlier_model_v{model['version']}_{created}_{model['reference_key'][:8]}.joblib"
+    path = os.path.join(directory, file_name)
+    joblib.dump(model, path)
+    return path
+
+
+def load_outlier_model(path):
+    """
+    Loads a model artifact saved by save_outlier_model, and checks its format version
+    """
+    model = joblib.load(path)
+    check_model_version(model)
+    return model
+
+
+def check_model_version(model):
+    """
+    Raises a ValueError if the model artifact was saved with another format version
+    """
+    if model.get("version") != OUTLIER_MODEL_VERSION:
+        raise ValueError(
+            f"Unsupported outlier model version {model.get('version')}, expected {OUTLIER_MODEL_VERSION}"
+        )
+
+
+def score_new_scans(model, df):
+    """
+    Scores new scans against the reference population of the model, without refitting anything.
+    The scans are projected with the stored scaler and PCA, then scored with the stored MCD estimates and detectors.
+    Rows outside the bundle and age group of the model, or with missing measures, are not scored.
+
+    Parameters:
+    - model (dict): The model artifact, see fit_outlier_model.
+    - df (DataFrame): The new scans, in the format of data_loading.transform_mat_to_df.
+
+    Returns:
+    - scores_df (DataFrame): The identifiers, the Mahalanobis distance and flag, the detector score and the outlier flag.
+    """
+    check_model_version(model)
+    missing = [measure for measure in model["measures"] if measure not in df.columns]
+    if missing:
+        raise ValueError(f"The new scans do not have the measures {missing}")
+    df = outlier_detection.pca_truncate_for_anomaly_detector(
+        df, model["bundle"], model["age_group"]
+    )
+    df = df.dropna(subset=model["measures"])
+    q = model["parameters"]["q"]
+
+    # Same projection as dim_reduction_backend.run_outlier_pca_backend, restricted to the q components used
+    features = model["scaler"].transform(df[model["measures"]])
+    components = model["pca"].transform(features)[:, :q]
+
+    diff = components - model["location"]
+    md = np.sqrt(
+        np.maximum(np.einsum("ij,jk,ik->i", diff, model["precision"], diff), 0)
+    )
+    detector_scores, _ = outlier_detection.engine_decision_function(
+        model["detectors"], components
+    )
+
+    scores_df = df[[column for column in ID_COLUMNS if column in df.columns]].copy()
+    scores_df["Mahalanobis_Distance"] = md
+    scores_df["Mahalanobis_Outlier"] = md > model["threshold"]
+    scores_df["Detector_Score"] = detector_scores
+    scores_df["Outlier"] = detector_scores < 0
+    return scores_df
+
+
+def load_scans(path):
+    """
+    Loads new scans from a MATLAB file (same keys as the uploaded data) or from a CSV file with the same columns
+    """
+    if path.endswith(".csv"):
+        return pd.read_csv(path)
+    with open(path, "rb") as file:
+        contents = "data:application/octet-stream;base64," + base64.b64encode(
+            file.read()
+        ).decode("ascii")
+    return data_loading.transform_mat_to_df(*data_loading.load_data(contents))
+
+
+def main(argv=None):
+    """
+    Command line entry point, used as a QC gate when new scans are ingested:
+        python outlier_model.py model.joblib new_scans.mat --output scores.csv
+    The exit code is 1 if any scan is flagged as an outlier
+    """
+    parser = argparse.ArgumentParser(
+        description="Score new scans against a saved outlier model"
+    )
+    parser.add_argument("model", help="Path of the saved outlier model (.joblib)")
+    parser.add_argument("scans", help="Path of the new scans (.mat or .csv)")
+    parser.add_argument("--output", help="Path of the CSV file for the scores")
+    args = parser.parse_args(argv)
+
+    model = load_outlier_model(args.model)
+    scores_df = score_new_scans(model, load_scans(args.scans))
+    if args.output:
+        scores_df.to_csv(args.output, index=False)
+    else:
+        print(scores_df.to_string(index=False))
+    print(f"{int(scores_df['Outlier'].sum())} of {len(scores_df)} scans flagged")
+    return 1 if scores_df["Outlier"].any() else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,206 @@
+import numpy as np
+import pandas as pd
+
+from constants import PERMUTATION_TEST_BATCH_SIZE, PERMUTATION_TEST_PERMUTATIONS
+from principal_components_age_corr_regression_viz import SplineBasis
+
+
+def _effect_statistics(Y_residuals, rss_reduced, T, Q_nuisance, n_nuisance):
+    """
+    F statistics of the tested columns T for all the responses at once, for a batch of permuted versions of T
+
+    Parameters:
+    - Y_residuals (array): The responses residualized on the nuisance design, (n, m).
+    - rss_reduced (array): The residual sum of squares of the reduced model, (m,).
+    - T (array): The tested columns of every permutation, (b, n, r).
+    - Q_nuisance (array): The orthonormal basis of the nuisance design, (n, q).
+    - n_nuisance (int): The number of nuisance columns, q.
+
+    Returns:
+    - F (array): The F statistics, (b, m).
+    """
+    n, r = T.shape[1], T.shape[2]
+    # Residualize the tested columns on the nuisance design, the effect sum of squares is the projection on them
+    # Batched matrix products (matmul broadcasts over the permutations and uses BLAS)
+    T_residuals = T - Q_nuisance @ (Q_nuisance.T @ T)
+    Q_effect, _ = np.linalg.qr(T_residuals)
+    ss_effect = np.sum((Q_effect.transpose(0, 2, 1) @ Y_residuals) ** 2, axis=1)
+    rss_full = rss_reduced - ss_effect
+    return (ss_effect / r) / (rss_full / (n - n_nuisance - r))
+
+
+def _test_columns(Y, age_basis, sex, rows, permutations, batch_size):
+    """
+    Observed and permuted F statistics of the age and sex effects, for responses that share their rows
+    The age effect is the spline of age, given sex, the sex effect is sex, given the spline of age
+    Without sex (a single sex in the data) only the age effect is tested
+    The permutations are applied to all the subjects, a row takes the covariate of its permuted subject,
+    so the basis of age is only indexed, never rebuilt
+    """
+    intercept = np.ones((len(rows), 1))
+    if sex is None:
+        tests = [("Age", intercept, age_basis)]
+    else:
+        tests = [
+            ("Age", np.hstack([intercept, sex[rows]]), age_basis),
+            ("Sex", np.hstack([intercept, age_basis[rows]]), sex),
+        ]
+    statistics = {}
+    for effect, nuisance, tested in tests:
+        Q_nuisance, _ = np.linalg.qr(nuisance)
+        Y_residuals = Y - Q_nuisance @ (Q_nuisance.T @ Y)
+        rss_reduced = np.sum(Y_residuals**2, axis=0)
+        observed = _effect_statistics(
+            Y_residuals, rss_reduced, tested[rows][None], Q_nuisance, nuisance.shape[1]
+        )[0]
+        permuted = np.concatenate(
+            [
+                _effect_statistics(
+                    Y_residuals,
+                    rss_reduced,
+                    tested[permutations[start : start + batch_size][:, rows]],
+                    Q_nuisance,
+                    nuisance.shape[1],
+                )
+                for start in range(0, len(permutations), batch_size)
+            ]
+        )
+        statistics[effect] = (observed, permuted)
+    return statistics
+
+
+def _subject_permutations(subjects, n_permutations, rng):
+    """
+    Permutations of the rows that move the subjects as blocks, so the repeated scans of a subject stay together:
+    the rows of a subject take the covariates of the rows of another subject with the same number of rows, in the same order
+    (subjects with a different number of rows are not exchangeable). With one row per subject, these are permutations of the rows
+
+    Parameters:
+    - subjects (array): The subject of every row, the rows of a subject in the order of their covariates.
+    - n_permutations (int): The number of permutations.
+    - rng (Generator): The random generator.
+
+    Returns:
+    - permutations (array): For every permutation, the row whose covariates every row takes, (n_permutations, n).
+    """
+    codes, _ = pd.factorize(subjects)
+    # Rows grouped by subject, and the first of them of every subject
+    order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    blocks = [(size, np.flatnonzero(counts == size)) for size in np.unique(counts)]
+    permutations = np.empty((n_permutations, len(subjects)), dtype=int)
+    for permutation in permutations:
+        for size, block_subjects in blocks:
+            shuffled = rng.permutation(block_subjects)
+            target = order[starts[block_subjects][:, None] + np.arange(size)]
+            source = order[starts[shuffled][:, None] + np.arange(size)]
+            permutation[target.ravel()] = source.ravel()
+    return permutations
+
+
+def permutation_test(
+    df,
+    response_vars,
+    predictor_var="Age",
+    bundle_var="Bundle",
+    knots=None,
+    degree=3,
+    n_permutations=PERMUTATION_TEST_PERMUTATIONS,
+    batch_size=PERMUTATION_TEST_BATCH_SIZE,
+    random_state=42,
+):
+    """
+    Permutation test of the age and sex effects on every response of every bundle, with family-wise error correction.
+    The same permutations of the subjects are used for all the bundles and responses, and the F statistics of each batch
+    of permutations are computed for all of them at once with batched matrix products. The corrected p-values compare
+    each statistic with the permutation distribution of the maximum statistic over all bundles and responses (max-statistic FWER).
+
+    Parameters:
+    - df (DataFrame): The data, one row per scan and bundle, with Patient_ID, Sex, the predictor and the responses.
+      A subject can have several scans, at the same or different ages, they are permuted together.
+    - response_vars (list): The responses, e.g. the PCs.
+    - predictor_var (str): The predictor variable.
+    - bundle_var (str): The bundle variable.
+    - knots (list): The knots of the age spline, defaults to the 25th, 50th and 75th percentiles.
+    - degree (int): The degree of the age spline.
+    - n_permutations (int): The number of permutations.
+    - batch_size (int): The number of permutations computed at once.
+    - random_state (int): The seed of the permutations.
+
+    Returns:
+    - results_df (DataFrame): One row per bundle, response and effect, with the F statistic,
+      the uncorrected and the FWER-corrected permutation p-values.
+    """
+    # Wide format, one row per scan and one column per (bundle, response)
+    # Repeated scans of a subject at the same age are numbered, as in BatchedSplineRegression, so each one gets its own row
+    index_columns = ["Patient_ID", predictor_var, "Sex"]
+    scan = (
+        df.groupby(index_columns + [bundle_var], sort=False, dropna=False)
+        .cumcount()
+        .rename("Scan")
+    )
+    wide_df = df.set_index(index_columns + [scan, bundle_var])[response_vars].unstack(
+        bundle_var
+    )
+    wide_df.columns = wide_df.columns.swaplevel(0, 1)
+    x = wide_df.index.get_level_values(predictor_var).to_numpy(dtype=float)
+    sex_levels = wide_df.index.get_level_values("Sex")
+    sex = (
+        (sex_levels == sex_levels.unique()[0]).astype(float)[:, None]
+        if sex_levels.nunique() > 1
+        else None
+    )
+    effects = ["Age", "Sex"] if sex is not None else ["Age"]
+    y = wide_df.to_numpy(dtype=float)
+
+    # One basis on the ages of all the scans, permuting the subjects permutes its rows
+    age_basis = SplineBasis(x, knots, degree).basis_functions(x)[:, 1:]
+    rng = np.random.default_rng(random_state)
+    # The rows of a subject are sorted by age (the wide format is sorted), they are permuted as one block
+    permutations = _subject_permutations(
+        wide_df.index.get_level_values("Patient_ID"), n_permutations, rng
+    )
+
+    # Columns with the same missing values share their rows, the permutations are the same for all of them
+    observed_rows = ~np.isnan(y)
+    _, pattern_ids = np.unique(observed_rows, axis=1, return_inverse=True)
+    pattern_ids = pattern_ids.ravel()
+    observed = {effect: np.full(y.shape[1], np.nan) for effect in effects}
+    permuted = {
+        effect: np.full((n_permutations, y.shape[1]), np.nan) for effect in effects
+    }
+    for pattern_id in np.unique(pattern_ids):
+        columns = np.flatnonzero(pattern_ids == pattern_id)
+        rows = np.flatnonzero(observed_rows[:, columns[0]])
+        if len(rows) <= age_basis.shape[1] + 3:
+            continue
+        statistics = _test_columns(
+            y[np.ix_(rows, columns)], age_basis, sex, rows, permutations, batch_size
+        )
+        for effect, (effect_observed, effect_permuted) in statistics.items():
+            observed[effect][columns] = effect_observed
+            permuted[effect][:, columns] = effect_permuted
+
+    results = []
+    for effect in effects:
+        # Maximum statistic over all bundles and responses, for every permutation
+        max_statistics = np.nanmax(permuted[effect], axis=1)
+        for j, (bundle, response) in enumerate(wide_df.columns):
+            if np.isnan(observed[effect][j]):
+                continue
+            results.append(
+                {
+                    "Bundle": bundle,
+                    "Response": response,
+                    "Effect": effect,
+                    "F": observed[effect][j],
+                    "P_Value": (
+                        1 + np.sum(permuted[effect][:, j] >= observed[effect][j])
+                    )
+                    / (1 + n_permutations),
+                    "P_Value_FWER": (1 + np.sum(max_statistics >= observed[effect][j]))
+                    / (1 + n_permutations),
+                }
+            )
+    return pd.DataFrame(results)
@@ -1,12 +1,107 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
 import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 import statsmodels.api as sm
-from patsy import dmatrix
-from sklearn.metrics import r2_score
+from scipy import linalg, stats
+from sklearn.model_selection import GroupKFold
 
 import auxiliary_functions
+from constants import (
+    BOOTSTRAP_BATCH_SIZE,
+    BOOTSTRAP_RESAMPLES,
+    KNOT_SELECTION_DEGREES,
+    KNOT_SELECTION_FOLDS,
+    KNOT_SELECTION_MAX_KNOTS,
+    KNOT_SELECTION_TIME_BUDGET,
+)
+
+
+class SplineBasis:
+    # B-spline basis of a predictor, with fixed knots and boundaries
+    # The basis is built once per knot set and reused for fitting and for the prediction grid
+    # It is the same basis as patsy's bs(x, knots, degree, include_intercept=False), plus the intercept column
+    def __init__(self, x, knots=None, degree=3, lower_bound=None, upper_bound=None):
+        x = np.asarray(x, dtype=float)
+        self.degree = degree
+        # The knots default to the 25th, 50th and 75th percentiles, the boundaries to the range of the data
+        self.knots = np.asarray(
+            knots if knots is not None else np.percentile(x, [25, 50, 75]),
+            dtype=float,
+        )
+        self.lower_bound = x.min() if lower_bound is None else lower_bound
+        self.upper_bound = x.max() if upper_bound is None else upper_bound
+        # Same checks as patsy's bs, a knot outside of the boundaries would give a degenerate basis
+        if np.any(self.knots < self.lower_bound):
+            raise ValueError(
+                f"some knot values ({self.knots[self.knots < self.lower_bound]}) fall below lower bound ({self.lower_bound})"
+            )
+        if np.any(self.knots > self.upper_bound):
+            raise ValueError(
+                f"some knot values ({self.knots[self.knots > self.upper_bound]}) fall above upper bound ({self.upper_bound})"
+            )
+        # Full knot vector, the boundary knots are repeated degree + 1 times
+        self.all_knots = np.concatenate(
+            [
+                [self.lower_bound] * (degree + 1),
+                np.sort(self.knots),
+                [self.upper_bound] * (degree + 1),
+            ]
+        )
+        self.n_basis = len(self.all_knots) - degree - 1
+
+    @property
+    def column_names(self):
+        # Names of the columns of the design matrix
+        return ["Intercept"] + [f"bs[{i}]" for i in range(self.n_basis - 1)]
+
+    def basis_functions(self, x):
+        """
+        Evaluates all the B-spline basis functions at x with the Cox-de Boor recursion.
+        Only the degree + 1 functions that are non-zero in the knot span of each point are computed,
+        points outside of the boundaries use the polynomial of the closest span (extrapolation).
+
+        Parameters:
+        - x (array): The values of the predictor.
+
+        Returns:
+        - basis (array): The basis functions, of shape (len(x), n_basis).
+        """
+        x = np.asarray(x, dtype=float)
+        t = self.all_knots
+        k = self.degree
+        # Index of the knot span of each point, the upper boundary belongs to the last span
+        span = np.clip(np.searchsorted(t, x, side="right") - 1, k, self.n_basis - 1)
+
+        # Triangular recursion, N[:, j] is the basis function span - k + j
+        N = np.zeros((len(x), k + 1))
+        N[:, 0] = 1.0
+        left = np.zeros((len(x), k + 1))
+        right = np.zeros((len(x), k + 1))
+        for j in range(1, k + 1):
+            left[:, j] = x - t[span + 1 - j]
+            right[:, j] = t[span + j] - x
+            saved = np.zeros(len(x))
+            for r in range(j):
+                denominator = right[:, r + 1] + left[:, j - r]
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    temp = np.where(denominator != 0, N[:, r] / denominator, 0.0)
+                N[:, r] = saved + right[:, r + 1] * temp
+                saved = left[:, j - r] * temp
+            N[:, j] = saved
+
+        basis = np.zeros((len(x), self.n_basis))
+        rows = np.arange(len(x))[:, None]
+        basis[rows, span[:, None] - k + np.arange(k + 1)] = N
+        return basis
+
+    def design_matrix(self, x):
+        # Design matrix of the regression: intercept and the basis without its first function
+        basis = self.basis_functions(x)
+        return np.column_stack([np.ones(len(basis)), basis[:, 1:]])
 
 
 class SplineRegression:
@@ -54,50 +149,191 @@ class SplineRegression:
     def _fit_models_by_variable(self):
         # Fit models by variable
         self.models = {}  # Initialize an empty dictionary to store the models
+        self.bases = {}  # The spline basis of every model, reused for the predictions
+        self.diagnostics = {"R2": {}, "p-values": {}}
         for level in self.df[
             self.by_variable
         ].unique():  # Iterate over the unique levels of the by_variable
             sub_df = self.df[
                 self.df[self.by_variable] == level
             ]  # Subset the data by the level of the by_variable
-            self.models[level] = self._fit_model(
-                sub_df
+            self.models[level], self.bases[level] = self._fit_model(
+                sub_df, level
             )  # Fit a model to the subset of data
+            self._set_diagnostics(level)
 
     def _fit_single_model(self):
-        self.models = {
-            "Overall": self._fit_model(self.df)
-        }  # Fit a single model to the entire data
+        # Fit a single model to the entire data
+        self.models = {}
+        self.bases = {}
+        self.diagnostics = {"R2": {}, "p-values": {}}
+        self.models["Overall"], self.bases["Overall"] = self._fit_model(
+            self.df, "Overall"
+        )
+        self._set_diagnostics("Overall")
 
-    def _fit_model(self, data):
-        design_matrix = dmatrix(  # Create a design matrix for the spline regression, using the predictor variable, knots, and degree
-            f"bs({self.predictor_var}, knots={tuple(self.knots)}, degree={self.degree}, include_intercept=False)",
-            data,
-            return_type="dataframe",
+    def _fit_model(self, data, level):
+        # Create the spline basis for the regression, using the predictor variable, knots, and degree
+        # The knots and degree can be given per level of the by_variable, as dictionaries (see select_knots_cv)
+        # The basis keeps the boundaries of the data, so the predictions use the same basis as the fit
+        knots = self.knots[level] if isinstance(self.knots, dict) else self.knots
+        degree = self.degree[level] if isinstance(self.degree, dict) else self.degree
+        basis = SplineBasis(data[self.predictor_var], knots, degree)
+        design_matrix = pd.DataFrame(
+            basis.design_matrix(data[self.predictor_var]),
+            index=data.index,
+            columns=basis.column_names,
         )
         response_var = data[self.response_var]
         if self.method == "GLM":
             model = sm.GLM(
                 response_var, design_matrix
             ).fit()  # Fit a Generalized Linear Model (GLM) to the data
-        return model
+        return model, basis
+
+    def _set_diagnostics(self, level):
+        # Diagnostics are calculated once, when the model is fitted
+        model = self.models[level]
+        residuals = model.model.endog - model.fittedvalues
+        centered = model.model.endog - model.model.endog.mean()
+        self.diagnostics["R2"][level] = 1 - np.sum(residuals**2) / np.sum(
+            centered**2
+        )  # Calculate the R-squared value for the model
+        self.diagnostics["p-values"][level] = model.pvalues  # Get the p-values
 
     def calculate_diagnostics(self):
-        # Calculate diagnostics for the models
-        r2 = {}
-        p_values = {}
-        for level, model in self.models.items():  # Iterate over the models
-            if self.by_variable:
-                data_subset = self.df[
-                    self.df[self.by_variable] == level
-                ]  # Subset the data by the level of the by_variable
-            else:
-                data_subset = self.df  # Use the entire data if there is no by_variable
-            r2[level] = r2_score(
-                data_subset[self.response_var], model.predict()
-            )  # Calculate the R-squared value for the model
-            p_values[level] = model.pvalues  # Get the p-values for the model
-        return {"R2": r2, "p-values": p_values}
+        # Diagnostics of the models, calculated when they were fitted
+        return self.diagnostics
+
+    def predict(self, level, x, alpha=0.05):
+        """
+        Predicts the response of one model on new values of the predictor, with the confidence interval of the mean.
+        The interval is the quadratic form of the design matrix with the covariance of the coefficients,
+        evaluated for all the points at once.
+
+        Parameters:
+        - level: The level of the by_variable ("Overall" without by_variable).
+        - x (array): The values of the predictor.
+        - alpha (float): The significance level of the confidence interval.
+
+        Returns:
+        - y (array): The predictions.
+        - ci_lower, ci_upper (array): The bounds of the confidence interval.
+        """
+        model = self.models[level]
+        design_matrix = self.bases[level].design_matrix(x)
+        y = design_matrix @ np.asarray(model.params)
+        standard_error = np.sqrt(
+            np.einsum(
+                "ij,jk,ik->i",
+                design_matrix,
+                np.asarray(model.cov_params()),
+                design_matrix,
+            )
+        )
+        z = stats.norm.ppf(1 - alpha / 2)
+        return y, y - z * standard_error, y + z * standard_error
+
+    def prediction_grid(self):
+        # Grid of the predictor the fitted lines are drawn on
+        return np.linspace(
+            self.df[self.predictor_var].min(),
+            self.df[self.predictor_var].max(),
+            500,
+        )
+
+    def _level_data(self, level):
+        # The data of one model
+        if self.by_variable:
+            return self.df[self.df[self.by_variable] == level]
+        return self.df
+
+    def _bootstrap_batch(self, level, X, y, row_groups, n_groups, batch_size, seed):
+        """
+        Fits batch_size subject-level bootstrap resamples of one model, and predicts them on the grid
+        Resampling the subjects is done with weights, each row is weighted by the number of times its subject is drawn,
+        so the design matrix of the fit is reused and the resamples are solved as one batch of normal equations
+        """
+        rng = np.random.default_rng(seed)
+        draws = rng.integers(0, n_groups, size=(batch_size, n_groups))
+        counts = np.stack([np.bincount(draw, minlength=n_groups) for draw in draws])
+        weights = counts[:, row_groups]
+        XtWX = np.einsum("bn,ni,nj->bij", weights, X, X)
+        XtWy = weights @ (X * y[:, None])
+        # pinv, so resamples with too few distinct ages do not fail
+        coefficients = np.einsum("bij,bj->bi", np.linalg.pinv(XtWX), XtWy)
+        return level, coefficients @ self._grid_design_matrices[level].T
+
+    def bootstrap_bands(
+        self,
+        n_resamples=BOOTSTRAP_RESAMPLES,
+        alpha=0.05,
+        batch_size=BOOTSTRAP_BATCH_SIZE,
+        group_var="Patient_ID",
+        max_workers=None,
+        random_state=42,
+    ):
+        """
+        Subject-level bootstrap of the fitted models, the batches of resamples run in parallel threads.
+        It is a generator, the percentile bands are yielded every time a batch finishes, so they can be shown while the rest runs.
+        The spline basis of each model is built once, only the subjects are resampled.
+
+        Parameters:
+        - n_resamples (int): The number of resamples of every model.
+        - alpha (float): The significance level of the bands.
+        - batch_size (int): The number of resamples per batch.
+        - group_var (str): The column identifying the subjects.
+        - max_workers (int): The number of threads.
+        - random_state (int): The seed of the resamples.
+
+        Yields:
+        - n_done (int): The number of resamples done, over all the models.
+        - bands (dict): For every level, the lower and upper bands on prediction_grid().
+        """
+        x_range = self.prediction_grid()
+        self._grid_design_matrices = {
+            level: self.bases[level].design_matrix(x_range) for level in self.models
+        }
+        tasks = []
+        seeds = np.random.SeedSequence(random_state)
+        for level in self.models:
+            data = self._level_data(level)
+            X = self.bases[level].design_matrix(data[self.predictor_var])
+            y = data[self.response_var].to_numpy(dtype=float)
+            # Index of the subject of each row, the subjects are resampled rather than the rows
+            row_groups, groups = pd.factorize(data[group_var])
+            n_batches = int(np.ceil(n_resamples / batch_size))
+            for i, seed in enumerate(seeds.spawn(n_batches)):
+                tasks.append(
+                    (
+                        level,
+                        X,
+                        y,
+                        row_groups,
+                        len(groups),
+                        min(batch_size, n_resamples - i * batch_size),
+                        seed,
+                    )
+                )
+
+        predictions = {level: [] for level in self.models}
+        n_done = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._bootstrap_batch, *task) for task in tasks]
+            for future in as_completed(futures):
+                level, batch_predictions = future.result()
+                predictions[level].append(batch_predictions)
+                n_done += len(batch_predictions)
+                bands = {
+                    level: np.percentile(
+                        np.concatenate(level_predictions),
+                        [100 * alpha / 2, 100 * (1 - alpha / 2)],
+                        axis=0,
+                    )
+                    for level, level_predictions in predictions.items()
+                    if level_predictions
+                }
+                yield n_done, bands
 
     def fit_model_to_df(self):
         # Used in app_integrated_data.py, to return the model output tables to a dictionary, to be written to an Excel file
@@ -120,7 +356,7 @@ class SplineRegression:
             title = f"{self.response_var} vs {self.predictor_var} with Spline Regression using {self.method} method for bundle {self.bundle_var}"
             if self.by_variable:  # Add the level of the by_variable to the title
                 title += f" for {self.by_variable} = {auxiliary_functions.get_sex_label(level)}"
-            title += f" (R2 = {self.calculate_diagnostics()['R2'][level]:.2f})"  # Add the R-squared value to the title
+            title += f" (R2 = {self.diagnostics['R2'][level]:.2f})"  # Add the R-squared value to the title
             # Subset the data by the level of the by_variable
             if self.by_variable:
                 df_subset = self.df[self.df[self.by_variable] == level]
@@ -138,22 +374,10 @@ class SplineRegression:
             )
 
             # Create spline fit line
-            x_range = np.linspace(
-                self.df[self.predictor_var].min(),
-                self.df[self.predictor_var].max(),
-                500,
-            )
-
-            # Create a design matrix for the spline regression
-            x_range_spline = dmatrix(
-                f"bs(x_range, knots={tuple(self.knots)}, degree={self.degree}, include_intercept=False)",
-                {"x_range": x_range},
-                return_type="dataframe",
-            )
+            x_range = self.prediction_grid()
 
-            # Predict the response variable using the model
-            y_range_spline = model.predict(x_range_spline)
-            ci_lower, ci_upper = model.get_prediction(x_range_spline).conf_int().T
+            # Predict the response variable using the model, with the spline basis of the fit
+            y_range_spline, ci_lower, ci_upper = self.predict(level, x_range)
 
             # Add a name to the spline fit line, based on the by_variable (if present)
             spline_name = (
@@ -211,12 +435,467 @@ class SplineRegression:
 
         # Append combined figure if it exists
         if combined_fig is not None:
-            R2_scores = []
-            for level, _ in self.models.items():
-                R2_scores.append(self.calculate_diagnostics()["R2"][level])
+            R2_scores = list(self.diagnostics["R2"].values())
             combined_fig.update_layout(
                 title_text=f"{self.response_var} vs {self.predictor_var} with Spline Regression using {self.method} method for bundle {self.bundle_var} for Female (R2 = {R2_scores[0]:.2f})/Male (R2 = {R2_scores[1]:.2f})",
             )
             figs.append(combined_fig)
 
         return figs
+
+
+class BatchedSplineRegression:
+    # Class for fitting the spline regression of many responses at once (every PC of every bundle)
+    # The design matrix only depends on the predictor and the knots, so it is built once per set of rows
+    # and all the responses sharing these rows are solved with a single QR decomposition
+    # The estimates are the same as the ones of SplineRegression (Gaussian GLM)
+    def __init__(
+        self,
+        dataframe,
+        response_vars,
+        predictor_var="Age",
+        bundle_var="Bundle",
+        degree=3,
+        knots=None,
+        by_variable=None,
+    ):
+        self.df = dataframe
+        self.response_vars = list(response_vars)
+        self.predictor_var = predictor_var
+        self.bundle_var = bundle_var
+        self.degree = degree
+        self.knots = knots
+        self.by_variable = by_variable
+        self.results = None
+
+    def fit_model(self):
+        """
+        Fits the spline regression of every response, for every bundle and level of the by_variable.
+
+        Returns:
+        - results (DataFrame): One row per (level, bundle, response), with the number of observations, the R2,
+          the coefficients (coef_*) and their standard errors (se_*).
+        """
+        # Wide format, one row per patient and one column per (bundle, response)
+        index_columns = ["Patient_ID", self.predictor_var]
+        if self.by_variable:
+            index_columns.append(self.by_variable)
+        # Repeated rows of a patient, age and bundle (e.g. two scans in the same year) are separate observations,
+        # as in SplineRegression, they are numbered so each one gets its own row of the wide format
+        scan = (
+            self.df.groupby(index_columns + [self.bundle_var], sort=False, dropna=False)
+            .cumcount()
+            .rename("Scan")
+        )
+        wide_df = self.df.set_index(index_columns + [scan, self.bundle_var])[
+            self.response_vars
+        ].unstack(self.bundle_var)
+        wide_df.columns = wide_df.columns.swaplevel(0, 1)
+        x = wide_df.index.get_level_values(self.predictor_var).to_numpy(dtype=float)
+        levels = (
+            wide_df.index.get_level_values(self.by_variable).to_numpy()
+            if self.by_variable
+            else np.full(len(wide_df), "Overall", dtype=object)
+        )
+        y = wide_df.to_numpy(dtype=float)
+
+        # Group the columns by their missing values, columns with the same rows share the design matrix
+        observed = ~np.isnan(y)
+        _, pattern_ids = np.unique(observed, axis=1, return_inverse=True)
+        pattern_ids = pattern_ids.ravel()
+
+        results = []
+        for pattern_id in np.unique(pattern_ids):
+            columns = np.flatnonzero(pattern_ids == pattern_id)
+            rows = observed[:, columns[0]]
+            # Same knots as SplineRegression, the percentiles over all levels of the bundle
+            knots = (
+                self.knots
+                if self.knots is not None
+                else np.percentile(x[rows], [25, 50, 75])
+            )
+            for level in pd.unique(levels[rows]):
+                level_rows = rows & (levels == level)
+                results.extend(
+                    self._solve(
+                        x[level_rows],
+                        y[np.ix_(level_rows, columns)],
+                        knots,
+                        level,
+                        wide_df.columns[columns],
+                    )
+                )
+
+        self.results = pd.DataFrame(results)
+        if len(self.results) > 0:
+            # Keep the responses in the given order (PC2 before PC10)
+            self.results["Response"] = pd.Categorical(
+                self.results["Response"], categories=self.response_vars
+            )
+            self.results = self.results.sort_values(
+                ["Level", "Bundle", "Response"], ignore_index=True
+            )
+        return self.results
+
+    def _solve(self, x, y, knots, level, columns):
+        # Solve all the responses of one set of rows with a single QR decomposition
+        basis = SplineBasis(x, knots, self.degree)
+        X = basis.design_matrix(x)
+        n, p = X.shape
+        names = basis.column_names
+        if n <= p:
+            # Not enough observations for the number of coefficients
+            return []
+
+        Q, R = np.linalg.qr(X)
+        coefficients = linalg.solve_triangular(R, Q.T @ y)
+        residuals = y - X @ coefficients
+        rss = np.sum(residuals**2, axis=0)
+        tss = np.sum((y - y.mean(axis=0)) ** 2, axis=0)
+        # Diagonal of (X'X)^-1 = R^-1 R^-T, scaled by the residual variance, as in the Gaussian GLM
+        R_inv = linalg.solve_triangular(R, np.eye(p))
+        standard_errors = np.sqrt(np.outer(np.sum(R_inv**2, axis=1), rss / (n - p)))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r2 = 1 - rss / tss
+
+        results = []
+        for j, (bundle, response) in enumerate(columns):
+            result = {
+                "Level": level,
+                "Bundle": bundle,
+                "Response": response,
+                "N": n,
+                "R2": r2[j],
+            }
+            result.update(
+                {
+                    f"coef_{name}": value
+                    for name, value in zip(names, coefficients[:, j])
+                }
+            )
+            result.update(
+                {
+                    f"se_{name}": value
+                    for name, value in zip(names, standard_errors[:, j])
+                }
+            )
+            results.append(result)
+        return results
+
+    def r2_table(self):
+        # R2 of every bundle (rows) and response (columns), with one column block per level of the by_variable
+        table = self.results.pivot_table(
+            index="Bundle", columns=["Level", "Response"], values="R2", observed=True
+        )
+        if self.by_variable:
+            table.columns = [
+                f"{response} ({auxiliary_functions.get_sex_label(level)})"
+                for level, response in table.columns
+            ]
+        else:
+            table.columns = [response for _, response in table.columns]
+        return table.reset_index()
+
+
+def plot_normative_centiles(atlas_df, bundle, measure, subject_df=None, z_df=None):
+    """
+    Plots the normative centile curves of one bundle and measure, one set of curves per sex.
+
+    Parameters:
+    - atlas_df (DataFrame): The atlas, see normative_atlas.build_normative_atlas.
+    - bundle (str): The bundle.
+    - measure (str): The measure (raw measure or PC).
+    - subject_df (DataFrame): The rows of a subject, drawn as markers on the curves, optional.
+    - z_df (DataFrame): The z-scores of the subject, see normative_atlas.normative_z_scores, used in the hover text.
+
+    Returns:
+    - fig (Figure): The figure with the curves.
+    """
+    curves_df = atlas_df[
+        (atlas_df["Bundle"] == str(bundle)) & (atlas_df["Measure"] == measure)
+    ]
+    centiles = [column for column in atlas_df.columns if column.startswith("P")]
+    fig = go.Figure()
+    colors = px.colors.qualitative.Plotly
+    for i, (sex, sex_df) in enumerate(curves_df.groupby("Sex")):
+        for centile in centiles:
+            fig.add_scatter(
+                x=sex_df["Age"],
+                y=sex_df[centile],
+                mode="lines",
+                # The median is drawn solid, the other centiles dashed
+                line=dict(
+                    color=colors[i % len(colors)],
+                    dash="solid" if centile == "P50" else "dash",
+                    width=2 if centile == "P50" else 1,
+                ),
+                name=f"{centile} ({auxiliary_functions.get_sex_label(sex)})",
+            )
+
+    # The subject is only drawn if it has the measure (e.g. not for the PC curves of an atlas built offline)
+    if subject_df is not None and len(subject_df) > 0 and measure in subject_df:
+        subject_df = subject_df[subject_df["Bundle"].astype(str) == str(bundle)]
+        hover_text = subject_df["Patient_ID"].astype(str)
+        if z_df is not None:
+            z_values = z_df[
+                (z_df["Bundle"] == str(bundle)) & (z_df["Measure"] == measure)
+            ]["Z_Score"].to_numpy()
+            hover_text = [
+                f"{patient_id}, z = {z:.2f}"
+                for patient_id, z in zip(hover_text, z_values)
+            ]
+        fig.add_scatter(
+            x=subject_df["Age"],
+            y=subject_df[measure],
+            mode="markers",
+            marker=dict(size=12, color="black", symbol="x"),
+            text=hover_text,
+            name="Subject",
+        )
+
+    fig.update_layout(
+        title=f"Normative centiles of {measure} for bundle {bundle}",
+        xaxis_title="Age",
+        yaxis_title=measure,
+        legend_title="Legend",
+        height=600,
+    )
+    return fig
+
+
+def _cv_error(x, y, knots, degree, folds):
+    """
+    Cross-validated mean squared error of one knot set and degree
+    The design matrix is built once on all the rows, the normal equations of each training fold
+    are the ones of all the rows minus the ones of the test fold
+    """
+    basis = SplineBasis(x, knots, degree)
+    X = basis.design_matrix(x)
+    XtX = X.T @ X
+    Xty = X.T @ y
+    errors = []
+    for test_rows in folds:
+        X_test = X[test_rows]
+        y_test = y[test_rows]
+        coefficients = linalg.lstsq(XtX - X_test.T @ X_test, Xty - X_test.T @ y_test)[0]
+        errors.append(np.mean((y_test - X_test @ coefficients) ** 2))
+    return np.mean(errors), np.std(errors) / np.sqrt(len(errors))
+
+
+def select_knots_cv(
+    df,
+    response_var,
+    predictor_var="Age",
+    group_var="Patient_ID",
+    by_variable=None,
+    degrees=KNOT_SELECTION_DEGREES,
+    max_knots=KNOT_SELECTION_MAX_KNOTS,
+    n_splits=KNOT_SELECTION_FOLDS,
+    time_budget=KNOT_SELECTION_TIME_BUDGET,
+    max_workers=None,
+):
+    """
+    Selects the knots and degree of the spline regression by k-fold cross-validation, the candidates are evaluated in parallel threads.
+    The candidates place 0 to max_knots knots at equally spaced percentiles of the predictor. The folds are grouped by subject,
+    so the rows of a subject are never both in the training and the test fold.
+    With a by_variable, the selection is done for every level on its own rows (the time budget is shared between the levels),
+    so the knots of a level are always within its range of the predictor.
+
+    Parameters:
+    - df (DataFrame): The data, with the predictor, the response and the group columns.
+    - response_var (str): The response variable.
+    - predictor_var (str): The predictor variable.
+    - group_var (str): The column identifying the subjects.
+    - by_variable (str): The variable splitting the data in separate fits, as in SplineRegression.
+    - degrees (list): The candidate degrees.
+    - max_knots (int): The maximum number of knots.
+    - n_splits (int): The number of folds.
+    - time_budget (float): The latency budget in seconds, the candidates not evaluated within it are skipped.
+    - max_workers (int): The number of threads.
+
+    Returns:
+    - knots (list): The knots of the best candidate, a dictionary of the knots of every level with a by_variable.
+    - degree (int): The degree of the best candidate, a dictionary of the degree of every level with a by_variable.
+    - cv_df (DataFrame): The cross-validation error of every evaluated candidate, with a Level column with a by_variable.
+    """
+    if not by_variable:
+        return _select_knots_cv(
+            df,
+            response_var,
+            predictor_var,
+            group_var,
+            degrees,
+            max_knots,
+            n_splits,
+            time_budget,
+            max_workers,
+        )
+    levels = df[by_variable].unique()
+    knots, degree, cv_dfs = {}, {}, []
+    for level in levels:
+        knots[level], degree[level], level_cv_df = _select_knots_cv(
+            df[df[by_variable] == level],
+            response_var,
+            predictor_var,
+            group_var,
+            degrees,
+            max_knots,
+            n_splits,
+            time_budget / len(levels) if time_budget else time_budget,
+            max_workers,
+        )
+        cv_dfs.append(level_cv_df.assign(Level=level))
+    return knots, degree, pd.concat(cv_dfs, ignore_index=True)
+
+
+def _select_knots_cv(
+    df,
+    response_var,
+    predictor_var,
+    group_var,
+    degrees,
+    max_knots,
+    n_splits,
+    time_budget,
+    max_workers,
+):
+    """
+    Selects the knots and degree of one fit, see select_knots_cv
+    """
+    start = time.time()
+    df = df.dropna(subset=[predictor_var, response_var])
+    x = df[predictor_var].to_numpy(dtype=float)
+    y = df[response_var].to_numpy(dtype=float)
+    groups = df[group_var].to_numpy()
+    n_splits = min(n_splits, len(np.unique(groups)))
+    folds = [
+        test_rows for _, test_rows in GroupKFold(n_splits=n_splits).split(x, y, groups)
+    ]
+
+    # Simplest candidates first, so they are the ones evaluated if the budget runs out
+    candidates = [
+        (
+            [
+                float(knot)
+                for knot in np.percentile(x, np.linspace(0, 100, n_knots + 2)[1:-1])
+            ],
+            degree,
+        )
+        for n_knots in range(max_knots + 1)
+        for degree in degrees
+    ]
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {
+        executor.submit(_cv_error, x, y, knots, degree, folds): (knots, degree)
+        for knots, degree in candidates
+    }
+    remaining = max(time_budget - (time.time() - start), 0) if time_budget else None
+    done, _ = wait(futures, timeout=remaining)
+    if not done:
+        # At least the simplest candidate is evaluated, whatever the budget
+        done, _ = wait(list(futures)[:1])
+    # The candidates still running are left to finish in the background, the queued ones are cancelled
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    results = []
+    for future in done:
+        knots, degree = futures[future]
+        cv_mse, cv_se = future.result()
+        results.append(
+            {
+                "Degree": degree,
+                "N_Knots": len(knots),
+                "Knots": ", ".join(f"{knot:.1f}" for knot in knots),
+                "CV_MSE": cv_mse,
+                "CV_SE": cv_se,
+            }
+        )
+    cv_df = pd.DataFrame(results).sort_values(["Degree", "N_Knots"], ignore_index=True)
+    best = cv_df["CV_MSE"].idxmin()
+    knots, degree = next(
+        candidate
+        for candidate in candidates
+        if candidate[1] == cv_df.loc[best, "Degree"]
+        and len(candidate[0]) == cv_df.loc[best, "N_Knots"]
+    )
+    print(
+        f"Knot selection: {len(cv_df)} of {len(candidates)} candidates in {time.time() - start:.2f} s"
+    )
+    return knots, degree, cv_df
+
+
+def plot_knot_selection_cv(cv_df, response_var, knots, degree):
+    """
+    Plots the cross-validation error of the candidate knot sets, one line per degree (and level, if the knots were
+    selected per level of a by_variable), with the selected candidates in the title
+    """
+    fig = go.Figure()
+    if "Level" in cv_df.columns:
+        for (level, candidate_degree), degree_df in cv_df.groupby(["Level", "Degree"]):
+            fig.add_scatter(
+                x=degree_df["N_Knots"],
+                y=degree_df["CV_MSE"],
+                error_y=dict(type="data", array=degree_df["CV_SE"]),
+                mode="lines+markers",
+                text=degree_df["Knots"],
+                name=f"{auxiliary_functions.get_sex_label(level)}, degree {candidate_degree}",
+            )
+        selected = "; ".join(
+            f"{auxiliary_functions.get_sex_label(level)}: degree {degree[level]} with knots ({', '.join(f'{knot:.1f}' for knot in knots[level])})"
+            for level in knots
+        )
+    else:
+        for candidate_degree, degree_df in cv_df.groupby("Degree"):
+            fig.add_scatter(
+                x=degree_df["N_Knots"],
+                y=degree_df["CV_MSE"],
+                error_y=dict(type="data", array=degree_df["CV_SE"]),
+                mode="lines+markers",
+                text=degree_df["Knots"],
+                name=f"Degree {candidate_degree}",
+            )
+        selected = (
+            f"degree {degree} with knots ({', '.join(f'{knot:.1f}' for knot in knots)})"
+        )
+    fig.update_layout(
+        title=f"Cross-validated error of {response_var}, selected {selected}",
+        xaxis_title="Number of knots",
+        yaxis_title="CV mean squared error",
+        legend_title="Legend",
+        height=400,
+    )
+    return fig
+
+
+def add_bootstrap_bands(spline_reg, figs, bands, n_done, n_total):
+    """
+    Adds the bootstrap percentile bands of a fitted SplineRegression to the figures of its plot method,
+    so the bands are shown against the fitted curves they were computed for, with the number of resamples done
+    so far in the titles. Returns new figures, figs is not modified.
+    """
+    figs = [go.Figure(fig) for fig in figs]
+    x_range = spline_reg.prediction_grid()
+    for i, level in enumerate(spline_reg.models):
+        if level not in bands:
+            continue
+        # One figure per level, or all the levels in the same figure
+        fig = figs[0] if spline_reg.plots == "Same Plot" else figs[i]
+        label = (
+            auxiliary_functions.get_sex_label(level)
+            if spline_reg.by_variable
+            else level
+        )
+        lower, upper = bands[level]
+        fig.add_scatter(
+            x=np.concatenate([x_range, x_range[::-1]]),
+            y=np.concatenate([lower, upper[::-1]]),
+            fill="toself",
+            fillcolor="rgba(99,110,250,0.25)",
+            line=dict(color="rgba(255,255,255,0)"),
+            name=f"Bootstrap Band ({label})",
+        )
+    for fig in figs:
+        fig.update_layout(
+            title_text=f"{fig.layout.title.text}, bootstrap bands ({n_done}/{n_total} resamples)"
+        )
+    return figs
@@ -0,0 +1,170 @@
+import numpy as np
+from scipy import stats
+
+# Columns that define a cell, sketches are precomputed per bundle x age group x sex
+CELL_COLUMNS = ["Bundle", "Age_Group", "Sex"]
+
+# Identifier columns, the other columns are the measures
+ID_COLUMNS = ["Patient", "Patient_ID", "Bundle", "Sex", "Age", "Age_Group"]
+
+# Same clipping as sklearn's QuantileTransformer, so the extreme values map to about +-5.2
+BOUNDS_THRESHOLD = 1e-7
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile summary of a single measure.
+
+    The sketch keeps at most `size` weighted points. A column with at most `size` values is stored exactly;
+    larger columns are compressed into `size` buckets of equal weight, each represented by its middle value.
+    Merging concatenates the points of the sketches and compresses them again.
+
+    Accuracy bound: one compression moves the rank of any value by at most half a bucket, i.e. N / (2 * size)
+    for a total weight N. Cells are compressed once when they are built and once when merged, so the rank of
+    any value in a merged sketch is off by at most N / size, a quantile error of at most 1 / size
+    (0.5% with the default size of 200).
+    """
+
+    def __init__(self, values, weights, size):
+        self.values = values
+        self.weights = weights
+        self.size = size
+
+    @classmethod
+    def from_values(cls, values, size=200):
+        """
+        Build a sketch from the raw values of a measure (NaN values are ignored)
+        """
+        values = np.sort(values[~np.isnan(values)])
+        return cls._compress(values, np.ones(len(values)), size)
+
+    @classmethod
+    def merge(cls, sketches):
+        """
+        Merge several sketches into one, the accuracy bound of the result is the one given in the class docstring
+        """
+        size = max(sketch.size for sketch in sketches)
+        values = np.concatenate([sketch.values for sketch in sketches])
+        weights = np.concatenate([sketch.weights for sketch in sketches])
+        order = np.argsort(values, kind="stable")
+        return cls._compress(values[order], weights[order], size)
+
+    @classmethod
+    def _compress(cls, values, weights, size):
+        """
+        Compress sorted weighted values into at most size points of equal weight
+        """
+        if len(values) <= size:
+            return cls(values, weights, size)
+        total_weight = weights.sum()
+        cumulative_weights = np.cumsum(weights)
+        bucket_weight = total_weight / size
+        # Value at the middle rank of each bucket
+        middle_ranks = (np.arange(size) + 0.5) * bucket_weight
+        indices = np.searchsorted(cumulative_weights, middle_ranks, side="left")
+        indices = np.minimum(indices, len(values) - 1)
+        return cls(values[indices], np.full(size, bucket_weight), size)
+
+    @property
+    def count(self):
+        # Number of values summarised, the bucket weights are fractional so the sum is rounded
+        return int(round(self.weights.sum()))
+
+    def cdf(self, x):
+        """
+        Approximate quantile of each value of x, with the same conventions as sklearn's QuantileTransformer:
+        the smallest point maps to 0, the largest to 1, and repeated values map to the middle of their range
+        """
+        if len(self.values) == 1:
+            return np.full(len(x), 0.5)
+        # Rank of the centre of each point, rescaled so the first and last points are at 0 and 1
+        centres = np.cumsum(self.weights) - self.weights / 2
+        references = (centres - centres[0]) / (centres[-1] - centres[0])
+        # Interpolate in both directions and average, to handle repeated values
+        forward = np.interp(x, self.values, references)
+        backward = -np.interp(-x, -self.values[::-1], -references[::-1])
+        return 0.5 * (forward + backward)
+
+
+def build_cell_sketches(df, measures=None, size=200):
+    """
+    Precompute the quantile sketches of every measure for every bundle x age group x sex cell.
+    Used when the data is loaded, so the outlier normal-score transform does not need to sort the raw data.
+
+    Parameters:
+    - df (DataFrame): The full DataFrame, as returned by data_loading.transform_mat_to_df.
+    - measures (list): The measures to sketch, defaults to all measures.
+    - size (int): The maximum number of points of a sketch, see QuantileSketch for the accuracy bound.
+
+    Returns:
+    - sketches (dict): {(bundle, age_group, sex): {measure: QuantileSketch}}
+    """
+    if measures is None:
+        measures = [column for column in df.columns if column not in ID_COLUMNS]
+    sketches = {}
+    for cell, cell_df in df.groupby(CELL_COLUMNS, observed=True):
+        values = cell_df[measures].to_numpy(dtype=float)
+        sketches[cell] = {
+            measure: QuantileSketch.from_values(values[:, i], size)
+            for i, measure in enumerate(measures)
+        }
+    return sketches
+
+
+def covers_whole_cells(df, cell_sketches):
+    """
+    Checks whether the selection keeps every row of the cells it touches, in which case the merged
+    cell sketches describe the selection (up to the accuracy bound) and SketchQuantileTransformer can be used
+    """
+    rows = df.groupby(CELL_COLUMNS, observed=True).size()
+    for cell, n_rows in rows.items():
+        if cell not in cell_sketches:
+            return False
+        # The sketches ignore NaN values, so the largest count is the number of rows of the cell
+        cell_rows = max(sketch.count for sketch in cell_sketches[cell].values())
+        if n_rows < cell_rows:
+            return False
+    return True
+
+
+class SketchQuantileTransformer:
+    """
+    Normal-score transform built from precomputed cell sketches, a drop-in replacement of
+    QuantileTransformer(output_distribution="normal") in dim_reduction_backend.run_outlier_pca_backend.
+
+    fit() merges the sketches of the cells present in the selection instead of sorting the raw data.
+    The reference distribution is therefore the one of the whole cells: if the selection only keeps part
+    of a cell (patient or age range), the exact QuantileTransformer should be used instead.
+    """
+
+    def __init__(self, cell_sketches):
+        self.cell_sketches = cell_sketches
+
+    def fit(self, df):
+        """
+        Merge the sketches of the cells in df, for the measures in df
+        """
+        self.feature_names_in_ = [
+            column for column in df.columns if column not in ID_COLUMNS
+        ]
+        cells = df[CELL_COLUMNS].drop_duplicates().itertuples(index=False, name=None)
+        cell_sketches = [self.cell_sketches[cell] for cell in cells]
+        self.sketches_ = {
+            measure: QuantileSketch.merge([sketch[measure] for sketch in cell_sketches])
+            for measure in self.feature_names_in_
+        }
+        return self
+
+    def transform(self, X):
+        """
+        Map the measures of X to normal scores, X can be a DataFrame or an array with the fitted measures as columns
+        """
+        X = np.asarray(X, dtype=float)
+        quantiles = np.column_stack(
+            [
+                self.sketches_[measure].cdf(X[:, i])
+                for i, measure in enumerate(self.feature_names_in_)
+            ]
+        )
+        quantiles = np.clip(quantiles, BOUNDS_THRESHOLD, 1 - BOUNDS_THRESHOLD)
+        return stats.norm.ppf(quantiles)
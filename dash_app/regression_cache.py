@@ -0,0 +1,131 @@
+import cache_management
+import data_processing
+import normative_atlas
+import principal_components_age_corr_regression_viz
+from constants import (
+    NORMATIVE_AGE_STEP,
+    NORMATIVE_CENTILES,
+    REGRESSION_CACHE_DIR,
+    REGRESSION_CACHE_EXPIRE,
+    REGRESSION_CACHE_SIZE_LIMIT,
+)
+
+# Fitted regression outputs and figures, keyed by the data and the parameters of the regression
+# A disk cache with a least recently used eviction policy is used, so the budget holds across the server and the background processes
+cache = cache_management.managed_cache(
+    REGRESSION_CACHE_DIR, REGRESSION_CACHE_SIZE_LIMIT, "derived"
+)
+
+
+def _spline_parameter(value):
+    """
+    Converts knots or a degree to a hashable value, they can be given per level of the by_variable as dictionaries
+    """
+    if isinstance(value, dict):
+        return tuple(
+            (str(level), _spline_parameter(level_value))
+            for level, level_value in sorted(
+                value.items(), key=lambda item: str(item[0])
+            )
+        )
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return tuple(float(knot) for knot in value)
+
+
+def regression_key(spline_reg, color_column=None, hover_data=None):
+    """
+    Computes the cache key of a SplineRegression: the content of the data it uses (so a new dataset or PCA result
+    gives a new key), the bundle, the response, the knots, the degree, the by_variable, the plot mode and the plot options
+    """
+    columns = [
+        column
+        for column in dict.fromkeys(
+            [spline_reg.predictor_var, spline_reg.response_var]
+            + ([spline_reg.by_variable] if spline_reg.by_variable else [])
+            + ([color_column] if color_column else [])
+            + (hover_data or [])
+        )
+        if column in spline_reg.df.columns
+    ]
+    return data_processing.dataframe_fingerprint(
+        spline_reg.df[columns],
+        str(spline_reg.bundle_var),
+        spline_reg.response_var,
+        _spline_parameter(spline_reg.knots),
+        _spline_parameter(spline_reg.degree),
+        spline_reg.method,
+        spline_reg.by_variable,
+        spline_reg.plots,
+        color_column,
+    )
+
+
+def fit_and_plot(spline_reg, color_column=None, hover_data=None):
+    """
+    Memoized SplineRegression.fit_model, plot and fit_model_to_df
+    Repeated requests for the same regression return the cached figures and model outputs without refitting
+
+    Parameters:
+    - spline_reg (SplineRegression): The regression, not fitted yet.
+    - color_column, hover_data: The options of SplineRegression.plot.
+
+    Returns:
+    - figs (list): The figures, as dictionaries.
+    - models_dict (dict): The model output tables, see SplineRegression.fit_model_to_df.
+    """
+    key = regression_key(spline_reg, color_column, hover_data)
+    cached = cache.get(key)
+    if cached is not None:
+        print("Regression cache hit")
+        return cached
+
+    spline_reg.fit_model()
+    figs = [
+        fig.to_dict()
+        for fig in spline_reg.plot(color_column=color_column, hover_data=hover_data)
+    ]
+    result = (figs, spline_reg.fit_model_to_df())
+    cache.set(key, result, expire=REGRESSION_CACHE_EXPIRE)
+    return result
+
+
+def select_knots(df, response_var, by_variable=None):
+    """
+    Memoized principal_components_age_corr_regression_viz.select_knots_cv
+    The selection has a time budget, so it can differ between two runs. Memoizing it gives the regression plot
+    and its bootstrap bands the same knots and degree.
+    """
+    columns = ["Age", "Patient_ID", response_var] + (
+        [by_variable] if by_variable else []
+    )
+    key = data_processing.dataframe_fingerprint(
+        df[columns], "select_knots_cv", response_var, by_variable
+    )
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    result = principal_components_age_corr_regression_viz.select_knots_cv(
+        df, response_var, by_variable=by_variable
+    )
+    cache.set(key, result, expire=REGRESSION_CACHE_EXPIRE)
+    return result
+
+
+def build_normative_atlas(df):
+    """
+    Memoized normative_atlas.build_normative_atlas, keyed by the content of the data
+    The app builds the atlas of the whole uploaded cohort, so it is fitted once per dataset, not once per selection
+    """
+    key = data_processing.dataframe_fingerprint(
+        df, "normative_atlas", NORMATIVE_CENTILES, NORMATIVE_AGE_STEP
+    )
+    cached = cache.get(key)
+    if cached is not None:
+        print("Normative atlas cache hit")
+        return cached
+
+    atlas_df = normative_atlas.build_normative_atlas(df)
+    cache.set(key, atlas_df, expire=REGRESSION_CACHE_EXPIRE)
+    return atlas_df
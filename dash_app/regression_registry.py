@@ -0,0 +1,39 @@
+import uuid
+
+import cache_management
+from constants import (
+    REGRESSION_REGISTRY_DIR,
+    REGRESSION_REGISTRY_EXPIRE,
+    REGRESSION_REGISTRY_SIZE_LIMIT,
+)
+
+# The model outputs of the regression plots are kept server side, keyed by the key of their plot
+# Only the list of keys is sent to the browser (store-pca-scatter-plot-output)
+# A disk cache is used, so the entries are shared between the server and the background callback processes
+registry = cache_management.managed_cache(
+    REGRESSION_REGISTRY_DIR, REGRESSION_REGISTRY_SIZE_LIMIT, "derived"
+)
+
+
+def add_outputs(outputs):
+    """
+    Stores the model outputs of one plot, a dictionary of DataFrames written as sheets by the download
+    Returns the key of the plot, used in the ids of its buttons
+    """
+    key = uuid.uuid4().hex
+    registry.set(key, outputs, expire=REGRESSION_REGISTRY_EXPIRE)
+    return key
+
+
+def get_outputs(key):
+    """
+    Returns the model outputs of one plot, None if they were removed or expired
+    """
+    return registry.get(key)
+
+
+def remove_outputs(key):
+    """
+    Removes the model outputs of one plot
+    """
+    registry.delete(key)
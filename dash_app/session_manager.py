@@ -0,0 +1,185 @@
+import hashlib
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+import flask
+import pandas as pd
+
+import data_processing
+from constants import SERVERSIDE_HOT_CACHE_BYTES, SESSION_COOKIE, SESSION_MEMORY_BYTES
+from hot_cache import HotCache, estimate_nbytes
+
+# Marker of a value that is not in memory (None is a valid Serverside value)
+_MISSING = object()
+
+
+def current_session():
+    """
+    Returns the session id of the request being handled, None outside of a request (e.g. in a background callback process)
+    """
+    if flask.has_request_context():
+        return flask.request.cookies.get(SESSION_COOKIE)
+    return None
+
+
+def set_session_cookie(response):
+    """
+    after_request hook of the server, gives every browser a session id cookie
+    """
+    if flask.request.cookies.get(SESSION_COOKIE) is None:
+        response.set_cookie(
+            SESSION_COOKIE, uuid.uuid4().hex, httponly=True, samesite="Lax"
+        )
+    return response
+
+
+def content_key(df):
+    """
+    Computes the content hash of a DataFrame, identical datasets (e.g. the same cohort uploaded in two sessions)
+    get the same key. Unlike data_processing.dataframe_fingerprint alone, the index and the dtypes are part of the key,
+    since they are stored too.
+    """
+    index_hash = hashlib.sha1(
+        pd.util.hash_pandas_object(df.index).values.tobytes()
+    ).hexdigest()
+    return "df-" + data_processing.dataframe_fingerprint(
+        df, [str(dtype) for dtype in df.dtypes], index_hash
+    )
+
+
+class SessionManager:
+    """
+    Keeps the deserialized Serverside values of the browser sessions in memory, within a per-session and a global budget.
+    The values are keyed by content, so a dataset used by several sessions is held once and its bytes are shared
+    between them. Over the session budget, the least recently used values of the session are spilled (dropped from
+    memory, they are read back from the disk when needed). Over the global budget, the least recently active sessions
+    are spilled entirely.
+    """
+
+    def __init__(
+        self,
+        global_budget=SERVERSIDE_HOT_CACHE_BYTES,
+        session_budget=SESSION_MEMORY_BYTES,
+    ):
+        self.cache = HotCache(global_budget)
+        self.session_budget = session_budget
+        # Keys of the values used by each session, least recently used first, and the sessions least recently active first
+        self.sessions = OrderedDict()
+        self.last_seen = {}
+        self.spills = 0
+        self._lock = threading.RLock()
+
+    def get(self, session, key, default=None):
+        """
+        Returns the value of key for a session and marks it as used by the session, or default if it is not in memory
+        """
+        with self._lock:
+            value = self.cache.get(key, _MISSING)
+            if value is _MISSING:
+                return default
+            self._claim(session, key)
+            return value
+
+    def peek(self, key, default=None):
+        return self.cache.peek(key, default)
+
+    def put(self, session, key, value):
+        """
+        Keeps a value in memory for a session, then spills values and sessions until the budgets hold
+        Values larger than the session budget are not kept
+        """
+        nbytes = estimate_nbytes(value)
+        if nbytes > self.session_budget:
+            return
+        with self._lock:
+            # Room is made by spilling the least recently active sessions, before the cache evicts values on its own
+            for other in list(self.sessions):
+                if self.cache.stats()["bytes"] + nbytes <= self.cache.max_bytes:
+                    break
+                if other != session:
+                    self._spill_session(other)
+            self.cache.put(key, value, nbytes)
+            if key not in self.cache:
+                return
+            self._claim(session, key)
+            keys = self.sessions[session]
+            while self._footprint(session) > self.session_budget and len(keys) > 1:
+                self._release(session, next(iter(keys)))
+                self.spills += 1
+
+    def discard(self, match):
+        """
+        Removes the values whose key satisfies match (a callable) from memory and from the sessions using them
+        """
+        with self._lock:
+            self.cache.discard(match)
+            for keys in self.sessions.values():
+                for key in [key for key in keys if match(key)]:
+                    del keys[key]
+
+    def _claim(self, session, key):
+        keys = self.sessions.setdefault(session, OrderedDict())
+        keys[key] = None
+        keys.move_to_end(key)
+        self.sessions.move_to_end(session)
+        self.last_seen[session] = time.time()
+
+    def _release(self, session, key):
+        """
+        Removes a value from a session, the value is dropped from memory when no other session uses it
+        """
+        self.sessions[session].pop(key, None)
+        if not any(key in keys for keys in self.sessions.values()):
+            self.cache.discard(lambda cache_key: cache_key == key)
+
+    def _spill_session(self, session):
+        for key in list(self.sessions[session]):
+            self._release(session, key)
+        del self.sessions[session]
+        self.last_seen.pop(session, None)
+        self.spills += 1
+
+    def _owners(self):
+        return Counter(key for keys in self.sessions.values() for key in keys)
+
+    def _footprint(self, session, owners=None):
+        """
+        Bytes in memory of a session, the bytes of a value used by several sessions are split between them
+        """
+        owners = owners or self._owners()
+        return sum(
+            self.cache.size(key) / owners[key] for key in self.sessions.get(session, ())
+        )
+
+    def telemetry(self):
+        """
+        Returns the memory footprint of every session (values, bytes, shared values, idle seconds),
+        the budgets and the counters of the server process. The session ids are shortened.
+        """
+        with self._lock:
+            owners = self._owners()
+            now = time.time()
+            cache_stats = self.cache.stats()
+            return {
+                "sessions": {
+                    str(session)[:8]: {
+                        # Values the cache evicted on its own are not counted
+                        "values": sum(key in self.cache for key in keys),
+                        "bytes": int(self._footprint(session, owners)),
+                        "shared_values": sum(
+                            owners[key] > 1 for key in keys if key in self.cache
+                        ),
+                        "idle_seconds": round(now - self.last_seen[session]),
+                    }
+                    for session, keys in reversed(self.sessions.items())
+                },
+                "bytes": cache_stats["bytes"],
+                "global_budget": self.cache.max_bytes,
+                "session_budget": self.session_budget,
+                "spills": self.spills,
+                "hits": cache_stats["hits"],
+                "misses": cache_stats["misses"],
+                "evictions": cache_stats["evictions"],
+            }